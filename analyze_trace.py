@@ -0,0 +1,263 @@
+"""
+analyze_trace.py reads a datagram trace recorded with --trace by the server or client, and
+rebuilds what happened on every connection, like tcptrace does for TCP.
+
+For the data the traced side sent, it follows every data segment until the cumulative ACK
+of the peer covers it: the RTT samples (only of segments sent once, as Karn's algorithm
+has it), the bytes in flight, the retransmissions, the parity segments and the duplicate
+ACKs. For the data the traced side received, it counts the duplicates, the segments that
+came out of order and the ones with a bad checksum. A stall is a time of at least --stall
+seconds without any datagram to or from a peer, in the middle of a transfer.
+
+A summary of every peer is printed, and --series writes every event as one JSON line with
+the bytes in flight at that time, to plot the connection over time.
+Usage: python3 analyze_trace.py server.trace [--series series.jsonl] [--stall 0.5]
+"""
+import argparse
+import json
+import sys
+from typing import Dict, List
+from lib.constants import ACK_FLAG, FIN_FLAG, HEADER_SIZE, METADATA_SEQ, OPTIONS_FLAG, SYN_FLAG, TRACE_STALL
+from lib.trace import RECEIVED, SENT, read_trace
+
+
+def parse_analyze_args():
+    """Parse the argument when running the trace analyzer"""
+    parser = argparse.ArgumentParser(
+        description="Rebuild the RTT samples, data in flight, retransmissions and stalls of a datagram trace"
+    )
+    parser.add_argument("trace", type=str,
+                        help="The trace file written with --trace")
+    parser.add_argument("--series", type=str,
+                        help="Write every event as a JSON line to this file, - for stdout")
+    parser.add_argument("--stall", type=float, default=TRACE_STALL,
+                        help="The seconds without any datagram in the middle of a transfer that count as a stall")
+    parser.add_argument("--json", action="store_true",
+                        help="Print the summary of every peer as a JSON line instead of text")
+    return parser.parse_args()
+
+
+def is_data(flags: int, seq: int, length: int) -> bool:
+    """Whether a datagram is the metadata or a data segment, with or without a SYN"""
+    return not flags & (ACK_FLAG | FIN_FLAG) and seq >= METADATA_SEQ and length > HEADER_SIZE
+
+
+def is_parity(flags: int, seq: int) -> bool:
+    """
+    Whether a data segment is a parity segment: data segments have no options, parity
+    segments do and share the seq of the first data segment of their group
+    """
+    return flags & OPTIONS_FLAG and not flags & SYN_FLAG and seq > METADATA_SEQ
+
+
+class PeerAnalysis:
+    """Events of the connection to one peer, in both directions"""
+
+    def __init__(self, name: str, stall: float, series) -> None:
+        self.name = name
+        self.stall = stall
+        self.series = series
+        self.first = None
+        self.last = None
+        self.counts = {"sent": 0, "received": 0, "dropped": 0, "invalid": 0, "data_segments": 0,
+                       "data_bytes": 0, "retransmits": 0, "parity": 0, "acked_bytes": 0,
+                       "dup_acks": 0, "received_data": 0, "duplicates": 0, "out_of_order": 0}
+        self.rtts: List[float] = []
+        self.stalls: List[float] = []
+        self.in_flight_max = 0
+        self.reset_sent()
+        self.reset_received()
+
+    def reset_sent(self):
+        """Forget the data sent, the next file of a session starts again at the metadata"""
+        # Length and time of the data segments sent, and how many times each was sent, by seq
+        self.lengths: Dict[int, int] = {}
+        self.sent_at: Dict[int, float] = {}
+        self.sends: Dict[int, int] = {}
+        self.acked = 0
+        self.in_flight = 0
+
+    def reset_received(self):
+        self.received = set()
+        self.expected = None
+        self.receiving = False
+
+    def event(self, at: float, name: str, seq: int, ack: int, length: int, **extra):
+        if self.series is None:
+            return
+        line = {"time": round(at, 6), "peer": self.name, "event": name, "seq": seq, "ack": ack,
+                "length": length, "in_flight": self.in_flight}
+        line.update(extra)
+        self.series.write(json.dumps(line) + "\n")
+
+    def add(self, at: float, kind: int, seq: int, ack: int, flags: int, length: int, valid: bool):
+        if self.last is not None and at - self.last >= self.stall and (self.in_flight or self.receiving):
+            self.stalls.append(at - self.last)
+            self.event(self.last, "stall", seq, ack, 0, duration=round(at - self.last, 6))
+        if self.first is None:
+            self.first = at
+        self.last = at
+        if kind == RECEIVED:
+            self.counts["received"] += 1
+            if not valid:
+                self.counts["invalid"] += 1
+                self.event(at, "invalid", seq, ack, length)
+                return
+            self.on_received(at, seq, ack, flags, length)
+        else:
+            self.counts["sent" if kind == SENT else "dropped"] += 1
+            self.on_sent(at, kind, seq, ack, flags, length)
+
+    def on_sent(self, at: float, kind: int, seq: int, ack: int, flags: int, length: int):
+        if flags & FIN_FLAG:
+            self.reset_sent()
+            self.reset_received()
+            return
+        if not is_data(flags, seq, length):
+            return
+        if is_parity(flags, seq):
+            self.counts["parity"] += 1
+            self.event(at, "parity", seq, ack, length)
+            return
+        sends = self.sends.get(seq, 0)
+        self.sends[seq] = sends + 1
+        if sends:
+            self.counts["retransmits"] += 1
+            name = "retransmit"
+        else:
+            self.counts["data_segments"] += 1
+            self.counts["data_bytes"] += length
+            self.lengths[seq] = length
+            self.sent_at[seq] = at
+            if seq >= self.acked:
+                self.in_flight += length
+                self.in_flight_max = max(self.in_flight_max, self.in_flight)
+            name = "send"
+        self.event(at, name if kind == SENT else "drop", seq, ack, length)
+
+    def on_received(self, at: float, seq: int, ack: int, flags: int, length: int):
+        if flags & FIN_FLAG:
+            self.reset_sent()
+            self.reset_received()
+            return
+        if is_data(flags, seq, length):
+            self.on_data(at, seq, ack, flags, length)
+        elif flags & ACK_FLAG and self.sends:
+            self.on_ack(at, seq, ack, length)
+
+    def on_ack(self, at: float, seq: int, ack: int, length: int):
+        # The ACK of seq carries seq + 1, and covers every segment before it
+        if ack <= self.acked or ack > max(self.sends) + 1:
+            if self.in_flight:
+                self.counts["dup_acks"] += 1
+                self.event(at, "dup_ack", seq, ack, length)
+            return
+        for covered in range(max(self.acked, min(self.sends)), ack):
+            covered_length = self.lengths.get(covered, 0)
+            self.in_flight -= covered_length
+            self.counts["acked_bytes"] += covered_length
+        self.acked = ack
+        extra = {}
+        # Karn's algorithm: the ACK of a retransmitted segment could be for any of its copies
+        if self.sends.get(ack - 1) == 1:
+            rtt = at - self.sent_at[ack - 1]
+            self.rtts.append(rtt)
+            extra["rtt"] = round(rtt, 6)
+        self.event(at, "ack", seq, ack, length, **extra)
+
+    def on_data(self, at: float, seq: int, ack: int, flags: int, length: int):
+        if is_parity(flags, seq):
+            self.counts["parity"] += 1
+            self.event(at, "parity", seq, ack, length)
+            return
+        self.receiving = True
+        if seq in self.received:
+            self.counts["duplicates"] += 1
+            name = "duplicate"
+        else:
+            self.received.add(seq)
+            self.counts["received_data"] += 1
+            name = "out_of_order" if self.expected is not None and seq != self.expected else "receive"
+            if name == "out_of_order":
+                self.counts["out_of_order"] += 1
+        if self.expected is None or seq == self.expected:
+            self.expected = seq + 1
+            while self.expected in self.received:
+                self.expected += 1
+        self.event(at, name, seq, ack, length)
+
+    def summary(self) -> dict:
+        duration = (self.last - self.first) if self.first is not None else 0.0
+        result = {"peer": self.name, "start": round(self.first or 0.0, 6), "duration": round(duration, 6)}
+        result.update(self.counts)
+        result.update({
+            "rtt_samples": len(self.rtts),
+            "rtt_min": round(min(self.rtts), 6) if self.rtts else None,
+            "rtt_mean": round(sum(self.rtts) / len(self.rtts), 6) if self.rtts else None,
+            "rtt_max": round(max(self.rtts), 6) if self.rtts else None,
+            "in_flight_max": self.in_flight_max,
+            "goodput": round(self.counts["acked_bytes"] / duration, 1) if duration else 0.0,
+            "stalls": len(self.stalls),
+            "stall_longest": round(max(self.stalls), 6) if self.stalls else 0.0,
+            "stall_total": round(sum(self.stalls), 6),
+        })
+        return result
+
+
+def analyze(path: str, stall: float = TRACE_STALL, series=None) -> List[dict]:
+    """
+    Analyze the trace at path.
+    :param stall: the seconds without any datagram that count as a stall
+    :param series: the file every event is written to as a JSON line, None for no series
+    :return: the summary of every peer, in the order they were first seen
+    """
+    _, peers, records = read_trace(path)
+    analyses: Dict[int, PeerAnalysis] = {}
+    for at, kind, peer, seq, ack, flags, length, valid in records:
+        analysis = analyses.get(peer)
+        if analysis is None:
+            analysis = analyses[peer] = PeerAnalysis(peers.get(peer, str(peer)), stall, series)
+        analysis.add(at, kind, seq, ack, flags, length, valid)
+    return [analyses[peer].summary() for peer in sorted(analyses)]
+
+
+def print_summary(result: dict):
+    print(f"[ TRACE ] {result['peer']} for {result['duration']:.3f} s: "
+          f"{result['sent']} datagrams sent, {result['received']} received, "
+          f"{result['dropped']} dropped on purpose, {result['invalid']} with a bad checksum")
+    if result["data_segments"]:
+        rtt = (f"RTT {result['rtt_min'] * 1000:.2f}/{result['rtt_mean'] * 1000:.2f}/{result['rtt_max'] * 1000:.2f} ms "
+               f"(min/mean/max) over {result['rtt_samples']} samples" if result["rtt_samples"] else "no RTT sample")
+        print(f"[ TRACE ]   sent {result['data_segments']} data segments ({result['data_bytes']} bytes), "
+              f"{result['retransmits']} retransmits, {result['parity']} parity, {result['dup_acks']} duplicate ACKs, "
+              f"{rtt}, up to {result['in_flight_max']} bytes in flight, goodput {result['goodput']:.0f} B/s")
+    if result["received_data"]:
+        print(f"[ TRACE ]   received {result['received_data']} data segments, {result['duplicates']} duplicates, "
+              f"{result['out_of_order']} out of order")
+    if result["stalls"]:
+        print(f"[ TRACE ]   {result['stalls']} stalls, {result['stall_total']:.3f} s in total, "
+              f"the longest {result['stall_longest']:.3f} s")
+
+
+def main():
+    args = parse_analyze_args()
+    series = None
+    if args.series:
+        series = sys.stdout if args.series == "-" else open(args.series, "w")
+    try:
+        results = analyze(args.trace, args.stall, series)
+    except (OSError, ValueError) as exc:
+        print(f"[ ERROR ] {exc}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if series is not None and series is not sys.stdout:
+            series.close()
+    for result in results:
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print_summary(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,435 @@
+"""
+benchmark.py is the loopback benchmark of the file transfer application.
+It runs the server and client on 127.0.0.1, as subprocesses or in-process, for every
+combination of the given file sizes, segment sizes, window sizes and loss rates, and
+reports the throughput, time to first byte, CPU time and peak RSS of each run.
+It also times crc16 and the Segment encoding and decoding on their own.
+
+With --via-proxy, or when a delay or another impairment is given, the client connects
+through the impairment proxy of proxy.py, which then applies the loss rate instead of
+the Connection objects. --transports compares the transports of lib/transport.py: UDP over
+IPv4 or IPv6, AF_UNIX datagram sockets, and with --mode in-process, in-process queues.
+The proxy only runs with UDP over IPv4.
+
+Every result is written as one JSON line, so a previous output can be given to
+--compare to catch regressions.
+Usage: python3 benchmark.py [--mode {subprocess,in-process}] [--output results.jsonl]
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+from lib.constants import DEFAULT_IP, HEADER_SIZE, QUEUE_SCHEME, UNIX_SCHEME
+from lib.crc16 import crc16
+from lib.parser import parse_args
+from lib.segment import Segment
+from lib.transport import UnixTransport, transport_class
+from md5sum import compare_files
+from proxy import ImpairmentProxy
+from lib.impairment import Impairment
+
+RUN_TIMEOUT = 120
+BIND_TIMEOUT = 30
+# Metrics where a higher value is better, every other compared metric is better lower
+HIGHER_IS_BETTER = ["throughput_bytes_per_second", "ops_per_second"]
+# Host of the server and client on every transport compared
+TRANSPORTS = {
+    "udp": DEFAULT_IP,
+    "udp6": "::1",
+    "unix": f"{UNIX_SCHEME}{tempfile.gettempdir()}/tcpudp-bench-{os.getpid()}",
+    "mem": f"{QUEUE_SCHEME}bench",
+}
+COMPARED_METRICS = ["throughput_bytes_per_second", "first_byte_seconds", "cpu_seconds", "ops_per_second"]
+
+
+def parse_bench_args():
+    """Parse the argument when running the benchmark"""
+    parser = argparse.ArgumentParser(
+        description="Loopback throughput and latency benchmark of the file transfer application"
+    )
+    parser.add_argument("--mode", choices=["subprocess", "in-process"], default="subprocess",
+                        help="Run the server and client as subprocesses or as threads of this process")
+    parser.add_argument("--transports", choices=list(TRANSPORTS), nargs="+", default=["udp"],
+                        help="The transports to compare, mem needs --mode in-process")
+    parser.add_argument("--file-sizes", type=int, nargs="+", default=[8192, 32768],
+                        help="The sizes of the transferred files in bytes")
+    parser.add_argument("--segment-sizes", type=int, nargs="+", default=[1024, 4096],
+                        help="The segment sizes to use, header included")
+    parser.add_argument("--window-sizes", type=int, nargs="+", default=[1, 3],
+                        help="The window sizes to use")
+    parser.add_argument("--loss-rates", type=float, nargs="+", default=[0.0],
+                        help="The fraction of the datagrams dropped on both sides")
+    parser.add_argument("--delays", type=float, nargs="+", default=[0.0],
+                        help="The one-way delays added by the impairment proxy in milliseconds")
+    parser.add_argument("--via-proxy", action="store_true",
+                        help="Connect through the impairment proxy even without impairments")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="The delay variation added by the proxy in milliseconds")
+    parser.add_argument("--reorder", type=float, default=0.0,
+                        help="The probability of the proxy reordering a datagram")
+    parser.add_argument("--duplicate", type=float, default=0.0,
+                        help="The probability of the proxy duplicating a datagram")
+    parser.add_argument("--corrupt", type=float, default=0.0,
+                        help="The probability of the proxy corrupting a datagram")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="The rate limit of the proxy in bytes per second, 0 for no limit")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="How many times every combination is run")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="The seed of the file contents and the datagram drops")
+    parser.add_argument("--no-micro", action="store_true",
+                        help="Skip the crc16 and Segment micro benchmarks")
+    parser.add_argument("--output", type=str, default="-",
+                        help="The JSON lines file to write the results to, - for stdout")
+    parser.add_argument("--compare", type=str,
+                        help="A previous output to compare the results against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="The relative slowdown reported as a regression")
+    return parser.parse_args()
+
+
+def free_port() -> int:
+    """Get a UDP port that is currently free on the loopback address"""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind((DEFAULT_IP, 0))
+        return sock.getsockname()[1]
+
+
+def is_bound(host: str, port: int) -> bool:
+    """Whether an endpoint is bound at host and port"""
+    transport = transport_class(host)
+    if transport is UnixTransport:
+        return os.path.exists(UnixTransport.native((host, port)))
+    with socket.socket(transport.family, socket.SOCK_DGRAM) as sock:
+        try:
+            sock.bind(transport.native((host, port)))
+        except OSError:
+            return True
+    return False
+
+
+def wait_for_bind(host: str, port: int, proc: subprocess.Popen):
+    """Wait until the server process bound its port, so the connection request is not lost"""
+    deadline = time.monotonic() + BIND_TIMEOUT
+    while time.monotonic() < deadline and proc.poll() is None:
+        if is_bound(host, port):
+            return
+        time.sleep(0.01)
+    raise RuntimeError(f"Server did not bind port {port}")
+
+
+def make_input_file(size: int, seed: int) -> str:
+    """Create the file to transfer in sent_file/ and return its name"""
+    name = f"bench_{size}_{seed}.bin"
+    path = f"sent_file/{name}"
+    if not os.path.exists(path) or os.path.getsize(path) != size:
+        with open(path, "wb") as file:
+            file.write(random.Random(seed).randbytes(size))
+    return name
+
+
+def case_argv(case: dict, ports: dict, name: str, metrics_path: str):
+    """Build the server and client arguments of a benchmark case"""
+    # The proxy drops the datagrams itself when there is one
+    loss_rate = 0.0 if case["proxy"] else case["loss_rate"]
+    host = TRANSPORTS[case["transport"]]
+    # Both sides get their own seed so they do not drop the same datagrams
+    server_argv = [
+        str(ports["server"]), name, host, "--clients", "1", "-q",
+        "--segment-size", str(case["segment_size"]), "--window-size", str(case["window_size"]),
+        "--loss-rate", str(loss_rate), "--seed", str(2 * case["seed"]),
+    ]
+    client_argv = [
+        str(ports["client"]), str(ports["connect"]), name, host, host, "-q",
+        "--metrics-out", metrics_path,
+        "--loss-rate", str(loss_rate), "--seed", str(2 * case["seed"] + 1),
+    ]
+    return server_argv, client_argv
+
+
+def start_proxy(case: dict, ports: dict):
+    """Start the impairment proxy of a case in a thread, returning the proxy and the thread"""
+    def impairment(direction: str) -> Impairment:
+        return Impairment(
+            loss=case["loss_rate"],
+            delay=case["delay"] / 1000,
+            jitter=case["proxy"]["jitter"] / 1000,
+            reorder=case["proxy"]["reorder"],
+            reorder_delay=max(case["delay"], 10) / 1000,
+            duplicate=case["proxy"]["duplicate"],
+            corrupt=case["proxy"]["corrupt"],
+            rate=case["proxy"]["rate"],
+            seed=f"{case['seed']}/{direction}",
+        )
+
+    proxy = ImpairmentProxy(DEFAULT_IP, ports["connect"], DEFAULT_IP, ports["server"],
+                            impairment("to-server"), impairment("to-client"))
+    thread = threading.Thread(target=proxy.serve_forever, daemon=True)
+    thread.start()
+    return proxy, thread
+
+
+def wait_process(proc: subprocess.Popen, deadline: float):
+    """Wait for proc to exit and return its resource usage, killing it past the deadline"""
+    while True:
+        pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+        if pid != 0:
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            return usage
+        if time.monotonic() > deadline:
+            proc.kill()
+        time.sleep(0.005)
+
+
+def run_subprocess(case: dict, ports: dict, name: str) -> dict:
+    """Run one transfer with the server and client as subprocesses"""
+    with tempfile.TemporaryDirectory() as tmp:
+        metrics_path = os.path.join(tmp, "client.json")
+        server_argv, client_argv = case_argv(case, ports, name, metrics_path)
+        deadline = time.monotonic() + RUN_TIMEOUT
+        server = subprocess.Popen([sys.executable, "server.py"] + server_argv,
+                                  stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+        wait_for_bind(TRANSPORTS[case["transport"]], ports["server"], server)
+        start = time.monotonic()
+        client = subprocess.Popen([sys.executable, "client.py"] + client_argv,
+                                  stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+        client_usage = wait_process(client, deadline)
+        wall = time.monotonic() - start
+        server_usage = wait_process(server, deadline)
+        metrics = {}
+        if os.path.exists(metrics_path):
+            with open(metrics_path) as file:
+                metrics = json.load(file)[0]["metrics"]
+
+    return {
+        "wall_seconds": wall,
+        "metrics": metrics,
+        "cpu_seconds": sum(usage.ru_utime + usage.ru_stime for usage in [server_usage, client_usage]),
+        "server_peak_rss_kb": server_usage.ru_maxrss,
+        "client_peak_rss_kb": client_usage.ru_maxrss,
+        "ok": server.returncode == 0 and client.returncode == 0,
+    }
+
+
+def run_in_process(case: dict, ports: dict, name: str) -> dict:
+    """Run one transfer with the server and client as threads of this process"""
+    # Imported here so the subprocess mode does not depend on the entry modules
+    from server import Server
+    from client import Client
+
+    server_argv, client_argv = case_argv(case, ports, name, os.devnull)
+    client_args = parse_args(False, client_argv)
+    client_args.metrics_out = None
+    cpu_start = time.process_time()
+    start = time.monotonic()
+
+    server = Server(parse_args(True, server_argv))
+    errors = []
+
+    def serve():
+        try:
+            server.split_file()
+            server.listen_for_clients()
+            server.initiate_transfer()
+        except Exception as exc:  # pylint: disable=broad-except
+            errors.append(exc)
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    client = Client(client_args)
+    # Closing the sockets makes a stuck transfer fail instead of hanging the benchmark
+    watchdog = threading.Timer(RUN_TIMEOUT, lambda: (client.conn.close(), server.conn.close()))
+    watchdog.start()
+    try:
+        client.connect()
+        client.three_way_handshake()
+        client.listen_file_transfer()
+    except OSError as exc:
+        errors.append(exc)
+    client.shutdown()
+    wall = time.monotonic() - start
+    thread.join(RUN_TIMEOUT)
+    watchdog.cancel()
+    server.conn.close()
+
+    return {
+        "wall_seconds": wall,
+        "metrics": client.metrics.snapshot()["metrics"],
+        "cpu_seconds": time.process_time() - cpu_start,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "ok": not errors and not thread.is_alive(),
+    }
+
+
+def run_transfer(case: dict, mode: str) -> dict:
+    """Run one transfer benchmark case and summarize it as a result"""
+    name = make_input_file(case["file_size"], case["seed"])
+    received = f"received_file/{name}"
+    if os.path.exists(received):
+        os.remove(received)
+
+    ports = {"server": free_port(), "client": free_port()}
+    ports["connect"] = free_port() if case["proxy"] else ports["server"]
+    proxy = start_proxy(case, ports) if case["proxy"] else None
+    try:
+        if mode == "subprocess":
+            run = run_subprocess(case, ports, name)
+        else:
+            run = run_in_process(case, ports, name)
+    finally:
+        if proxy is not None:
+            proxy[0].stop()
+            proxy[1].join()
+            proxy[0].close()
+    metrics = run.pop("metrics")
+    result = {"kind": "transfer", "mode": mode, **case, **run}
+    result["ok"] = result["ok"] and os.path.exists(received) and compare_files(f"sent_file/{name}", received)
+    result["first_byte_seconds"] = metrics.get("first_byte_seconds", 0)
+    result["transfer_seconds"] = metrics.get("transfer_seconds", 0)
+    result["throughput_bytes_per_second"] = case["file_size"] / run["wall_seconds"]
+    result["goodput_bytes_per_second"] = metrics.get("goodput_bytes_per_second", 0)
+    result["retransmits"] = metrics.get("retransmits_total", 0)
+    result["timeouts"] = metrics.get("timeouts_total", 0)
+    if os.path.exists(received):
+        os.remove(received)
+    return result
+
+
+def run_micro(segment_sizes: list):
+    """Time crc16 and the Segment encoding and decoding for every segment size"""
+    for size in segment_sizes:
+        payload = random.Random(size).randbytes(size - HEADER_SIZE)
+        segment = Segment()
+        segment.set_header({"seq": 3, "ack": 3})
+        segment.set_payload(payload)
+        encoded = segment.to_bytes()
+        benchmarks = {
+            "crc16": lambda: crc16(payload),
+            "segment_to_bytes": segment.to_bytes,
+            "segment_from_bytes": lambda: Segment.from_bytes(encoded),
+            "segment_is_valid": Segment.from_bytes(encoded).is_valid,
+        }
+        for name, func in benchmarks.items():
+            number, elapsed = timeit.Timer(func).autorange()
+            yield {
+                "kind": "micro",
+                "name": name,
+                "segment_size": size,
+                "ops_per_second": number / elapsed,
+                "bytes_per_second": number * len(payload) / elapsed,
+            }
+
+
+def result_key(result: dict) -> tuple:
+    """The fields identifying the benchmark of a result, for comparing runs"""
+    if result["kind"] == "micro":
+        return ("micro", result["name"], result["segment_size"])
+    return ("transfer", result["mode"], result.get("transport", "udp"), result["file_size"], result["segment_size"],
+            result["window_size"], result["loss_rate"], result.get("delay", 0.0),
+            json.dumps(result.get("proxy"), sort_keys=True))
+
+
+def find_regressions(results: list, baseline_path: str, tolerance: float) -> list:
+    """Compare results with the averaged results in baseline_path, listing the regressions"""
+    baseline = {}
+    with open(baseline_path) as file:
+        for line in file:
+            if line.strip():
+                previous = json.loads(line)
+                baseline.setdefault(result_key(previous), []).append(previous)
+
+    regressions = []
+    for result in results:
+        previous = baseline.get(result_key(result))
+        if not previous:
+            continue
+        for metric in COMPARED_METRICS:
+            if metric not in result:
+                continue
+            old = sum(entry[metric] for entry in previous) / len(previous)
+            new = result[metric]
+            if old <= 0:
+                continue
+            if metric in HIGHER_IS_BETTER:
+                change = (old - new) / old
+            else:
+                change = (new - old) / old
+            if change > tolerance:
+                regressions.append(f"{result_key(result)} {metric}: {old:.6g} -> {new:.6g}")
+    return regressions
+
+
+def main():
+    args = parse_bench_args()
+    output = sys.stdout if args.output == "-" else open(args.output, "w")
+    results = []
+
+    def emit(result):
+        results.append(result)
+        output.write(json.dumps(result) + "\n")
+        output.flush()
+
+    if not args.no_micro:
+        for result in run_micro(args.segment_sizes):
+            print(f"[ BENCH ] {result['name']} segment_size={result['segment_size']}: "
+                  f"{result['ops_per_second']:.1f} ops/s", file=sys.stderr)
+            emit(result)
+
+    impairments = {
+        "jitter": args.jitter, "reorder": args.reorder, "duplicate": args.duplicate,
+        "corrupt": args.corrupt, "rate": args.rate,
+    }
+    if "mem" in args.transports and args.mode != "in-process":
+        print("[ ERROR ] The mem transport only connects threads of one process, use --mode in-process",
+              file=sys.stderr)
+        sys.exit(1)
+    combinations = itertools.product(
+        args.transports, args.file_sizes, args.segment_sizes, args.window_sizes, args.loss_rates, args.delays,
+        range(args.repeat)
+    )
+    for transport, file_size, segment_size, window_size, loss_rate, delay, repeat in combinations:
+        use_proxy = args.via_proxy or delay > 0 or any(impairments.values())
+        if use_proxy and transport != "udp":
+            print(f"[ WARNING ] Skipping the {transport} transport, the proxy only runs with udp", file=sys.stderr)
+            continue
+        case = {
+            "transport": transport,
+            "file_size": file_size,
+            "segment_size": segment_size,
+            "window_size": window_size,
+            "loss_rate": loss_rate,
+            "delay": delay,
+            "proxy": impairments if use_proxy else None,
+            "seed": args.seed + repeat,
+        }
+        result = run_transfer(case, args.mode)
+        print(f"[ BENCH ] transport={transport} file={file_size} segment={segment_size} window={window_size} "
+              f"loss={loss_rate} delay={delay}: {result['throughput_bytes_per_second']:.0f} B/s, "
+              f"first byte {result['first_byte_seconds']:.3f} s, ok={result['ok']}", file=sys.stderr)
+        emit(result)
+
+    if output is not sys.stdout:
+        output.close()
+    shutil.rmtree(TRANSPORTS["unix"][len(UNIX_SCHEME):], ignore_errors=True)
+
+    failed = [result for result in results if result.get("ok") is False]
+    regressions = find_regressions(results, args.compare, args.tolerance) if args.compare else []
+    for regression in regressions:
+        print(f"[ REGRESSION ] {regression}", file=sys.stderr)
+    if failed:
+        print(f"[ ERROR ] {len(failed)} transfer(s) did not complete correctly", file=sys.stderr)
+    sys.exit(1 if failed or regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
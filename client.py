@@ -1,14 +1,36 @@
 """
 The module for the client class of the file transfer application using UDP
 """
+import copy
+import os
+import struct
 import sys
-import time
 from typing import Tuple
 from socket import timeout
 from lib.parser import parse_args
+from lib.logger import get_logger, configure_logging, Summary, SUCCESS
+from lib.metrics import ConnectionMetrics, install_exporter
 from lib.connection import Connection
-from lib.segment import Segment
-from lib.constants import ACK_FLAG, SYN_ACK_FLAG, SYN_FLAG, DEFAULT_IP, FIN_FLAG, TIMEOUT_LISTEN, FIN_ACK_FLAG
+from lib.clock import SystemClock
+from lib.profiler import PROFILER
+from lib.trace import TraceRecorder
+from lib.transport import canonical_host, default_host
+from lib.segment import Segment, SegmentTemplate
+from lib.manifest import ManifestWriter
+from lib.write_behind import WriteBehindFile
+from lib.timer_wheel import TimerWheel
+from lib.fec import FecReceiver
+from lib.multi_source import MultiSourceFetch
+from lib.constants import (
+    ACK_REPORT_FORMAT, CAPABILITIES, CAPABILITY_ACK_REPORT, CAPABILITY_FEC, OPTION_CAPABILITIES,
+    OPTION_FEC_GROUP, OPTION_SOCKET_DROPS, OPTION_RECEIVE_WINDOW, OPTION_SYN_COOKIE, OPTION_RANGE,
+    OPTION_DIGEST, WINDOW_UPDATE_INTERVAL, CONNECT_FAST_OPEN, METADATA_SEQ, TIMEOUT, SESSION_KEEPALIVE_INTERVAL,
+    SESSION_KEEPALIVE_MISSES, CONNECT_FLAG, ACK_FLAG, SYN_ACK_FLAG, SYN_FLAG, DEFAULT_IP, FIN_FLAG,
+    TIMEOUT_LISTEN, FIN_ACK_FLAG
+)
+import logging
+
+LOG = get_logger("client")
 
 
 class Client:
@@ -20,55 +42,219 @@ class Client:
     3. Sends the acknowledgement to the server
     """
 
-    def __init__(self):
-        client_port, broadcast_port, output_file, server_ip, client_ip = parse_args(
-            False)
+    def __init__(self, args=None, conn=None, clock=None, file=None):
+        """
+        Create the client from the command line arguments, or from args when given.
+        conn, clock and file replace the UDP connection, the system clock and the output
+        file, which is how the simulator runs the client.
+        """
+        if args is None:
+            args = parse_args(False)
+        configure_logging(args.log_level)
+        client_port, broadcast_port, output_file, server_ip, client_ip = (
+            args.client_port, args.broadcast_port, args.path_file, args.server_ip, args.client_ip
+        )
         if server_ip is None:
             server_ip = DEFAULT_IP
+        # The server answers from the address its datagrams come from, in the form the socket gives it
+        server_ip = canonical_host(server_ip)
         if client_ip is None:
-            client_ip = DEFAULT_IP
+            client_ip = default_host(server_ip)
         self.server_ip = server_ip
         self.client_port = client_port
         self.broadcast_port = broadcast_port
-        self.output_file = output_file.split("/")[-1]
-        self.file = self.create_file()
-        self.conn = Connection(
-            ip=client_ip,
-            port=self.client_port,
-            broadcast=self.broadcast_port,
-            as_server=False
-        )
+        self.output_file = output_file
+        self.output_path = output_path(output_file)
+        self.owns_file = file is None
+        self.session_files = args.session
+        self.pause = args.pause
+        self.fast_open = args.fast_open
+        self.receive_buffer = args.receive_buffer
+        # Last receive window sent to the server, None when no window is advertised
+        self.advertised_window = None
+        # Whether the metadata of the next file came with the SYN of a fast open
+        self.early_metadata = False
+        # Capabilities both sides have, agreed on during the handshake
+        self.peer_capabilities = 0
+        self.fec_limit = max(args.fec, 0)
+        self.capabilities = CAPABILITIES if self.fec_limit else CAPABILITIES & ~CAPABILITY_FEC
+        # FEC group size agreed with the server, 0 without FEC
+        self.fec_group = 0
+        # Offset and length of the part of the file to ask for, None for the whole file
+        self.byte_range = None
+        # Size and digest of the file announced by the metadata, None until it arrives; the digest
+        # only comes with a range. on_metadata is called with them, and whether it is a directory.
+        self.file_size = None
+        self.digest = None
+        self.on_metadata = None
+        if args.profile or args.cprofile:
+            PROFILER.enable(args.profile_out, args.cprofile)
+        # The output file is created once the metadata of the file is received
+        self.file = None if file is None else PROFILER.wrap_file(file)
+        if conn is None:
+            conn = Connection(
+                ip=client_ip,
+                port=self.client_port,
+                broadcast=self.broadcast_port,
+                as_server=False,
+                loss_rate=args.loss_rate,
+                seed=args.seed,
+                rcvbuf=args.rcvbuf,
+                sndbuf=args.sndbuf,
+                trace=TraceRecorder(args.trace, args.trace_ring) if args.trace else None
+            )
+        self.conn = conn
+        self.clock = SystemClock() if clock is None else clock
+        # Idle, window update and keepalive deadlines, waited for together with the segments
+        self.timers = TimerWheel(self.clock)
+        # Segment the received datagrams are parsed into, and the encoded ACKs by their options
         self.segment = Segment()
+        self.ack_templates = {}
+        self.metrics = ConnectionMetrics(self.clock.monotonic, role="client",
+                                         peer=f"{self.server_ip}:{self.broadcast_port}")
+        self.connect_time = self.clock.monotonic()
+        if args.metrics_out:
+            install_exporter(lambda: [self.metrics], args.metrics_out, args.metrics_format)
 
     def create_file(self):
-        """Create the output file"""
-        try:
-            file = open(f"received_file/{self.output_file}", "wb")
+        """
+        Create the output file, and the directories of its relative path
+        :raise OSError: when the output cannot be written, like a directory received before
+        """
+        os.makedirs(os.path.dirname(self.output_path), exist_ok=True)
+        return open(self.output_path, "wb")
+
+    def wrap_output(self, file):
+        """Write to file from a background thread holding up to the receive buffer, so a slow disk does not stall the receiver"""
+        if file is None:
+            return None
+        file = PROFILER.wrap_file(file)
+        if self.receive_buffer <= 0:
             return file
-        except FileNotFoundError:
-            print(f"[!] {self.output_file} doesn't exists. Client exiting...")
-            sys.exit(1)
+        return WriteBehindFile(file, self.receive_buffer)
+
+    def receive_window(self) -> int:
+        """Bytes the server can send beyond the last acknowledged segment"""
+        return max(self.receive_buffer - getattr(self.file, "backlog", 0), 0)
 
     def close_file(self):
         """Close the output file"""
-        self.file.close()
+        if self.file is not None:
+            self.file.close()
+
+    def receive_metadata(self, payload: bytes, server_address: Tuple[str, str], digest=None):
+        """
+        Prepare the output for the file described by the metadata payload
+        :param digest: the digest of the whole file sent with the metadata of a range
+        """
+        metadata = payload.decode().split(",")
+        LOG.info("[Server %s:%s] Received Filename: %s, File Extension: %s, File Size: %s",
+                 server_address[0], server_address[1], metadata[0], metadata[1], metadata[2])
+        self.file_size = int(metadata[2])
+        self.digest = None if digest is None else bytes(digest)
+        if self.on_metadata is not None:
+            self.on_metadata(self.file_size, self.digest, len(metadata) > 3)
+        # A directory also announces the size of its manifest
+        if len(metadata) > 3:
+            self.receive_directory(int(metadata[3]))
+        elif self.owns_file and self.file is None:
+            self.file = self.wrap_output(self.create_file())
+
+    def receive_directory(self, manifest_size: int):
+        """Write the directory stream announced by the metadata into the output path, as a directory"""
+        self.file = self.wrap_output(ManifestWriter(self.output_path, manifest_size))
 
     def connect(self):
-        """Connect"""
+        """Connect, asking for the file named like the output file"""
+        self.connect_time = self.clock.monotonic()
+        self.peer_capabilities = 0
+        self.fec_group = 0
+        self.file_size = self.digest = None
+        self.segment.set_payload(self.output_file.encode())
+        self.set_range(self.segment)
+        if self.fast_open:
+            self.segment.set_header({"seq": 0, "ack": CONNECT_FAST_OPEN})
         self.conn.send(
             self.segment.to_bytes(), self.server_ip, self.conn.broadcast_port
         )
 
+    def set_range(self, request: Segment):
+        """Ask for the byte range of the client in request, or for the whole file without one"""
+        if self.byte_range is None:
+            request.options.pop(OPTION_RANGE, None)
+        else:
+            request.set_range_option(OPTION_RANGE, *self.byte_range)
+
+    def ack_template(self, options: tuple) -> SegmentTemplate:
+        """Get the encoded ACK carrying the given integer options, built on first use"""
+        template = self.ack_templates.get(options)
+        if template is None:
+            template = self.ack_templates[options] = SegmentTemplate(["ACK"], options)
+        return template
+
     def acknowledge(self, seq_number: int, server_address: Tuple[str, str]):
         """Send acknowledge to the server"""
+        # Report the datagrams the kernel dropped and the receive window, so the server can slow down
+        drops = self.conn.kernel_drops()
+        if drops is not None:
+            self.metrics.socket_drops.set(drops)
+        if self.receive_buffer > 0:
+            self.advertised_window = self.receive_window()
+            self.metrics.receive_window.set(self.advertised_window)
+        if self.peer_capabilities & CAPABILITY_ACK_REPORT:
+            if drops is not None and self.advertised_window is not None:
+                data = self.ack_template((OPTION_SOCKET_DROPS, OPTION_RECEIVE_WINDOW)).encode(
+                    seq_number, seq_number + 1, drops, self.advertised_window)
+            elif drops is not None:
+                data = self.ack_template((OPTION_SOCKET_DROPS,)).encode(seq_number, seq_number + 1, drops)
+            elif self.advertised_window is not None:
+                data = self.ack_template((OPTION_RECEIVE_WINDOW,)).encode(
+                    seq_number, seq_number + 1, self.advertised_window)
+            else:
+                data = self.ack_template(()).encode(seq_number, seq_number + 1)
+        elif self.advertised_window is not None or drops is not None:
+            # Servers without options read the report from the payload
+            response = Segment()
+            response.set_flag(["ACK"])
+            response.set_header({"seq": seq_number, "ack": seq_number + 1})
+            if self.advertised_window is not None:
+                response.set_payload(struct.pack(ACK_REPORT_FORMAT, drops or 0, self.advertised_window))
+            else:
+                response.set_payload(struct.pack("I", drops))
+            data = response.to_bytes()
+        else:
+            data = self.ack_template(()).encode(seq_number, seq_number + 1)
+        self.conn.send(data, server_address[0], server_address[1])
+        self.metrics.segments_sent.inc()
+
+    def syn_ack(self, syn: Segment) -> Segment:
+        """
+        Build the SYN-ACK answering syn. A server that understands options offered its
+        capabilities in the SYN, the client answers with its own and keeps the common ones.
+        A server offering FEC gets the group size the client takes, at most the one offered.
+        A server answering with a SYN cookie keeps no state, the client names its file again.
+        """
+        self.peer_capabilities = 0
+        self.fec_group = 0
+        if syn.version >= 1:
+            offered = syn.get_int_option(OPTION_CAPABILITIES)
+            self.peer_capabilities = self.capabilities & offered if offered is not None else 0
+        group = syn.get_int_option(OPTION_FEC_GROUP)
+        if self.peer_capabilities & CAPABILITY_FEC and group:
+            self.fec_group = min(group, self.fec_limit)
+        else:
+            self.peer_capabilities &= ~CAPABILITY_FEC
         response = Segment()
-        response.set_flag(["ACK"])
-        response_header = response.get_header()
-        response_header["seq"] = seq_number
-        response_header["ack"] = seq_number + 1
-        response.set_header(response_header)
-        self.conn.send(response.to_bytes(),
-                       server_address[0], server_address[1])
+        response.set_flag(["SYN", "ACK"])
+        response.set_header({"seq": 0, "ack": syn.get_header()["seq"] + 1})
+        if syn.version >= 1:
+            response.set_int_option(OPTION_CAPABILITIES, self.capabilities)
+            if self.fec_group:
+                response.set_int_option(OPTION_FEC_GROUP, self.fec_group)
+            if syn.get_int_option(OPTION_SYN_COOKIE):
+                response.set_payload(self.output_file.encode())
+                self.set_range(response)
+        return response
 
     def three_way_handshake(self):
         """
@@ -76,159 +262,336 @@ class Client:
         1. Send SYN to server
         2. Receive SYN-ACK from server
         3. Send ACK to server
+        A server answering a fast open sends the metadata with its SYN, and the data
+        right after it: the SYN-ACK acknowledges the metadata and ends the handshake.
         """
+        request = self.segment.to_bytes()
+        syn_received = False
+        # Whether the SYN carried a cookie, the server does not send it again
+        cookie = False
         while True:
             server_addr = (self.server_ip, self.broadcast_port)
             try:
                 data, server_addr = self.conn.listen_segment()
-                self.segment = Segment.from_bytes(data)
+                self.segment.parse(data)
+                self.metrics.segments_received.inc()
 
-                if self.segment.get_flag() == SYN_FLAG:
-                    self.segment.set_flag(["SYN", "ACK"])
-                    header = self.segment.get_header()
-                    header["ack"] = header["seq"] + 1
-                    header["seq"] = 0
-                    self.segment.set_header(header)
-                    print(
-                        f"[ INFO ] [Server {server_addr[0]}:{server_addr[1]}] received SYN from client"
-                    )
+                if (self.segment.get_flag() == SYN_FLAG and self.segment.get_header()["seq"] == METADATA_SEQ
+                        and self.segment.get_payload()):
+                    if not self.segment.is_valid():
+                        continue
+                    LOG.info("[Server %s:%s] received SYN with the metadata, fast open", *server_addr)
+                    self.receive_metadata(self.segment.get_payload(), server_addr,
+                                          self.segment.get_option(OPTION_DIGEST))
+                    self.early_metadata = True
+                    self.segment = self.syn_ack(self.segment)
+                    self.conn.send(self.segment.to_bytes(), *server_addr)
+                    self.metrics.segments_sent.inc()
+                    LOG.info("[Server %s:%s] Three-way handshake established", *server_addr)
+                    self.metrics.handshake_time.set(self.clock.monotonic() - self.connect_time)
+                    break
+
+                elif not syn_received and self.segment.get_flag() != SYN_FLAG:
+                    # Data of a fast open whose SYN was lost, it is sent again after the SYN
+                    continue
+
+                elif self.segment.get_flag() == SYN_FLAG:
+                    syn_received = True
+                    cookie = self.segment.version >= 1 and bool(self.segment.get_int_option(OPTION_SYN_COOKIE))
+                    self.segment = self.syn_ack(self.segment)
+                    LOG.info("[Server %s:%s] received SYN from client", *server_addr)
                     self.conn.send(self.segment.to_bytes(), *server_addr)
+                    self.metrics.segments_sent.inc()
 
                 elif self.segment.get_flag() == SYN_ACK_FLAG:
-                    print(
-                        f"[ INFO ] [Server {server_addr[0]}:{server_addr[1]}] sent SYN-ACK to client"
-                    )
+                    LOG.info("[Server %s:%s] sent SYN-ACK to client", *server_addr)
                     self.conn.send(self.segment.to_bytes(), *server_addr)
+                    self.metrics.segments_sent.inc()
+                    self.metrics.handshake_retries.inc()
 
                 elif self.segment.get_flag() == ACK_FLAG:
-                    print(
-                        f"[ INFO ] [Server {server_addr[0]}:{server_addr[1]}] received ACK from client"
-                    )
-                    print(
-                        f"[ INFO ] [Server {server_addr[0]}:{server_addr[1]}] Three-way handshake established"
-                    )
+                    LOG.info("[Server %s:%s] received ACK from client", *server_addr)
+                    LOG.info("[Server %s:%s] Three-way handshake established", *server_addr)
+                    self.metrics.handshake_time.set(self.clock.monotonic() - self.connect_time)
                     break
 
                 else:
-                    print(
-                        f"[ INFO ] [Server {server_addr[0]}:{server_addr[1]}] already received segment file, resetting connection"
-                    )
+                    LOG.info("[Server %s:%s] already received segment file, resetting connection", *server_addr)
                     self.segment.set_flag(["SYN", "ACK"])
                     header = self.segment.get_header()
                     header["ack"] = header["seq"] + 1
                     header["seq"] = 0
                     self.segment.set_header(header)
-                    print(
-                        f"[ INFO ] [Server {server_addr[0]}:{server_addr[1]}] sent SYN-ACK to client"
-                    )
+                    LOG.info("[Server %s:%s] sent SYN-ACK to client", *server_addr)
                     self.conn.send(self.segment.to_bytes(), *server_addr)
 
+            except struct.error:
+                continue
             except timeout:
                 if self.segment.get_flag() == SYN_FLAG:
-                    print(
-                        f"[ TIMEOUT ] [Server {server_addr[0]}:{server_addr[1]}] ACK response timeout, resending SYN"
-                    )
+                    LOG.warning("[Server %s:%s] ACK response timeout, resending SYN", *server_addr)
                     self.conn.send(self.segment.to_bytes(), *server_addr)
+                    self.metrics.handshake_retries.inc()
+
+                elif not syn_received:
+                    LOG.warning("[Server %s:%s] No SYN yet, resending connection request", *server_addr)
+                    self.conn.send(request, self.server_ip, self.conn.broadcast_port)
+                    self.metrics.handshake_retries.inc()
+
+                elif cookie:
+                    LOG.warning("[Server %s:%s] ACK response timeout, resending SYN-ACK", *server_addr)
+                    self.conn.send(self.segment.to_bytes(), *server_addr)
+                    self.metrics.handshake_retries.inc()
 
                 else:
-                    print(
-                        f"[ TIMEOUT ] [Server {server_addr[0]}:{server_addr[1]}] SYN response timeout"
-                    )
+                    LOG.warning("[Server %s:%s] SYN response timeout", *server_addr)
 
     def shutdown(self):
         """Shutdown the client"""
         self.close_file()
         self.conn.close()
 
-    def listen_file_transfer(self):
-        """Listen for file transfer attempt from server"""
+    def listen_file_transfer(self, keep_open: bool = False, request: bytes = None):
+        """
+        Listen for file transfer attempt from server
+        :param keep_open: keep the session open after the file instead of closing the connection
+        :param request: the request segment of the file, resent until its metadata arrives
+        :return: whether the file was received, False when the request was refused
+        """
         # File transfer, client-side, receive file from a server
         # SYN : 0
         # ACK : 1
         # Metadata : 2
-        metadata_seq_number = 2
-        is_metadata_received = False
+        metadata_seq_number = METADATA_SEQ
+        is_metadata_received = self.early_metadata
+        self.early_metadata = False
         seq_number = 3
+        debug = LOG.isEnabledFor(logging.DEBUG)
+        summary = Summary(LOG, f"[Server {self.server_ip}:{self.broadcast_port}] Transfer progress:")
+        metrics = self.metrics
+        start = None
+        server_address = (self.server_ip, self.broadcast_port)
+        # Timers that fired: "idle" after TIMEOUT without segments, "window" to check a closed receive window
+        expired = []
+        idle_timer = self.timers.schedule(TIMEOUT, expired.append, "idle")
+        # Runs while the last ACK left no room for another segment, of up to segment_bytes
+        window_timer = None
+        segment_bytes = 0
+        # Payloads of the current FEC group, to rebuild a lost segment from its parity
+        fec = FecReceiver(self.fec_group) if self.fec_group else None
 
         while True:
-            try:
-                data, server_address = self.conn.listen_segment()
-                if server_address[1] != self.broadcast_port:
-                    print(
-                        f"[ WARNING ] [Server {server_address[0]}:{server_address[1]}] Received Segment {self.segment.get_header()['seq']} [Wrong port]"
-                    )
-                else:
-                    self.segment = Segment.from_bytes(data)
-                    # Received data fails checksum
-                    if not self.segment.is_valid():
-                        print(
-                            f"[ WARNING ] [Server {server_address[0]}:{server_address[1]}] Received Segment {self.segment.get_header()['seq']} [Segment Corrupted]"
-                        )
-                    # Received valid metadata when metadata haven't been received
-                    elif (self.segment.get_header()["seq"] == metadata_seq_number
-                            and not is_metadata_received
-                          ):
-                        payload = self.segment.get_payload()
-                        metadata = payload.decode().split(",")
-                        print(
-                            f"[ INFO ] [Server {server_address[0]}:{server_address[1]}] Received Filename: {metadata[0]}, File Extension: {metadata[1]}, File Size: {metadata[2]}"
-                        )
-                        print(
-                            f"[ INFO ] [Server {server_address[0]}:{server_address[1]}] Sending ACK {metadata_seq_number + 1}"
-                        )
-                        self.acknowledge(self.segment.get_header()[
-                                         "seq"], server_address)
-                        # Prevent the loop from continuing, which would cause ACK to be sent twice
+            result = self.conn.listen_until(self.timers)
+            if result is None:
+                if "window" in expired:
+                    # Tell the server once the write backlog drained enough for another segment
+                    if self.receive_window() >= segment_bytes:
+                        window_timer = None
+                        self.acknowledge(seq_number - 1, server_address)
+                    else:
+                        window_timer = self.timers.schedule(WINDOW_UPDATE_INTERVAL, expired.append, "window")
+                if "idle" in expired:
+                    LOG.warning("[Server %s:%s] Received Segment %d [Timeout]",
+                                server_address[0], server_address[1], self.segment.get_header()["seq"])
+                    if request is not None and not is_metadata_received:
+                        self.conn.send(request, server_address[0], server_address[1])
+                    else:
+                        self.acknowledge(seq_number - 1 if is_metadata_received else metadata_seq_number - 1,
+                                         server_address)
+                    metrics.timeouts.inc()
+                    idle_timer = self.timers.schedule(TIMEOUT, expired.append, "idle")
+                expired.clear()
+                continue
+            data, server_address = result
+            self.timers.cancel(idle_timer)
+            idle_timer = self.timers.schedule(TIMEOUT, expired.append, "idle")
+            if server_address[1] != self.broadcast_port:
+                LOG.warning("[Server %s:%s] Received Segment %d [Wrong port]",
+                            server_address[0], server_address[1], self.segment.get_header()["seq"])
+            else:
+                try:
+                    self.segment.parse(data)
+                    valid = self.segment.is_valid()
+                except struct.error:
+                    # Shorter than a header
+                    valid = False
+                metrics.segments_received.inc()
+                # Payload of seq_number, received or rebuilt, delivered with the ones following it
+                payload = None
+                rebuilt = False
+                # Received data fails checksum
+                if not valid:
+                    if debug:
+                        LOG.debug("[Server %s:%s] Received Segment %d [Segment Corrupted]",
+                                  server_address[0], server_address[1], self.segment.get_header()["seq"])
+                    summary.count("corrupted")
+                    metrics.checksum_failures.inc()
+                # End of File, or refusal of the request when it comes instead of the metadata
+                elif (self.segment.get_flag() == FIN_ACK_FLAG
+                        and (self.segment.get_header()["seq"] == seq_number
+                             or (self.segment.get_header()["seq"] == metadata_seq_number
+                                 and not is_metadata_received))
+                      ):
+                    LOG.info("[Server %s:%s] Received FIN-ACK", *server_address)
+                    if not is_metadata_received:
+                        LOG.error("[Server %s:%s] Request for %s refused",
+                                  server_address[0], server_address[1], self.output_file)
+                    break
+                # Received valid metadata when metadata haven't been received
+                elif (self.segment.get_header()["seq"] == metadata_seq_number
+                        and not is_metadata_received
+                      ):
+                    self.receive_metadata(self.segment.get_payload(), server_address,
+                                          self.segment.get_option(OPTION_DIGEST))
+                    is_metadata_received = True
+                    LOG.info("[Server %s:%s] Sending ACK %d",
+                             server_address[0], server_address[1], metadata_seq_number + 1)
+                    self.acknowledge(self.segment.get_header()[
+                                     "seq"], server_address)
+                    # Prevent the loop from continuing, which would cause ACK to be sent twice
+                    continue
+                # Parity of a FEC group, which may rebuild the one segment of the group lost
+                elif fec is not None and self.segment.get_int_option(OPTION_FEC_GROUP) is not None:
+                    if not is_metadata_received or not fec.add_parity(seq_number, self.segment):
+                        continue
+                    payload, rebuilt = fec.take(seq_number)
+                    if payload is None:
+                        # Not acknowledged, the server expects one ACK per data segment
                         continue
-                    # Received valid data that is next in line to be received
-                    elif (self.segment.get_header()["seq"] == seq_number
-                          ):
-                        print(
-                            f"[ INFO ] [Server {server_address[0]}:{server_address[1]}] Received Segment {seq_number}"
-                        )
-                        payload = self.segment.get_payload()
+                # Received valid data that is next in line to be received
+                elif (self.segment.get_header()["seq"] == seq_number
+                        and is_metadata_received
+                      ):
+                    payload = self.segment.get_payload()
+                # Received previously received data
+                elif self.segment.get_header()["seq"] < seq_number:
+                    if debug:
+                        LOG.debug("[Server %s:%s] Received Segment %d [Duplicate]",
+                                  server_address[0], server_address[1], self.segment.get_header()["seq"])
+                    summary.count("duplicate")
+                    metrics.duplicates.inc()
+                elif self.segment.get_header()["seq"] > seq_number:
+                    if debug:
+                        LOG.debug("[Server %s:%s] Received Segment %d [Out-Of-Order]",
+                                  server_address[0], server_address[1], self.segment.get_header()["seq"])
+                    summary.count("out_of_order")
+                    metrics.out_of_order.inc()
+                    # Kept for the parity of its group, which may rebuild the missing segments before it
+                    if (fec is not None and is_metadata_received
+                            and fec.add(seq_number, self.segment.get_header()["seq"], self.segment.get_payload())):
+                        payload, rebuilt = fec.take(seq_number)
+
+                if payload is not None:
+                    while payload is not None:
+                        if rebuilt:
+                            if debug:
+                                LOG.debug("[Server %s:%s] Rebuilt Segment %d from the FEC parity",
+                                          server_address[0], server_address[1], seq_number)
+                            summary.count("rebuilt")
+                            metrics.fec_recovered.inc()
+                        elif debug:
+                            LOG.debug("[Server %s:%s] Received Segment %d",
+                                      server_address[0], server_address[1], seq_number)
                         self.file.write(payload)
-                        print(
-                            f"[ INFO ] [Server {server_address[0]}:{server_address[1]}] Sending ACK {seq_number + 1}"
-                        )
-                        self.acknowledge(seq_number, server_address)
+                        if start is None:
+                            start = self.clock.monotonic()
+                            metrics.first_byte_time.set(start - self.connect_time)
+                        metrics.bytes_received.inc(len(payload))
+                        summary.count("received")
+                        segment_bytes = max(segment_bytes, len(payload))
+                        if fec is not None:
+                            fec.add(seq_number, seq_number, payload)
+                        payload = None
                         seq_number += 1
-                        # Prevent the loop from continuing, which would cause ACK to be sent twice
-                        continue
-                    # End of File
-                    elif self.segment.get_flag() == FIN_ACK_FLAG:
-                        print(
-                            f"[ INFO ] [Server {server_address[0]}:{server_address[1]}] Received FIN-ACK"
-                        )
-                        break
-                    # Received previously received data
-                    elif self.segment.get_header()["seq"] < seq_number:
-                        print(
-                            f"[ WARNING ] [Server {server_address[0]}:{server_address[1]}] Received Segment {self.segment.get_header()['seq']} [Duplicate]"
-                        )
-                    elif self.segment.get_header()["seq"] > seq_number:
-                        print(
-                            f"[ WARNING ] [Server {server_address[0]}:{server_address[1]}] Received Segment {self.segment.get_header()['seq']} [Out-Of-Order]"
-                        )
-                    self.acknowledge(seq_number, server_address)
+                        if fec is not None:
+                            # The segments received ahead of a lost one follow it
+                            payload, rebuilt = fec.take(seq_number)
+                    if debug:
+                        LOG.debug("[Server %s:%s] Sending ACK %d",
+                                  server_address[0], server_address[1], seq_number)
+                    self.acknowledge(seq_number - 1, server_address)
+                    if self.advertised_window is not None and self.advertised_window < segment_bytes:
+                        if window_timer is None:
+                            window_timer = self.timers.schedule(WINDOW_UPDATE_INTERVAL, expired.append, "window")
+                    elif window_timer is not None:
+                        self.timers.cancel(window_timer)
+                        window_timer = None
+                    # Prevent the loop from continuing, which would cause ACK to be sent twice
+                    continue
+                # Repeat the ACK of the last segment received in order
+                self.acknowledge(seq_number - 1 if is_metadata_received else metadata_seq_number - 1,
+                                 server_address)
 
-            except timeout:
-                print(
-                    f"[ WARNING ] [Server {server_address[0]}:{server_address[1]}] Received Segment {self.segment.get_header()['seq']} [Timeout]"
-                )
-                self.acknowledge(seq_number, server_address)
-        self.closing_connection(seq_number, server_address)
+        summary.flush()
+        self.timers.cancel(idle_timer)
+        self.timers.cancel(window_timer)
+        if start is not None:
+            metrics.transfer_time.set(self.clock.monotonic() - start)
+            if metrics.transfer_time.value > 0:
+                metrics.goodput.set(metrics.bytes_received.value / metrics.transfer_time.value)
+        self.server_address = server_address
+        self.last_seq_number = seq_number
+        if not keep_open:
+            self.closing_connection(seq_number, server_address)
+        return is_metadata_received
+
+    def fetch(self, name: str, keep_open: bool = False, file=None) -> bool:
+        """
+        Ask for another file over the open session and receive it into received_file/name.
+        :param keep_open: keep the session open after the file instead of closing the connection
+        :param file: the output to write the file to instead of received_file/name
+        :return: whether the file was received, False when the request was refused
+        """
+        self.close_file()
+        self.output_file = name
+        self.output_path = output_path(name)
+        self.owns_file = file is None
+        self.file = None if file is None else PROFILER.wrap_file(file)
+        self.file_size = self.digest = None
+        request = Segment()
+        request.set_payload(name.encode())
+        self.set_range(request)
+        LOG.info("[Server %s:%s] Requesting %s", self.server_address[0], self.server_address[1], name)
+        self.conn.send(request.to_bytes(), *self.server_address)
+        return self.listen_file_transfer(keep_open, request.to_bytes())
+
+    def keepalive(self, duration: float) -> bool:
+        """
+        Keep the open session idle for duration seconds, sending keepalives the server echoes.
+        :return: whether the server still answers
+        """
+        keepalive = Segment().to_bytes()
+        answer = Segment()
+        deadline = self.clock.monotonic() + duration
+        missed = 0
+        expired = []
+        while self.clock.monotonic() < deadline:
+            self.conn.send(keepalive, *self.server_address)
+            self.timers.schedule_at(min(self.clock.monotonic() + SESSION_KEEPALIVE_INTERVAL, deadline),
+                                    expired.append, "interval")
+            answered = False
+            while not expired:
+                result = self.conn.listen_until(self.timers)
+                if result is not None:
+                    try:
+                        answered = answered or answer.parse(result[0]).get_flag() == CONNECT_FLAG
+                    except struct.error:
+                        continue
+            expired.clear()
+            missed = 0 if answered else missed + 1
+            if missed >= SESSION_KEEPALIVE_MISSES:
+                LOG.warning("[Server %s:%s] No answer to keepalives, session lost", *self.server_address)
+                return False
+        return True
 
     def closing_connection(self, seq_number, server_address):
         """Received FIN-ACK, starting the protocol to close connection"""
         # Send ACK
-        print(
-            f"[ INFO ] [Server {server_address[0]}:{server_address[1]}] Sending ACK")
+        LOG.info("[Server %s:%s] Sending ACK", *server_address)
         self.acknowledge(seq_number, server_address)
 
         # Send FIN-ACK
-        print(
-            f"[ INFO ] [Server {server_address[0]}:{server_address[1]}] Sending FIN-ACK")
+        LOG.info("[Server %s:%s] Sending FIN-ACK", *server_address)
         fin_ack_segment = Segment()
         fin_ack_segment.set_header({
             "ack": seq_number,
@@ -239,40 +602,102 @@ class Client:
                        server_address[0], server_address[1])
 
         is_ack_received = False
-        time_limit = time.time() + TIMEOUT_LISTEN
+        time_limit = self.clock.time() + TIMEOUT_LISTEN
         while not is_ack_received:
             try:
                 data, _ = self.conn.listen_segment()
                 ack_segment = Segment.from_bytes(data)
                 if ack_segment.get_flag() == ACK_FLAG:
-                    print(
-                        f"[ SUCCESS ] [Server {server_address[0]}:{server_address[1]}] ACK received, closing down connection."
-                    )
+                    LOG.log(SUCCESS, "[Server %s:%s] ACK received, closing down connection.", *server_address)
                     is_ack_received = True
+            except struct.error:
+                continue
             except timeout:
-                if time.time() > time_limit:
-                    print(
-                        f"[ WARNING ] [Server {server_address[0]}:{server_address[1]}] [Timeout] Client waited too long, connection closed."
-                    )
+                if self.clock.time() > time_limit:
+                    LOG.warning("[Server %s:%s] [Timeout] Client waited too long, connection closed.", *server_address)
                     break
-                print(
-                    f"[ WARNING ] [Server {server_address[0]}:{server_address[1]}] [Timeout] Resending FIN ACK."
-                )
+                LOG.warning("[Server %s:%s] [Timeout] Resending FIN ACK.", *server_address)
                 self.conn.send(fin_ack_segment.to_bytes(),
                                server_address[0], server_address[1])
 
         # ACK received from server
-        print(
-            f"[ SUCCESS ] [Server {server_address[0]}:{server_address[1]}] Data received successfuly"
-        )
-        print(
-            f"[ INFO ] [Server {server_address[0]}:{server_address[1]}] File written to received_file/{self.output_file}"
-        )
+        LOG.log(SUCCESS, "[Server %s:%s] Data received successfuly", *server_address)
+        LOG.info("[Server %s:%s] File written to %s",
+                 server_address[0], server_address[1], self.output_path)
+
+
+def output_path(name: str) -> str:
+    """Path in received_file/ of the file or directory name, keeping the directories of its relative path"""
+    parts = [part for part in name.split("/") if part not in ("", ".", "..")]
+    return os.path.join("received_file", *parts)
+
+
+def source_path(path, index: int):
+    """Output file of the source index, path with the source before its extension"""
+    if path is None or path == "-":
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}.source{index}{extension}"
+
+
+def fetch_from_sources(args) -> bool:
+    """
+    Fetch path_file from the server and every server of --sources at once, each one sending
+    the ranges of the file it takes, into received_file/path_file.
+    :return: whether the whole file was received and matches its digest
+    """
+    configure_logging(args.log_level)
+    if args.session:
+        LOG.error("--session fetches its files from one server, it cannot be used with --sources")
+        return False
+    servers = [(args.server_ip or DEFAULT_IP, args.broadcast_port)] + args.sources
+    names = [f"{canonical_host(host)}:{port}" for host, port in servers]
+    path = output_path(args.path_file)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        file = open(path, "w+b")
+    except OSError as exc:
+        LOG.error("%s cannot be written: %s. Client exiting...", path, exc)
+        return False
+    LOG.info("Fetching %s from %s", args.path_file, ", ".join(names))
+    fetch = MultiSourceFetch(file, names, args.chunk_size)
+    clients = []
+    for index, (host, port) in enumerate(servers):
+        # Each source has its own port, and writes its own trace
+        source_args = copy.copy(args)
+        source_args.server_ip, source_args.broadcast_port = host, port
+        source_args.client_port = args.client_port + index
+        source_args.metrics_out = None
+        source_args.trace = source_path(args.trace, index)
+        clients.append(Client(source_args, file=fetch.writer()))
+    if args.metrics_out:
+        install_exporter(lambda: [client.metrics for client in clients], args.metrics_out, args.metrics_format)
+    try:
+        assembled = fetch.run(clients)
+    finally:
+        file.close()
+    if not assembled:
+        os.remove(path)
+    return assembled
 
 
 if __name__ == "__main__":
-    CLIENT = Client()
-    CLIENT.connect()
-    CLIENT.three_way_handshake()
-    CLIENT.listen_file_transfer()
-    CLIENT.shutdown()
+    ARGS = parse_args(False)
+    if ARGS.sources:
+        sys.exit(0 if fetch_from_sources(ARGS) else 1)
+    CLIENT = Client(ARGS)
+    try:
+        CLIENT.connect()
+        CLIENT.three_way_handshake()
+        RECEIVED = CLIENT.listen_file_transfer(keep_open=bool(CLIENT.session_files))
+        for INDEX, NAME in enumerate(CLIENT.session_files):
+            if not CLIENT.keepalive(CLIENT.pause):
+                RECEIVED = False
+                break
+            RECEIVED = CLIENT.fetch(NAME, keep_open=INDEX + 1 < len(CLIENT.session_files)) and RECEIVED
+    except OSError as exc:
+        LOG.error("%s. Client exiting...", exc)
+        RECEIVED = False
+    finally:
+        CLIENT.shutdown()
+    sys.exit(0 if RECEIVED else 1)
@@ -0,0 +1,34 @@
+"""
+admission.py is a module for the admission policy of the server daemon.
+The policy decides which connection requests are served: up to a maximum number of
+clients at once, and only from the allowed networks.
+"""
+import ipaddress
+from typing import List
+from lib.constants import DAEMON_MAX_CLIENTS
+
+
+class AdmissionPolicy:
+    """Which clients the daemon admits, and how many at once"""
+
+    def __init__(self, max_clients: int = DAEMON_MAX_CLIENTS, allow: List[str] = None) -> None:
+        """
+        :param max_clients: the maximum number of clients served at once
+        :param allow: the networks (like 10.0.0.0/8) clients can connect from, any when empty
+        """
+        self.max_clients = max_clients
+        self.allow = [ipaddress.ip_network(network, strict=False) for network in allow or []]
+
+    def is_allowed(self, ip: str) -> bool:
+        """Whether a client with this ip address can be served"""
+        if not self.allow:
+            return True
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+        return any(address in network for network in self.allow)
+
+    def admits(self, client_addr, served: int) -> bool:
+        """Whether the connection request of client_addr is served now, while served clients are"""
+        return served < self.max_clients and self.is_allowed(client_addr[0])
@@ -0,0 +1,22 @@
+"""
+clock.py is a module for the clock used by the server and client.
+The protocol code reads the time and sleeps through a clock object instead of the time
+module, so the simulator can run it on a virtual clock.
+"""
+import time
+
+
+class SystemClock:
+    """Clock backed by the real time of the system"""
+
+    def time(self) -> float:
+        """Wall clock time in seconds since the epoch"""
+        return time.time()
+
+    def monotonic(self) -> float:
+        """Time in seconds that never goes backward, to measure durations"""
+        return time.monotonic()
+
+    def sleep(self, seconds: float):
+        """Block for the given number of seconds"""
+        time.sleep(seconds)
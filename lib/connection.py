@@ -1,34 +1,171 @@
+import os
 import socket
-from lib.constants import TIMEOUT, TIMEOUT_LISTEN, SEGMENT_SIZE, DEFAULT_IP, DEFAULT_BROADCAST_PORT, DEFAULT_PORT
+import struct
+import sys
+import random
+import time
+from lib.constants import (
+    TIMEOUT, TIMEOUT_LISTEN, MAX_SEGMENT_SIZE, DEFAULT_IP, DEFAULT_BROADCAST_PORT, DEFAULT_PORT,
+    SOCKET_RCVBUF, SOCKET_SNDBUF, SO_RXQ_OVFL, PROC_NET_UDP, PROC_DROPS_INTERVAL
+)
+from lib.logger import get_logger
+from lib.trace import DROPPED, RECEIVED, SENT
+from lib.transport import transport_class
+
+LOG = get_logger("connection")
 
 
 class Connection() :
-    """Class representing the socket connection"""
-    def __init__(self, ip : str = DEFAULT_IP, port : int = DEFAULT_PORT, broadcast : int = DEFAULT_BROADCAST_PORT, as_server : bool = False) -> None:
+    """Class representing the socket connection, over the transport of its ip, see lib.transport"""
+    def __init__(self, ip : str = DEFAULT_IP, port : int = DEFAULT_PORT, broadcast : int = DEFAULT_BROADCAST_PORT, as_server : bool = False,
+                 loss_rate : float = 0.0, seed : int = None, rcvbuf : int = SOCKET_RCVBUF, sndbuf : int = SOCKET_SNDBUF,
+                 reuse_port : bool = False, trace = None) -> None:
+        """
+        Bind the socket of a server or client.
+        :param ip: the host to bind, an IP address, unix:DIR or mem:NAME
+        :param reuse_port: let the server share its port with other sockets bound with reuse_port,
+            the kernel then hashes the address of every peer to one of the sockets
+        :param trace: the lib.trace.TraceRecorder recording every datagram, None to record nothing
+        """
         self.ip = ip
         self.port = port
         self.broadcast_port = broadcast
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Fraction of the sent datagrams to drop on purpose, to test retransmission
+        self.loss_rate = loss_rate
+        self.random = random.Random(seed)
+        self.trace = trace
+        self.transport = transport_class(ip)(ip)
+        # None for the in-process queues, which have no buffer or drop count to tune or read
+        self.socket = self.transport.socket
+        self.rcvbuf = self.set_buffer(socket.SO_RCVBUF, rcvbuf, "rmem_max")
+        self.sndbuf = self.set_buffer(socket.SO_SNDBUF, sndbuf, "wmem_max")
+        # Datagrams dropped by the kernel because the receive queue was full, None when unknown
+        self.drops = None
+        self.rxq_ovfl = self.enable_rxq_ovfl()
+        self.drops_read_at = None
         if (as_server) :
-            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.socket.bind((ip, broadcast))
-            print("[ INFO ] Server started on address", ip, "with port", broadcast)
+            self.transport.bind(broadcast, as_server=True, reuse_port=reuse_port)
+            LOG.info("Server started on address %s with port %s", ip, broadcast)
         else :
-            self.socket.bind((ip, port))
-            print("[ INFO ] Client started on address", ip, "with port", port)
-        self.socket.settimeout(TIMEOUT)
-    
+            self.transport.bind(port)
+            LOG.info("Client started on address %s with port %s", ip, port)
+        self.transport.settimeout(TIMEOUT)
+
+    def set_buffer(self, option : int, size : int, limit : str) -> int :
+        """
+        Ask for a socket buffer of size bytes, reporting when the kernel grants less.
+        :return: the usable size of the buffer
+        """
+        if self.socket is None :
+            return 0
+        if size > 0 :
+            self.socket.setsockopt(socket.SOL_SOCKET, option, size)
+        granted = self.socket.getsockopt(socket.SOL_SOCKET, option)
+        # Linux doubles the requested size to make room for its bookkeeping
+        if sys.platform.startswith("linux") :
+            granted //= 2
+        if size > 0 and granted < size :
+            name = "SO_RCVBUF" if option == socket.SO_RCVBUF else "SO_SNDBUF"
+            LOG.warning("Kernel clamped %s to %d bytes instead of %d, raise net.core.%s to allow more",
+                        name, granted, size, limit)
+        return granted
+
+    def enable_rxq_ovfl(self) -> bool :
+        """Ask Linux to attach the receive queue drop count to every received datagram"""
+        if not sys.platform.startswith("linux") or not self.transport.counts_drops :
+            return False
+        try :
+            self.socket.setsockopt(socket.SOL_SOCKET, getattr(socket, "SO_RXQ_OVFL", SO_RXQ_OVFL), 1)
+            return True
+        except OSError :
+            return False
+
+    def kernel_drops(self) :
+        """
+        Number of datagrams the kernel dropped on the receive queue of this socket, None
+        when it cannot be known. Without SO_RXQ_OVFL it is read from /proc/net/udp, at most
+        every PROC_DROPS_INTERVAL seconds.
+        """
+        if self.rxq_ovfl :
+            return self.drops if self.drops is not None else 0
+        if not self.transport.counts_drops :
+            return None
+        now = time.monotonic()
+        if self.drops_read_at is not None and now - self.drops_read_at < PROC_DROPS_INTERVAL :
+            return self.drops
+        self.drops_read_at = now
+        inode = str(os.fstat(self.socket.fileno()).st_ino)
+        for path in PROC_NET_UDP :
+            try :
+                with open(path) as table :
+                    for line in table.readlines()[1:] :
+                        fields = line.split()
+                        # sl local rem st tx:rx tr:when retrnsmt uid timeout inode ref pointer drops
+                        if len(fields) >= 13 and fields[9] == inode :
+                            self.drops = int(fields[12])
+                            return self.drops
+            except OSError :
+                continue
+        return self.drops
+
     def send(self, msg, ip : str, port : int) :
         """Send message through given ip and port"""
-        self.socket.sendto(msg, (ip, port))
-    
+        if self.loss_rate and self.random.random() < self.loss_rate:
+            if self.trace is not None :
+                self.trace.record(DROPPED, msg, (ip, port))
+            return
+        self.transport.sendto(msg, (ip, port))
+        if self.trace is not None :
+            self.trace.record(SENT, msg, (ip, port))
+
+    def set_timeout(self, timeout : float) :
+        """Set how long listen_segment waits for a segment before raising TimeoutError"""
+        self.transport.settimeout(timeout)
+
     def close(self) :
         """Close the socket held by the Connection object"""
-        self.socket.close()
-    
+        self.transport.close()
+
+    def receive(self) :
+        if not self.rxq_ovfl :
+            data, address = self.transport.recvfrom(MAX_SEGMENT_SIZE)
+        else :
+            data, ancillary, address = self.transport.recvmsg(MAX_SEGMENT_SIZE, socket.CMSG_SPACE(4))
+            for level, kind, value in ancillary :
+                if level == socket.SOL_SOCKET and len(value) >= 4 :
+                    self.drops = struct.unpack("I", value[:4])[0]
+        if self.trace is not None :
+            self.trace.record(RECEIVED, data, address)
+        return data, address
+
     def listen_segment(self) :
         """Listen for segment from the socket held by this object"""
         try :
-            return self.socket.recvfrom(SEGMENT_SIZE)
+            return self.receive()
         except TimeoutError as exc:
-            raise TimeoutError from exc
\ No newline at end of file
+            raise TimeoutError from exc
+
+    def listen_until(self, timers) :
+        """
+        Wait for a segment until the next deadline of timers, a lib.timer_wheel.TimerWheel,
+        running the timers that are due. Without timers, wait for the socket timeout.
+        :return: the (data, address) received, None when no segment came before the deadline
+        """
+        if timers.run() :
+            return None
+        wait = timers.time_left()
+        if wait is None :
+            wait = self.transport.gettimeout()
+        if not self.transport.wait(wait) :
+            timers.run()
+            return None
+        return self.receive()
+
+    def poll(self) :
+        """
+        Receive a segment that is already queued, without waiting.
+        :return: the (data, address) received, None when none is queued
+        """
+        if not self.transport.wait(0) :
+            return None
+        return self.receive()
@@ -0,0 +1,207 @@
+"""
+connection_table.py is a module for the state the server keeps about its clients.
+The ConnectionTable holds a Peer for every client between its connection request and the
+end of its session, up to a maximum number of them. Half-open peers, whose handshake is not
+done, and established peers not being served are dropped once they have been quiet for too
+long, and the least recently heard from is evicted when the table is full.
+
+Past a maximum number of half-open peers, connection requests are answered with a SYN cookie
+instead: the sequence number of the SYN is a keyed hash of the address of the client and the
+time, which the client acknowledges in its SYN-ACK. The server allocates nothing for the
+client until that SYN-ACK proves the client owns its address, so a flood of spoofed
+requests cannot fill the table.
+"""
+import hashlib
+import hmac
+import secrets
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from lib.metrics import TableMetrics
+from lib.constants import CONNECTION_TABLE_SIZE, CONNECTION_IDLE_TIMEOUT, HALF_OPEN_LIMIT, HALF_OPEN_TIMEOUT, SYN_COOKIE_MASK, SYN_COOKIE_PERIOD
+
+HALF_OPEN = "half-open"
+ESTABLISHED = "established"
+
+
+class Peer:
+    """What the server knows about a client"""
+    __slots__ = ("state", "version", "capabilities", "fec_group", "fast_open", "name", "byte_range", "srtt", "last_seen", "active")
+
+    def __init__(self, state: str, version: int, last_seen: float) -> None:
+        self.state = state
+        # Options version of the client, 0 for clients without options
+        self.version = version
+        # Capabilities both sides have, agreed on during the handshake, and the FEC group size
+        self.capabilities = 0
+        self.fec_group = 0
+        # Whether the connection request asked for a fast open
+        self.fast_open = False
+        # File named in the request, None when the client did not name one
+        self.name = None
+        # Offset and length of the part of the file the request asked for, None for the whole file
+        self.byte_range = None
+        # Smoothed RTT of the connection, None before the first sample
+        self.srtt = None
+        self.last_seen = last_seen
+        # Whether a session serves the client, its timers then decide when it is given up
+        self.active = False
+
+
+class ConnectionTable:
+    """Peers of the server by address, least recently heard from first"""
+
+    def __init__(self, clock=time.monotonic, capacity: int = CONNECTION_TABLE_SIZE,
+                 half_open_limit: int = HALF_OPEN_LIMIT, half_open_timeout: float = HALF_OPEN_TIMEOUT,
+                 idle_timeout: float = CONNECTION_IDLE_TIMEOUT, metrics: TableMetrics = None) -> None:
+        """
+        :param clock: a function returning monotonic seconds
+        :param capacity: the maximum number of peers
+        :param half_open_limit: the maximum number of half-open peers, the next requests get a SYN cookie
+        :param half_open_timeout: seconds a half-open peer is kept without hearing from it
+        :param idle_timeout: seconds an established peer not being served is kept without hearing from it
+        :param metrics: the registry counting the peers, a new one when None
+        """
+        self.clock = clock
+        self.capacity = max(capacity, 1)
+        self.half_open_limit = half_open_limit
+        self.half_open_timeout = half_open_timeout
+        self.idle_timeout = idle_timeout
+        self.peers: Dict[Tuple[str, int], Peer] = OrderedDict()
+        self.half_open = 0
+        self.metrics = TableMetrics(clock, role="server", table="connections") if metrics is None else metrics
+
+    def __len__(self) -> int:
+        return len(self.peers)
+
+    def __contains__(self, address) -> bool:
+        return address in self.peers
+
+    def get(self, address) -> Optional[Peer]:
+        return self.peers.get(address)
+
+    def touch(self, address) -> Optional[Peer]:
+        """Note that address was heard from"""
+        peer = self.peers.get(address)
+        if peer is not None:
+            peer.last_seen = self.clock()
+            self.peers.move_to_end(address)
+        return peer
+
+    def open(self, address, version: int) -> Optional[Peer]:
+        """
+        Get the peer of a connection request from address, adding it half-open when it is new.
+        :return: the peer, None when there is no room for one more half-open peer
+        """
+        peer = self.touch(address)
+        if peer is not None:
+            peer.version = version
+            return peer
+        if self.half_open >= self.half_open_limit or not self._make_room():
+            return None
+        self.half_open += 1
+        peer = self.peers[address] = Peer(HALF_OPEN, version, self.clock())
+        self._count()
+        return peer
+
+    def establish(self, address, version: int) -> Optional[Peer]:
+        """
+        Get the peer of address with its handshake done, adding it when it is new.
+        :return: the peer, None when the table is full of peers being served
+        """
+        peer = self.touch(address)
+        if peer is None:
+            if not self._make_room():
+                return None
+            peer = self.peers[address] = Peer(ESTABLISHED, version, self.clock())
+        elif peer.state == HALF_OPEN:
+            self.half_open -= 1
+        peer.state = ESTABLISHED
+        peer.version = version
+        self._count()
+        return peer
+
+    def activate(self, address) -> Peer:
+        """Pin the peer of address while a session serves it, adding it half-open when it is missing"""
+        peer = self.peers.get(address)
+        if peer is None:
+            self.half_open += 1
+            peer = self.peers[address] = Peer(HALF_OPEN, 0, self.clock())
+            self._count()
+        peer.active = True
+        return peer
+
+    def remove(self, address) -> Optional[Peer]:
+        peer = self.peers.pop(address, None)
+        if peer is not None and peer.state == HALF_OPEN:
+            self.half_open -= 1
+        self._count()
+        return peer
+
+    def _count(self):
+        self.metrics.connections.set(len(self.peers))
+        self.metrics.half_open.set(self.half_open)
+
+    def _make_room(self) -> bool:
+        """Evict the least recently heard from peer not being served when the table is full"""
+        if len(self.peers) < self.capacity:
+            return True
+        for address, peer in self.peers.items():
+            if not peer.active:
+                self.remove(address)
+                self.metrics.evicted.inc()
+                return True
+        return False
+
+    def reap(self) -> List[Tuple[str, int]]:
+        """
+        Drop the peers not being served that were quiet for longer than their timeout.
+        :return: the addresses dropped
+        """
+        now = self.clock()
+        shortest = min(self.half_open_timeout, self.idle_timeout)
+        reaped = []
+        for address, peer in self.peers.items():
+            quiet = now - peer.last_seen
+            if quiet < shortest:
+                # The peers after it were heard from later
+                break
+            if peer.active:
+                continue
+            if quiet >= (self.half_open_timeout if peer.state == HALF_OPEN else self.idle_timeout):
+                reaped.append(address)
+        for address in reaped:
+            self.remove(address)
+        self.metrics.reaped.inc(len(reaped))
+        return reaped
+
+
+class SynCookies:
+    """Sequence numbers of the SYNs answering connection requests the server keeps no state for"""
+
+    def __init__(self, clock=time.monotonic, period: float = SYN_COOKIE_PERIOD, secret: bytes = None) -> None:
+        """
+        :param clock: a function returning monotonic seconds
+        :param period: seconds of the time slots, a cookie is valid in its slot and the next one
+        :param secret: the key of the hash, a random one of the process when None
+        """
+        self.clock = clock
+        self.period = period
+        self.secret = secrets.token_bytes(16) if secret is None else secret
+
+    def _cookie(self, address, slot: int) -> int:
+        digest = hmac.new(self.secret, f"{address[0]}:{address[1]}:{slot}".encode(), hashlib.sha256).digest()
+        # The SYN-ACK acknowledges the cookie plus one, which has to fit in the header
+        return int.from_bytes(digest[:4], "big") & SYN_COOKIE_MASK
+
+    def make(self, address) -> int:
+        """Cookie of the SYN sent to address"""
+        return self._cookie(address, int(self.clock() // self.period))
+
+    def check(self, address, cookie: int) -> bool:
+        """Whether cookie was made for address in this time slot or the previous one"""
+        if not 0 <= cookie <= SYN_COOKIE_MASK:
+            return False
+        slot = int(self.clock() // self.period)
+        return any(hmac.compare_digest(self._cookie(address, slot - age).to_bytes(4, "big"), cookie.to_bytes(4, "big"))
+                   for age in (0, 1))
@@ -3,6 +3,11 @@
 DEFAULT_IP = "127.0.0.1"
 DEFAULT_PORT = 8000
 DEFAULT_BROADCAST_PORT = 9999
+# Address schemes of the transports other than UDP, see lib/transport.py
+UNIX_SCHEME = "unix:"
+QUEUE_SCHEME = "mem:"
+# Address a client of an IPv6 server binds when none is given
+DEFAULT_IP6 = "::"
 
 # Checksum
 CRC_POLYNOM = 0x1021
@@ -13,9 +18,50 @@ TIMEOUT = 5
 TIMEOUT_LISTEN = 15
 SEGMENT_SIZE = 32768
 
+# Socket buffers, 0 keeps the kernel default
+SOCKET_RCVBUF = 0
+SOCKET_SNDBUF = 0
+# Linux socket option reporting the receive queue drops, missing from older socket modules
+SO_RXQ_OVFL = 40
+PROC_NET_UDP = ["/proc/net/udp", "/proc/net/udp6"]
+PROC_DROPS_INTERVAL = 0.5
+# Datagrams waiting in an in-process queue before the next ones are dropped, like a full socket buffer
+QUEUE_TRANSPORT_LIMIT = 1024
+# ACKs carry the receive queue drops of the client as an unsigned int payload, followed by
+# its receive window: the bytes it can take beyond the acknowledged segment
+DROPS_REPORT_SIZE = 4
+ACK_REPORT_FORMAT = "II"
+ACK_REPORT_SIZE = 8
+# Bytes of received data the client holds while they are written, 0 for no receive window
+RECEIVE_BUFFER = 4194304
+# How often a client with a closed receive window tells the server it opened again
+WINDOW_UPDATE_INTERVAL = 0.05
+
+# Retransmission timeout
+RTO_INITIAL = 1
+RTO_MIN = 0.2
+RTO_MAX = 60
+RTO_CLOCK_GRANULARITY = 0.001
+
+# Timer wheel: seconds per tick, slots per level and number of levels. 4 levels of 256
+# slots of 1 ms reach 49 days, later timers wait in the last level.
+TIMER_RESOLUTION = 0.001
+TIMER_SLOTS = 256
+TIMER_LEVELS = 4
+
+# Forward error correction: largest group of data segments a client accepts one parity for
+FEC_MAX_GROUP = 16
+
+# Segment cache: bytes of encoded segments kept for all the connections, and segments read
+# at once when a file is read in order
+SEGMENT_CACHE_BUDGET = 67108864
+SEGMENT_CACHE_READ_AHEAD = 32
+
 # Sizes
 SEGMENT_SIZE = 32768
-PAYLOAD_SIZE = SEGMENT_SIZE - 12
+HEADER_SIZE = 12
+MAX_SEGMENT_SIZE = 65507
+PAYLOAD_SIZE = SEGMENT_SIZE - HEADER_SIZE
 WINDOW_SIZE = 3
 
 # Flags
@@ -24,3 +70,119 @@ ACK_FLAG = 0b000010000  # 16
 FIN_FLAG = 0b000000001  # 1
 SYN_ACK_FLAG = SYN_FLAG | ACK_FLAG
 FIN_ACK_FLAG = FIN_FLAG | ACK_FLAG
+# Set when an options area follows the header, masked out of the flags by SegmentFlag
+OPTIONS_FLAG = 0b10000000  # 128
+
+# Header options
+# Byte 9 of the header is the options version the sender understands, 0 for none. Options
+# are only sent to a peer that announced a version, so older peers never see them.
+OPTIONS_VERSION = 1
+OPTION_CAPABILITIES = 1
+OPTION_SOCKET_DROPS = 2
+OPTION_RECEIVE_WINDOW = 3
+# Size of the FEC groups in the SYN and SYN-ACK, number of segments covered by a parity segment
+OPTION_FEC_GROUP = 4
+# XOR of the payload lengths of the segments covered by a parity segment
+OPTION_FEC_LENGTH = 5
+# Set in a SYN whose sequence number is a SYN cookie, the client then names the file it asks
+# for in its SYN-ACK, and sends the SYN-ACK again until it is answered
+OPTION_SYN_COOKIE = 6
+# Byte offset and length of the part of the file a request asks for, the server then sends only
+# that range, its data segments numbered from the first data sequence number as for a whole file
+OPTION_RANGE = 7
+# Digest of the whole file in the metadata answering a range request, to check the file assembled from the ranges
+OPTION_DIGEST = 8
+# Features announced in the capabilities option of the handshake, used when both peers have them
+CAPABILITY_ACK_REPORT = 0b1
+CAPABILITY_FEC = 0b10
+CAPABILITIES = CAPABILITY_ACK_REPORT | CAPABILITY_FEC
+# Connection requests carry no flag, and the requested file name as payload
+CONNECT_FLAG = 0
+# Bit of the ack field of a connection request asking for a fast open: the SYN carries the
+# metadata and the first window follows it, without waiting for the rest of the handshake
+CONNECT_FAST_OPEN = 0b1
+METADATA_SEQ = 2
+
+# Logging
+LOG_LEVEL = "INFO"
+LOG_SUMMARY_INTERVAL = 1
+
+# Metrics
+METRICS_PREFIX = "tcpudp"
+METRICS_FORMATS = ["json", "prometheus"]
+RTT_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]
+SERIES_MAX_SAMPLES = 10000
+
+# Impairment proxy
+PROXY_QUEUE_LIMIT = 262144
+PROXY_POLL_INTERVAL = 0.1
+
+# Daemon
+DAEMON_MAX_CLIENTS = 16
+# Worker processes sharing the port of the daemon, and the delay before a crashed one is
+# restarted, doubled up to the maximum while workers crash within WORKER_STABLE_UPTIME seconds
+DAEMON_WORKERS = 1
+WORKER_RESTART_DELAY = 1
+WORKER_RESTART_MAX_DELAY = 30
+WORKER_STABLE_UPTIME = 10
+
+# Pacing
+PACING_GAIN = 1.25
+PACING_BURST_SEGMENTS = 2
+# Rate factor applied when the receiver reports drops, and regained per RTT sample
+PACING_DROP_BACKOFF = 0.5
+PACING_RECOVERY = 0.02
+PACING_MIN_SCALE = 0.05
+
+# Send scheduler
+# Bytes sent per round of the deficit round robin by every transfer waiting for a turn, times its weight
+SCHEDULER_QUANTUM = 32768
+
+# Sessions
+SESSION_IDLE_TIMEOUT = 60
+SESSION_KEEPALIVE_INTERVAL = 2
+SESSION_KEEPALIVE_MISSES = 3
+
+# Teardown
+# The FIN-ACK is sent again after twice the smoothed RTT of the connection (RTO_INITIAL before
+# any sample, RTO_MIN at least), doubling up to TIMEOUT, and the client is given up after
+# FIN_RETRIES of them. A closed connection then lingers for LINGER seconds, only to
+# acknowledge the FIN-ACK of the client again if the ACK is lost.
+FIN_RETRIES = 5
+LINGER = 6
+
+# Connection table
+# Clients the server keeps state for, and how many of them can be half-open before the next
+# connection requests are answered with a SYN cookie, without state until the handshake is done
+CONNECTION_TABLE_SIZE = 1024
+HALF_OPEN_LIMIT = 8
+# Seconds a client is kept without hearing from it: half-open ones longer than the TIMEOUT
+# after which clients resend their request, established ones waiting to be served
+HALF_OPEN_TIMEOUT = 15
+CONNECTION_IDLE_TIMEOUT = 60
+# A SYN cookie is valid in the time slot of this many seconds it was made in and the next one,
+# and fits in 31 bits so the SYN-ACK acknowledging it plus one fits in the header
+SYN_COOKIE_PERIOD = 64
+SYN_COOKIE_MASK = 0x7FFFFFFF
+# Datagrams already queued the server hands to the sessions after its timers fired, before the
+# sessions waiting for a datagram check their timers
+DRAIN_LIMIT = 256
+
+# Trace
+# Latest datagrams a trace keeps in memory until it is written, 0 to write every one as it comes
+TRACE_RING = 0
+# Seconds without any datagram to or from a peer that count as a stall of its connection
+TRACE_STALL = 1.0
+
+# Manifest
+MANIFEST_DIGEST = "md5"
+
+# Multi-source fetch
+# Bytes of the ranges a file fetched from several servers is split into, and the digest of the whole file
+MULTI_SOURCE_CHUNK = 4194304
+MULTI_SOURCE_DIGEST = "sha256"
+# Digests of the files served in ranges the server keeps, not to read a file again for every range
+DIGEST_CACHE_SIZE = 1024
+
+# Profiling
+PROFILE_ENV = "TCPUDP_PROFILE"
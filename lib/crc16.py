@@ -6,19 +6,16 @@ x16 + x12 + x5 + 1
 The CRC-16/CCITT-FALSE algorithm is checked against the following online calculator:
 https://crccalc.com/
 """
-from lib.constants import CRC_INIT, CRC_POLYNOM
+import binascii
+from lib.constants import CRC_INIT
 
-def crc16(data: bytes) -> int:
-    """Calculate the CRC-16 of a byte string."""
-    crc = CRC_INIT
-    for byte in data:
-        crc ^= byte << 8
-        for _ in range(8):
-            if crc & 0x8000:
-                crc = (crc << 1) ^ CRC_POLYNOM
-            else:
-                crc <<= 1
-    return crc & 0xFFFF
+def crc16(data: bytes, crc: int = CRC_INIT) -> int:
+    """
+    Calculate the CRC-16 of a byte string.
+    Passing the CRC of a first string as crc gives the CRC of both strings joined.
+    binascii.crc_hqx computes the same CRC with the polynomial 0x1021, in C.
+    """
+    return binascii.crc_hqx(data, crc)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,106 @@
+"""
+fec.py is a module for the forward error correction of the data segments.
+The data segments are split in groups of group_size, from the first one on. After the last
+segment of a group, the server sends a parity segment: the XOR of the payloads of the group,
+with the number of segments of the group and the XOR of their lengths as options. The
+client keeps the payloads of the group it is receiving, so when exactly one segment of the
+group is lost, it rebuilds it from the others and the parity, without a retransmission.
+"""
+from typing import Dict, List, Optional, Tuple
+from lib.segment import INT_OPTION, OPTION, OPTIONS_LENGTH, Segment
+from lib.constants import METADATA_SEQ, OPTION_FEC_GROUP, OPTION_FEC_LENGTH
+
+DATA_SEQ = METADATA_SEQ + 1
+# Bytes the options of a parity segment add to a data segment of the same payload size
+PARITY_OPTIONS_SIZE = OPTIONS_LENGTH.size + 2 * (OPTION.size + INT_OPTION.size)
+
+
+def group_start(seq: int, group_size: int) -> int:
+    """Sequence number of the first segment of the group of seq"""
+    return DATA_SEQ + (seq - DATA_SEQ) // group_size * group_size
+
+
+def parity_segment(first_seq: int, payloads: List[bytes]) -> Segment:
+    """Parity segment of the group of payloads starting at first_seq"""
+    parity = 0
+    length = 0
+    size = 0
+    for payload in payloads:
+        parity ^= int.from_bytes(payload, "little")
+        length ^= len(payload)
+        size = max(size, len(payload))
+    segment = Segment()
+    segment.set_header({"seq": first_seq, "ack": DATA_SEQ})
+    segment.set_int_option(OPTION_FEC_GROUP, len(payloads))
+    segment.set_int_option(OPTION_FEC_LENGTH, length)
+    segment.set_payload(parity.to_bytes(size, "little"))
+    return segment
+
+
+class FecReceiver:
+    """Payloads of the group being received, delivered or received ahead, and its parity"""
+
+    def __init__(self, group_size: int) -> None:
+        self.group_size = group_size
+        self.start = None
+        self.payloads: Dict[int, bytes] = {}
+        # Number of segments, XOR of their lengths and XOR of their payloads
+        self.parity: Optional[Tuple[int, int, bytes]] = None
+
+    def _enter(self, next_seq: int):
+        """Move to the group of next_seq, forgetting the previous one"""
+        start = group_start(next_seq, self.group_size)
+        if start != self.start:
+            self.start = start
+            self.payloads.clear()
+            self.parity = None
+
+    def add(self, next_seq: int, seq: int, payload: bytes) -> bool:
+        """
+        Keep the payload of seq, delivered or received ahead of next_seq, the next one expected.
+        :return: whether it belongs to the group of next_seq and was kept
+        """
+        self._enter(next_seq)
+        if group_start(seq, self.group_size) != self.start:
+            return False
+        self.payloads[seq] = payload
+        return True
+
+    def add_parity(self, next_seq: int, segment: Segment) -> bool:
+        """
+        Keep the parity segment when it belongs to the group of next_seq.
+        :return: whether it was kept
+        """
+        self._enter(next_seq)
+        count = segment.get_int_option(OPTION_FEC_GROUP)
+        length = segment.get_int_option(OPTION_FEC_LENGTH)
+        if segment.get_header()["seq"] != self.start or not count or length is None:
+            return False
+        self.parity = (count, length, segment.get_payload())
+        return True
+
+    def take(self, seq: int) -> Tuple[Optional[bytes], bool]:
+        """
+        Get the payload of seq, the next one expected, when it was received ahead or can be
+        rebuilt from the parity.
+        :return: the payload, None when it is missing, and whether it was rebuilt
+        """
+        self._enter(seq)
+        payload = self.payloads.get(seq)
+        if payload is not None:
+            return payload, False
+        if self.parity is None:
+            return None, False
+        count, length, parity = self.parity
+        if seq >= self.start + count or len(self.payloads) != count - 1:
+            return None, False
+        value = int.from_bytes(parity, "little")
+        for other in self.payloads.values():
+            value ^= int.from_bytes(other, "little")
+            length ^= len(other)
+        if value.bit_length() > length * 8:
+            # The segments of the group do not match the parity
+            return None, False
+        payload = value.to_bytes(length, "little")
+        self.payloads[seq] = payload
+        return payload, True
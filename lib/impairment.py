@@ -0,0 +1,122 @@
+"""
+impairment.py is a module modelling a bad network link for one direction of traffic.
+Every datagram given to Impairment.process can be dropped (randomly or in bursts),
+corrupted, duplicated, delayed with jitter, reordered and rate limited. All random
+choices come from a seeded RNG, so the same seed and the same datagrams always get
+the same fate.
+"""
+import random
+from typing import List, Tuple
+from lib.constants import HEADER_SIZE, PROXY_QUEUE_LIMIT
+
+
+class Impairment:
+    """Impairments applied to the datagrams going in one direction"""
+
+    def __init__(self, loss: float = 0.0, burst_enter: float = 0.0, burst_exit: float = 1.0,
+                 burst_loss: float = 1.0, delay: float = 0.0, jitter: float = 0.0,
+                 reorder: float = 0.0, reorder_delay: float = 0.0, duplicate: float = 0.0,
+                 corrupt: float = 0.0, rate: float = 0.0, queue_limit: int = PROXY_QUEUE_LIMIT,
+                 seed=None) -> None:
+        """
+        :param loss: probability of dropping a datagram
+        :param burst_enter: probability of going from the good to the lossy state (Gilbert-Elliott)
+        :param burst_exit: probability of going back from the lossy to the good state
+        :param burst_loss: probability of dropping a datagram in the lossy state
+        :param delay: delay added to every datagram in seconds
+        :param jitter: maximum random variation of the delay in seconds
+        :param reorder: probability of holding a datagram back by reorder_delay seconds
+        :param duplicate: probability of sending a datagram twice
+        :param corrupt: probability of flipping one byte of a datagram
+        :param rate: link rate in bytes per second, 0 for no limit
+        :param queue_limit: bytes that can wait for a rate limited link before datagrams are dropped
+        :param seed: seed of the RNG
+        """
+        self.loss = loss
+        self.burst_enter = burst_enter
+        self.burst_exit = burst_exit
+        self.burst_loss = burst_loss
+        self.delay = delay
+        self.jitter = jitter
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self.duplicate = duplicate
+        self.corrupt = corrupt
+        self.rate = rate
+        self.queue_limit = queue_limit
+        self.random = random.Random(seed)
+        self.in_burst = False
+        self.link_free_at = 0.0
+        self.stats = {
+            "received": 0, "dropped": 0, "burst_dropped": 0, "queue_dropped": 0,
+            "corrupted": 0, "duplicated": 0, "reordered": 0,
+        }
+
+    def _is_lost(self) -> bool:
+        """Random and burst loss"""
+        if self.burst_enter:
+            if self.in_burst:
+                self.in_burst = self.random.random() >= self.burst_exit
+            else:
+                self.in_burst = self.random.random() < self.burst_enter
+            if self.in_burst and self.random.random() < self.burst_loss:
+                self.stats["burst_dropped"] += 1
+                return True
+        if self.loss and self.random.random() < self.loss:
+            self.stats["dropped"] += 1
+            return True
+        return False
+
+    def _corrupt(self, data: bytes) -> bytes:
+        """Flip one byte of the payload, or of the checksum when there is no payload"""
+        corrupted = bytearray(data)
+        if len(data) > HEADER_SIZE:
+            index = self.random.randrange(HEADER_SIZE, len(data))
+        else:
+            index = len(data) - 1
+        corrupted[index] ^= self.random.randrange(1, 256)
+        self.stats["corrupted"] += 1
+        return bytes(corrupted)
+
+    def _departure(self, size: int, now: float):
+        """Time the datagram leaves a rate limited link, None when the queue is full"""
+        if not self.rate:
+            return now
+        start = max(now, self.link_free_at)
+        if (start - now) * self.rate > self.queue_limit:
+            self.stats["queue_dropped"] += 1
+            return None
+        self.link_free_at = start + size / self.rate
+        return self.link_free_at
+
+    def _latency(self) -> float:
+        latency = self.delay
+        if self.jitter:
+            latency += self.random.uniform(-self.jitter, self.jitter)
+        if self.reorder and self.random.random() < self.reorder:
+            latency += self.reorder_delay
+            self.stats["reordered"] += 1
+        return max(latency, 0.0)
+
+    def process(self, data: bytes, now: float) -> List[Tuple[float, bytes]]:
+        """
+        Decide the fate of a datagram received at time now.
+        :return: the (delivery time, datagram) pairs to send, empty when it is dropped
+        """
+        self.stats["received"] += 1
+        if self._is_lost():
+            return []
+        if self.corrupt and self.random.random() < self.corrupt:
+            data = self._corrupt(data)
+        copies = 1
+        if self.duplicate and self.random.random() < self.duplicate:
+            copies = 2
+            self.stats["duplicated"] += 1
+
+        deliveries = []
+        for _ in range(copies):
+            departure = self._departure(len(data), now)
+            if departure is None:
+                continue
+            deliveries.append((departure + self._latency(), data))
+        return deliveries
@@ -0,0 +1,85 @@
+"""
+logger.py is a module for the leveled, rate-limited logging of the server and client.
+Messages keep the "[ LEVEL ] message" layout used throughout the app.
+
+Per-segment (hot path) messages are logged at DEBUG level with lazy %-formatting, so
+they cost nothing unless DEBUG is enabled. At the default INFO level they are instead
+counted by a Summary and reported as one periodic summary line.
+"""
+import logging
+import sys
+import time
+from lib.constants import LOG_SUMMARY_INTERVAL
+
+LOGGER_NAME = "tcp_over_udp"
+SUCCESS = 25
+LOG_LEVELS = ["DEBUG", "INFO", "SUCCESS", "WARNING", "ERROR"]
+
+logging.addLevelName(SUCCESS, "SUCCESS")
+
+
+class _TagFormatter(logging.Formatter):
+    """Format records as "[ LEVEL ] message" like the rest of the app"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        return f"[ {record.levelname} ] {record.getMessage()}"
+
+
+def get_logger(name: str = None) -> logging.Logger:
+    """Get the app logger, or one of its children when name is given"""
+    if name is None:
+        return logging.getLogger(LOGGER_NAME)
+    return logging.getLogger(f"{LOGGER_NAME}.{name}")
+
+
+def configure_logging(level: str = "INFO", stream=None) -> logging.Logger:
+    """
+    Configure the app logger to write to stream (stdout by default) at the given level.
+    :param level: one of LOG_LEVELS
+    :param stream: the stream to write the log lines to
+    :return: the app logger
+    """
+    logger = get_logger()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    handler = logging.StreamHandler(sys.stdout if stream is None else stream)
+    handler.setFormatter(_TagFormatter())
+    logger.addHandler(handler)
+    logger.setLevel(level.upper())
+    logger.propagate = False
+    return logger
+
+
+class Summary:
+    """
+    Aggregate hot-path events into one summary line per interval.
+    Counting an event is a dict update and a clock read; the line is only formatted
+    when the interval is over or when flush is called.
+    """
+
+    def __init__(self, logger: logging.Logger, label: str, interval: float = LOG_SUMMARY_INTERVAL) -> None:
+        self.logger = logger
+        self.label = label
+        self.interval = interval
+        self.enabled = logger.isEnabledFor(logging.INFO)
+        self.counts = {}
+        self.next_flush = time.monotonic() + interval
+
+    def count(self, event: str, amount: int = 1):
+        """Count amount occurrences of event, flushing the summary when it is due"""
+        if not self.enabled:
+            return
+        self.counts[event] = self.counts.get(event, 0) + amount
+        if time.monotonic() >= self.next_flush:
+            self.flush()
+
+    def flush(self):
+        """Log the events counted since the last flush and reset the counters"""
+        self.next_flush = time.monotonic() + self.interval
+        if not self.counts:
+            return
+        self.logger.info(
+            "%s %s", self.label,
+            ", ".join(f"{event}={amount}" for event, amount in self.counts.items())
+        )
+        self.counts = {}
@@ -0,0 +1,185 @@
+"""
+manifest.py is a module to send a whole directory tree as one stream.
+The stream starts with a manifest, a JSON list of the relative path, size and digest of
+every file, followed by the data of all the files back to back. The server splits the
+stream into segments like a single file, so every file of the directory is sent over one
+connection, in one sequence space.
+"""
+import hashlib
+import io
+import json
+import os
+from typing import List
+from lib.constants import MANIFEST_DIGEST
+from lib.logger import get_logger
+
+LOG = get_logger("manifest")
+
+
+def file_digest(path: str) -> str:
+    """Hex digest of the file at path"""
+    digest = hashlib.new(MANIFEST_DIGEST)
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def build_manifest(root: str) -> List[dict]:
+    """List the path (relative to root), size and digest of every file under root, in a stable order"""
+    manifest = []
+    for directory, subdirectories, files in os.walk(root):
+        subdirectories.sort()
+        for name in sorted(files):
+            path = os.path.join(directory, name)
+            manifest.append({
+                "path": os.path.relpath(path, root).replace(os.sep, "/"),
+                "size": os.path.getsize(path),
+                MANIFEST_DIGEST: file_digest(path),
+            })
+    return manifest
+
+
+class DirectoryStream:
+    """Read-only file of the manifest of a directory followed by the data of its files"""
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self.manifest = build_manifest(root)
+        header = json.dumps(self.manifest).encode()
+        self.manifest_size = len(header)
+        # (start offset in the stream, size, reader) of every part of the stream
+        self.parts = [(0, len(header), io.BytesIO(header))]
+        offset = len(header)
+        for entry in self.manifest:
+            self.parts.append((offset, entry["size"], os.path.join(root, entry["path"])))
+            offset += entry["size"]
+        self.size = offset
+        self.position = 0
+
+    def _reader(self, index: int):
+        """Open the file of a part the first time it is read"""
+        start, size, reader = self.parts[index]
+        if isinstance(reader, str):
+            reader = open(reader, "rb")
+            self.parts[index] = (start, size, reader)
+        return reader
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.position = max(offset, 0)
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0:
+            size = self.size - self.position
+        chunks = []
+        for index, (start, length, _) in enumerate(self.parts):
+            if size <= 0:
+                break
+            if self.position >= start + length or length == 0:
+                continue
+            reader = self._reader(index)
+            reader.seek(self.position - start)
+            chunk = reader.read(min(size, start + length - self.position))
+            chunks.append(chunk)
+            self.position += len(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def close(self):
+        for _, _, reader in self.parts:
+            if not isinstance(reader, str):
+                reader.close()
+
+
+class ManifestWriter:
+    """
+    Write-only file receiving a directory stream: it parses the manifest, then writes
+    the data into the files it lists under root and checks their digests.
+    """
+
+    def __init__(self, root: str, manifest_size: int) -> None:
+        self.root = os.path.realpath(root)
+        self.manifest_size = manifest_size
+        self.header = bytearray()
+        self.manifest = None
+        self.index = 0
+        self.file = None
+        self.remaining = 0
+        self.digest = None
+        self.mismatches = []
+        self.written = 0
+
+    def _path(self, relative: str) -> str:
+        """Absolute path of a manifest entry, refusing paths leaving root"""
+        path = os.path.realpath(os.path.join(self.root, relative))
+        if os.path.commonpath([path, self.root]) != self.root:
+            raise ValueError(f"manifest path {relative} is outside of {self.root}")
+        return path
+
+    def _next_file(self):
+        """Close the current file and open the next one of the manifest, creating empty files on the way"""
+        while self.file is None and self.index < len(self.manifest):
+            entry = self.manifest[self.index]
+            path = self._path(entry["path"])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.file = open(path, "wb")
+            self.remaining = entry["size"]
+            self.digest = hashlib.new(MANIFEST_DIGEST)
+            if self.remaining == 0:
+                self._finish_file()
+
+    def _finish_file(self):
+        entry = self.manifest[self.index]
+        self.file.close()
+        self.file = None
+        self.index += 1
+        if self.digest.hexdigest() != entry[MANIFEST_DIGEST]:
+            LOG.error("Digest mismatch for %s", entry["path"])
+            self.mismatches.append(entry["path"])
+
+    def write(self, data: bytes) -> int:
+        view = memoryview(data)
+        if self.manifest is None:
+            needed = self.manifest_size - len(self.header)
+            self.header += view[:needed]
+            view = view[needed:]
+            if len(self.header) < self.manifest_size:
+                return len(data)
+            self.manifest = json.loads(self.header.decode())
+            os.makedirs(self.root, exist_ok=True)
+            LOG.info("Receiving %d files into %s", len(self.manifest), self.root)
+            self._next_file()
+        while view:
+            if self.file is None:
+                raise ValueError("received more data than listed in the manifest")
+            chunk = view[:self.remaining]
+            self.file.write(chunk)
+            self.digest.update(chunk)
+            self.remaining -= len(chunk)
+            self.written += len(chunk)
+            view = view[len(chunk):]
+            if self.remaining == 0:
+                self._finish_file()
+                self._next_file()
+        return len(data)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.manifest is None:
+            LOG.error("Manifest of %s was not received", self.root)
+            return
+        missing = len(self.manifest) - self.index
+        if missing:
+            LOG.error("%d files of %s were not received completely", missing, self.root)
+        elif not self.mismatches:
+            LOG.info("All %d files of %s received and verified", len(self.manifest), self.root)
@@ -0,0 +1,282 @@
+"""
+metrics.py is a module for the per-connection metrics of the server and client.
+Every connection (one per peer) owns a MetricsRegistry holding its counters, gauges,
+histograms and time series. Updating a metric is a single attribute update, the
+snapshot and the JSON / Prometheus text exports are only built on demand.
+"""
+import atexit
+import json
+import signal
+import time
+from bisect import bisect_left
+from collections import deque
+from typing import Dict, List
+from lib.constants import METRICS_PREFIX, RTT_BUCKETS, SERIES_MAX_SAMPLES
+
+
+class Counter:
+    """Monotonically increasing value"""
+    kind = "counter"
+
+    def __init__(self, name: str, description: str) -> None:
+        self.name = name
+        self.description = description
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    """Value that can go up and down"""
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str) -> None:
+        self.name = name
+        self.description = description
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram:
+    """Distribution of observed values over fixed upper bounds"""
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, buckets: List[float]) -> None:
+        self.name = name
+        self.description = description
+        self.buckets = sorted(buckets)
+        # The last count is the +Inf bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        cumulative = []
+        total = 0
+        for count in self.counts:
+            total += count
+            cumulative.append(total)
+        return {
+            "buckets": dict(zip([str(bound) for bound in self.buckets] + ["+Inf"], cumulative)),
+            "sum": self.sum,
+            "count": self.count,
+        }
+
+
+class TimeSeries:
+    """Value sampled over time, keeping only the latest SERIES_MAX_SAMPLES samples"""
+    kind = "series"
+
+    def __init__(self, name: str, description: str, clock, origin: float) -> None:
+        self.name = name
+        self.description = description
+        self.clock = clock
+        self.origin = origin
+        self.samples = deque(maxlen=SERIES_MAX_SAMPLES)
+
+    def record(self, value):
+        self.samples.append((self.clock() - self.origin, value))
+
+    def snapshot(self):
+        return [[round(at, 6), value] for at, value in self.samples]
+
+
+class MetricsRegistry:
+    """
+    Metrics of a single connection, identified by its labels.
+    Times are read from clock, a function returning monotonic seconds.
+    """
+
+    def __init__(self, clock=time.monotonic, **labels) -> None:
+        self.labels = labels
+        self.clock = clock
+        self.created = clock()
+        self.metrics: Dict[str, object] = {}
+
+    def _get(self, cls, name: str, *args):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = cls(name, *args)
+            self.metrics[name] = metric
+        return metric
+
+    def counter(self, name: str, description: str = "") -> Counter:
+        """Get the counter called name, creating it if needed"""
+        return self._get(Counter, name, description)
+
+    def gauge(self, name: str, description: str = "") -> Gauge:
+        """Get the gauge called name, creating it if needed"""
+        return self._get(Gauge, name, description)
+
+    def histogram(self, name: str, description: str = "", buckets: List[float] = RTT_BUCKETS) -> Histogram:
+        """Get the histogram called name, creating it if needed"""
+        return self._get(Histogram, name, description, buckets)
+
+    def series(self, name: str, description: str = "") -> TimeSeries:
+        """Get the time series called name, creating it if needed"""
+        return self._get(TimeSeries, name, description, self.clock, self.created)
+
+    def fold(self, other: "MetricsRegistry"):
+        """
+        Add the counters and histograms of other to the ones of this registry, to keep the totals
+        of a connection whose registry is dropped. Its gauges and time series are not totals, and are left out.
+        """
+        for name, metric in other.metrics.items():
+            if metric.kind == "counter":
+                self.counter(name, metric.description).inc(metric.value)
+            elif metric.kind == "histogram":
+                total = self.histogram(name, metric.description, metric.buckets)
+                for index, count in enumerate(metric.counts):
+                    total.counts[index] += count
+                total.sum += metric.sum
+                total.count += metric.count
+
+    def snapshot(self) -> dict:
+        """Get the current value of every metric as plain python objects"""
+        return {
+            "labels": dict(self.labels),
+            "uptime_seconds": self.clock() - self.created,
+            "metrics": {name: metric.snapshot() for name, metric in self.metrics.items()},
+        }
+
+    def to_json(self) -> str:
+        """Export the snapshot of this registry as JSON"""
+        return json.dumps(self.snapshot())
+
+    def to_prometheus(self) -> str:
+        """Export this registry in the Prometheus text format"""
+        return to_prometheus([self])
+
+
+class ConnectionMetrics(MetricsRegistry):
+    """Registry holding the metrics maintained by the handshake and transfer code"""
+
+    def __init__(self, clock=time.monotonic, **labels) -> None:
+        super().__init__(clock, **labels)
+        self.segments_sent = self.counter("segments_sent_total", "Segments sent")
+        self.segments_received = self.counter("segments_received_total", "Segments received")
+        self.bytes_sent = self.counter("bytes_sent_total", "Payload bytes sent")
+        self.bytes_received = self.counter("bytes_received_total", "Payload bytes received in order")
+        self.retransmits = self.counter("retransmits_total", "Segments sent more than once")
+        self.duplicates = self.counter("duplicates_total", "Duplicate segments or ACKs received")
+        self.out_of_order = self.counter("out_of_order_total", "Segments received ahead of the expected one")
+        self.checksum_failures = self.counter("checksum_failures_total", "Segments dropped for a bad checksum")
+        self.timeouts = self.counter("timeouts_total", "Receive timeouts")
+        self.handshake_retries = self.counter("handshake_retries_total", "Handshake segments sent again")
+        self.pacing_wait = self.counter("pacing_wait_seconds_total", "Time spent waiting for the pacer and the send scheduler before sending")
+        self.socket_drops = self.gauge("socket_drops", "Datagrams dropped by the kernel on the receive queue of the socket")
+        self.peer_socket_drops = self.gauge("peer_socket_drops", "Receive queue drops reported by the peer in its ACKs")
+        self.receive_window = self.gauge("receive_window_bytes", "Last receive window advertised in the ACKs")
+        self.zero_windows = self.counter("zero_windows_total", "Times the sender waited for the receive window to open")
+        self.cache_hits = self.counter("segment_cache_hits_total", "Segments to send found in the segment cache")
+        self.cache_misses = self.counter("segment_cache_misses_total", "Segments to send read from the file and encoded")
+        self.fec_parity_sent = self.counter("fec_parity_sent_total", "FEC parity segments sent")
+        self.fec_recovered = self.counter("fec_recovered_total", "Lost segments rebuilt from a FEC parity segment")
+        self.rtt = self.histogram("rtt_seconds", "Round trip time of segments sent once")
+        self.handshake_time = self.gauge("handshake_seconds", "Duration of the three-way handshake")
+        self.first_byte_time = self.gauge("first_byte_seconds", "Time from connecting to the first data byte")
+        self.transfer_time = self.gauge("transfer_seconds", "Duration of the file transfer")
+        self.goodput = self.gauge("goodput_bytes_per_second", "Payload bytes delivered per second")
+        self.window_size = self.series("window_size", "Segments in the sending window")
+
+
+class TableMetrics(MetricsRegistry):
+    """Registry holding the metrics of the connection table of the server"""
+
+    def __init__(self, clock=time.monotonic, **labels) -> None:
+        super().__init__(clock, **labels)
+        self.connections = self.gauge("connections", "Clients in the connection table")
+        self.half_open = self.gauge("half_open_connections", "Clients in the connection table whose handshake is not done")
+        self.reaped = self.counter("connections_reaped_total", "Clients dropped from the connection table after a timeout")
+        self.evicted = self.counter("connections_evicted_total", "Clients evicted from the full connection table")
+        self.abandoned = self.counter("handshakes_abandoned_total", "Handshakes given up for a client that never answered")
+        self.cookies_sent = self.counter("syn_cookies_sent_total", "SYNs sent with a cookie, without keeping state")
+        self.cookies_accepted = self.counter("syn_cookies_accepted_total", "SYN-ACKs completing a handshake with a valid cookie")
+        self.cookies_rejected = self.counter("syn_cookies_rejected_total", "SYN-ACKs from unknown clients without a valid cookie")
+
+
+def _format_labels(labels: dict, **extra) -> str:
+    merged = {**labels, **extra}
+    if not merged:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in merged.items()) + "}"
+
+
+def to_prometheus(registries: List[MetricsRegistry]) -> str:
+    """
+    Export several registries in the Prometheus text format.
+    Metrics with the same name are grouped under one HELP / TYPE header and told apart
+    by the labels of their registry. Time series are exported as a gauge of their
+    latest sample.
+    """
+    grouped: Dict[str, list] = {}
+    for registry in registries:
+        for name, metric in registry.metrics.items():
+            grouped.setdefault(name, []).append((registry.labels, metric))
+
+    lines = []
+    for name, entries in grouped.items():
+        first = entries[0][1]
+        full_name = f"{METRICS_PREFIX}_{name}"
+        kind = "gauge" if first.kind == "series" else first.kind
+        lines.append(f"# HELP {full_name} {first.description}")
+        lines.append(f"# TYPE {full_name} {kind}")
+        for labels, metric in entries:
+            if metric.kind == "histogram":
+                cumulative = 0
+                for bound, count in zip(metric.buckets + ["+Inf"], metric.counts):
+                    cumulative += count
+                    lines.append(f"{full_name}_bucket{_format_labels(labels, le=bound)} {cumulative}")
+                lines.append(f"{full_name}_sum{_format_labels(labels)} {metric.sum}")
+                lines.append(f"{full_name}_count{_format_labels(labels)} {metric.count}")
+            elif metric.kind == "series":
+                if metric.samples:
+                    lines.append(f"{full_name}{_format_labels(labels)} {metric.samples[-1][1]}")
+            else:
+                lines.append(f"{full_name}{_format_labels(labels)} {metric.value}")
+    return "\n".join(lines) + "\n"
+
+
+def export_metrics(registries: List[MetricsRegistry], path: str, fmt: str = "json"):
+    """
+    Write the given registries to path.
+    :param registries: the registries to export
+    :param path: the file to write, "-" for stdout
+    :param fmt: "json" or "prometheus"
+    """
+    if fmt == "prometheus":
+        output = to_prometheus(registries)
+    else:
+        output = json.dumps([registry.snapshot() for registry in registries], indent=2) + "\n"
+    if path == "-":
+        print(output, end="")
+        return
+    with open(path, "w") as file:
+        file.write(output)
+
+
+def install_exporter(get_registries, path: str, fmt: str = "json"):
+    """
+    Export the registries returned by get_registries to path when the process exits,
+    and on demand whenever the process receives SIGUSR1.
+    """
+    def export(*_):
+        export_metrics(get_registries(), path, fmt)
+
+    atexit.register(export)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, export)
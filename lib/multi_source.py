@@ -0,0 +1,319 @@
+"""
+multi_source.py is a module to fetch one file from several servers at once.
+The file is split into ranges of --chunk-size bytes that the sources take one at a time: each
+source asks its server for the next range over its session as soon as it received the
+previous one, so the faster servers fetch more of them. Once no range is left, a source that
+is done steals the rest of a range that a slower source is still fetching, and the range is
+done as soon as either of them has it, so a slow or stuck server does not hold the file back.
+Every source writes what it receives at its offset in the output file.
+
+Every segment is checked against its checksum as it arrives. The metadata of each range
+carries the digest of the whole file, every server has to announce the same size and digest,
+and the assembled file is checked against that digest once every range is received.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional
+from lib.constants import MULTI_SOURCE_DIGEST, SESSION_KEEPALIVE_INTERVAL, TIMEOUT
+from lib.logger import get_logger, SUCCESS
+
+LOG = get_logger("client")
+
+
+class SourceRejected(Exception):
+    """Raised from the metadata of a server that does not serve the file in ranges, or serves another one"""
+
+
+class Chunk:
+    """Range of the file, done once one of the sources fetching it received all of it"""
+    __slots__ = ("start", "end", "done", "fetches")
+
+    def __init__(self, start: int, end: int) -> None:
+        self.start = start
+        self.end = end
+        self.done = False
+        self.fetches: List["RangeFetch"] = []
+
+
+class RangeFetch:
+    """Part of a chunk a source is fetching, from start to the end of the chunk"""
+    __slots__ = ("source", "chunk", "start", "position", "started")
+
+    def __init__(self, source: int, chunk: Chunk, start: int, started: float) -> None:
+        self.source = source
+        self.chunk = chunk
+        self.start = start
+        # Offset of the next byte to receive
+        self.position = start
+        self.started = started
+
+    def left(self) -> int:
+        return self.chunk.end - self.position
+
+    def rate(self, now: float) -> float:
+        """Bytes per second received so far"""
+        elapsed = now - self.started
+        return (self.position - self.start) / elapsed if elapsed > 0 else 0.0
+
+
+class RangeWriter:
+    """Output of a source, writing what it receives at the position of its current fetch"""
+
+    def __init__(self, fetcher: "MultiSourceFetch") -> None:
+        self.fetcher = fetcher
+        self.fetch: Optional[RangeFetch] = None
+
+    def write(self, data: bytes) -> int:
+        fetch = self.fetch
+        # Never past the range, whatever the server sends
+        data = data[:max(fetch.chunk.end - fetch.position, 0)]
+        self.fetcher.write_at(fetch.position, data)
+        fetch.position += len(data)
+        return len(data)
+
+    def close(self):
+        """The output is closed by the fetch once the file is assembled"""
+
+
+class MultiSourceFetch:
+    """File fetched from several sources, split into the chunks they take"""
+
+    def __init__(self, file, sources: List[str], chunk_size: int, clock=time.monotonic) -> None:
+        """
+        :param file: the output file, opened for writing
+        :param sources: the name of every source, for the logs
+        :param chunk_size: the bytes of the chunks
+        :param clock: a function returning monotonic seconds
+        """
+        self.file = file
+        self.sources = sources
+        self.chunk_size = chunk_size
+        self.clock = clock
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.closed = False
+        # Size and digest of the file, from the metadata of the first range received
+        self.size: Optional[int] = None
+        self.digest: Optional[bytes] = None
+        self.chunks: List[Chunk] = []
+        # Chunks whose source failed, fetched again from where it stopped
+        self.pending: Deque[Chunk] = deque()
+        # Offset of the next chunk to make
+        self.next_offset = 0
+        # Fetch of every source fetching a chunk
+        self.active: Dict[int, RangeFetch] = {}
+        # Bytes per second of the last chunk each source received
+        self.rates: Dict[int, float] = {}
+        # Writer of every source, in the order they were made
+        self.writers: List[RangeWriter] = []
+        self.received = [0] * len(sources)
+        self.ranges = [0] * len(sources)
+        self.running = 0
+
+    def writer(self) -> RangeWriter:
+        """Output of the next source"""
+        writer = RangeWriter(self)
+        self.writers.append(writer)
+        return writer
+
+    def write_at(self, offset: int, data: bytes):
+        with self.write_lock:
+            # A source still fetching a stolen chunk once the file is assembled
+            if not self.closed:
+                os.pwrite(self.file.fileno(), data, offset)
+
+    def check(self, size: int, digest: Optional[bytes], directory: bool):
+        """
+        Check the metadata of a range, the first one sets the size and digest of the file.
+        :raise SourceRejected: when the server sent the whole file, a directory or another file
+        """
+        if directory:
+            raise SourceRejected("a directory is fetched from one server")
+        if digest is None:
+            raise SourceRejected("the server does not send files in ranges")
+        with self.condition:
+            if self.size is None:
+                self.size, self.digest = size, digest
+                self.file.truncate(size)
+                # The chunks made before the size was known may be past the end
+                for chunk in self.chunks:
+                    chunk.end = min(chunk.end, size)
+                    chunk.done = chunk.done or chunk.start >= size
+                self.pending = deque(chunk for chunk in self.pending if not chunk.done)
+                self.condition.notify_all()
+            elif (size, digest) != (self.size, self.digest):
+                raise SourceRejected("the server has another version of the file")
+
+    def complete(self) -> bool:
+        return (self.size is not None and self.next_offset >= self.size and not self.pending
+                and all(chunk.done for chunk in self.chunks))
+
+    def take(self, source: int) -> Optional[RangeFetch]:
+        """
+        Next range for source: a chunk left by a failed source, a new chunk, or the rest of
+        the chunk of a slower source.
+        :return: the fetch of the range, None when there is none for source now
+        """
+        with self.condition:
+            if self.complete():
+                return None
+            if self.pending:
+                chunk = self.pending.popleft()
+            elif self.size is None or self.next_offset < self.size:
+                # Before the first metadata, the chunks are made without knowing where the file ends
+                end = self.next_offset + self.chunk_size
+                chunk = Chunk(self.next_offset, end if self.size is None else min(end, self.size))
+                self.next_offset = end
+                self.chunks.append(chunk)
+            else:
+                return self.steal(source)
+            return self.start(source, chunk, chunk.start)
+
+    def steal(self, source: int) -> Optional[RangeFetch]:
+        """Fetch of the rest of the chunk with the most bytes left among those fetched slower than by source"""
+        rate = self.rates.get(source)
+        if rate is None:
+            return None
+        now = self.clock()
+        victim = None
+        for fetch in self.active.values():
+            if (fetch.source == source or fetch.chunk.done or len(fetch.chunk.fetches) > 1
+                    or fetch.left() <= 0 or fetch.rate(now) >= rate):
+                continue
+            if victim is None or fetch.left() > victim.left():
+                victim = fetch
+        if victim is None:
+            return None
+        LOG.info("[Source %s] Stealing bytes %d to %d from %s", self.sources[source], victim.position,
+                 victim.chunk.end, self.sources[victim.source])
+        return self.start(source, victim.chunk, victim.position)
+
+    def start(self, source: int, chunk: Chunk, start: int) -> RangeFetch:
+        fetch = RangeFetch(source, chunk, start, self.clock())
+        chunk.fetches.append(fetch)
+        self.active[source] = fetch
+        return fetch
+
+    def finish(self, fetch: RangeFetch):
+        """End fetch, its chunk is done when all of it was received, otherwise its rest goes back to the others"""
+        with self.condition:
+            self.active.pop(fetch.source, None)
+            chunk = fetch.chunk
+            chunk.fetches.remove(fetch)
+            self.received[fetch.source] += fetch.position - fetch.start
+            if fetch.left() <= 0:
+                chunk.done = True
+                self.ranges[fetch.source] += 1
+                self.rates[fetch.source] = fetch.rate(self.clock())
+            elif not chunk.done and not chunk.fetches:
+                # What the source received before it failed is kept
+                chunk.start = fetch.position
+                self.pending.appendleft(chunk)
+            self.condition.notify_all()
+
+    def others_fetching(self, source: int) -> bool:
+        """Whether a range may still come for source: the file is not assembled and other sources are fetching"""
+        with self.condition:
+            return not self.complete() and any(other != source for other in self.active)
+
+    def wait(self, timeout: float):
+        with self.condition:
+            self.condition.wait(timeout)
+
+    def run_source(self, source: int, client):
+        """
+        Fetch ranges from the server of client over one session until none is left for it.
+        While the other sources are fetching, it keeps its session open with keepalives and
+        checks again for a range to steal.
+        """
+        name = self.sources[source]
+        writer = self.writers[source]
+        client.on_metadata = self.check
+        connected = False
+        fetch = None
+        try:
+            while True:
+                fetch = self.take(source)
+                if fetch is None:
+                    if not self.others_fetching(source):
+                        break
+                    if connected:
+                        if not client.keepalive(SESSION_KEEPALIVE_INTERVAL):
+                            break
+                    else:
+                        self.wait(SESSION_KEEPALIVE_INTERVAL)
+                    continue
+                writer.fetch = fetch
+                client.byte_range = (fetch.start, fetch.chunk.end - fetch.start)
+                if connected:
+                    client.fetch(client.output_file, keep_open=True, file=writer)
+                else:
+                    client.connect()
+                    client.three_way_handshake()
+                    client.listen_file_transfer(keep_open=True)
+                    connected = True
+                refused = client.file_size is None
+                self.finish(fetch)
+                fetch = None
+                if refused:
+                    LOG.error("[Source %s] Range request refused", name)
+                    break
+            if connected:
+                client.closing_connection(client.last_seq_number, client.server_address)
+        except SourceRejected as exc:
+            LOG.error("[Source %s] Not used: %s", name, exc)
+        except OSError as exc:
+            LOG.error("[Source %s] Failed: %s", name, exc)
+        finally:
+            if fetch is not None:
+                self.finish(fetch)
+            client.shutdown()
+            with self.condition:
+                self.running -= 1
+                self.condition.notify_all()
+
+    def run(self, clients: list) -> bool:
+        """
+        Fetch the file with a client per source, each writing to a writer of this fetch, then
+        check the assembled file against the digest.
+        :return: whether the whole file was received and matches its digest
+        """
+        threads = [threading.Thread(target=self.run_source, args=(source, client), daemon=True)
+                   for source, client in enumerate(clients)]
+        self.running = len(threads)
+        for thread in threads:
+            thread.start()
+        with self.condition:
+            self.condition.wait_for(lambda: self.complete() or self.running == 0)
+            complete = self.complete()
+        # Let the idle sources close their sessions, a source still fetching a stolen chunk is left behind
+        deadline = self.clock() + TIMEOUT
+        for source, thread in enumerate(threads):
+            with self.condition:
+                fetching = source in self.active
+            if not fetching:
+                thread.join(max(deadline - self.clock(), 0))
+        with self.write_lock:
+            self.closed = True
+        with self.condition:
+            for fetch in self.active.values():
+                self.received[fetch.source] += fetch.position - fetch.start
+        for source, name in enumerate(self.sources):
+            LOG.info("[Source %s] Received %d bytes in %d ranges", name, self.received[source], self.ranges[source])
+        if not complete:
+            LOG.error("No source could send the rest of the file")
+            return False
+        self.file.flush()
+        self.file.seek(0)
+        digest = hashlib.new(MULTI_SOURCE_DIGEST)
+        for block in iter(lambda: self.file.read(1048576), b""):
+            digest.update(block)
+        if digest.digest() != self.digest:
+            LOG.error("The assembled file does not match the %s digest of the servers", MULTI_SOURCE_DIGEST)
+            return False
+        LOG.log(SUCCESS, "Assembled %d bytes from %d sources, %s digest verified", self.size,
+                len(self.sources), MULTI_SOURCE_DIGEST)
+        return True
@@ -0,0 +1,131 @@
+"""
+pacing.py is a module to spread the segments of the sender over time.
+Sending a whole window back to back overflows the socket buffer of the receiver and the
+queues on the way; a Pacer instead holds every segment until its token bucket has tokens,
+so the segments leave at the bucket rate after an initial burst. The send scheduler of the
+server (lib/scheduler.py) asks the pacer of each connection when it can send.
+
+The rate of a connection can be capped, derived from the window and the smoothed RTT
+(window / RTT, the rate the window would be sent at if it was spread over one RTT), and
+shared with the other connections through a global bucket. When the receiver reports
+that its kernel dropped datagrams, the rate is cut and regained slowly over the next
+RTT samples; a connection without pacing then starts pacing at window / RTT.
+"""
+from lib.constants import PACING_GAIN, PACING_DROP_BACKOFF, PACING_RECOVERY, PACING_MIN_SCALE
+
+
+class TokenBucket:
+    """Token bucket filling with rate bytes per second, holding at most burst bytes"""
+
+    def __init__(self, rate: float, burst: float, clock) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.last = clock.monotonic()
+
+    def refill(self):
+        """Add the tokens earned since the last refill"""
+        now = self.clock.monotonic()
+        self.tokens = min(self.tokens + (now - self.last) * self.rate, self.burst)
+        self.last = now
+
+    def reserve(self, size: int) -> float:
+        """
+        Take size bytes of tokens, going into debt when there are not enough.
+        :return: the seconds to wait until the debt is paid, 0 when the tokens were there
+        """
+        self.refill()
+        self.tokens -= size
+        return self.delay()
+
+    def delay(self) -> float:
+        """Seconds until the debt of the bucket is paid, 0 when it has tokens"""
+        self.refill()
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class Pacer:
+    """Paces the segments sent on one connection"""
+
+    def __init__(self, clock, rate: float = 0.0, burst: float = 0.0, shared: TokenBucket = None,
+                 auto: bool = False, window_bytes: int = 0) -> None:
+        """
+        :param clock: the clock to read the time from
+        :param rate: the rate cap of the connection in bytes per second, 0 for no cap
+        :param burst: the bytes that can be sent back to back
+        :param shared: the bucket shared by every connection, None when there is no global cap
+        :param auto: also pace at the window size divided by the smoothed RTT
+        :param window_bytes: the bytes of a full window, for auto
+        """
+        self.clock = clock
+        self.burst = burst
+        self.shared = shared
+        self.auto = auto
+        self.window_bytes = window_bytes
+        self.cap = rate
+        self.srtt = None
+        # Factor of the rate, lowered when the receiver drops datagrams
+        self.scale = 1.0
+        self.backoff_at = None
+        self.bucket = TokenBucket(rate, burst, clock) if rate else None
+
+    @property
+    def enabled(self) -> bool:
+        return self.bucket is not None or self.shared is not None or self.auto
+
+    def on_rtt(self, rtt: float):
+        """Update the smoothed RTT, and the rate derived from it when auto is set"""
+        self.srtt = rtt if self.srtt is None else 0.875 * self.srtt + 0.125 * rtt
+        if self.scale < 1.0:
+            self.scale = min(self.scale + PACING_RECOVERY, 1.0)
+        self.update_rate()
+
+    def on_drops(self, drops: int) -> bool:
+        """
+        Slow down after the receiver reported drops new datagrams dropped by its kernel,
+        at most once per smoothed RTT since the drops of one burst are reported several times.
+        :return: whether the rate was lowered
+        """
+        now = self.clock.monotonic()
+        if self.backoff_at is not None and self.srtt is not None and now - self.backoff_at < self.srtt:
+            return False
+        self.backoff_at = now
+        self.scale = max(self.scale * PACING_DROP_BACKOFF, PACING_MIN_SCALE)
+        if not self.enabled:
+            self.auto = True
+        self.update_rate()
+        return self.bucket is not None
+
+    def update_rate(self):
+        """Set the rate of the bucket from the cap, the smoothed RTT and the scale"""
+        rate = self.cap
+        if self.auto and self.srtt:
+            rate = PACING_GAIN * self.window_bytes / self.srtt
+            if self.cap:
+                rate = min(rate, self.cap)
+        if not rate:
+            return
+        rate *= self.scale
+        if self.bucket is None:
+            self.bucket = TokenBucket(rate, self.burst, self.clock)
+        else:
+            self.bucket.rate = rate
+
+    def delay(self) -> float:
+        """Seconds until a segment can be sent, 0 when it can be sent now"""
+        wait = 0.0
+        if self.bucket is not None:
+            wait = self.bucket.delay()
+        if self.shared is not None:
+            wait = max(wait, self.shared.delay())
+        return wait
+
+    def take(self, size: int):
+        """Take the tokens of a segment of size bytes sent now, going into debt when there are not enough"""
+        if self.bucket is not None:
+            self.bucket.reserve(size)
+        if self.shared is not None:
+            self.shared.reserve(size)
@@ -5,13 +5,377 @@ For client the format is python3 client.py [client_port] [broadcast_port] [path
 """
 
 import argparse
+import ipaddress
+import os
+from lib.constants import (
+    CONNECTION_TABLE_SIZE, CONNECTION_IDLE_TIMEOUT, HALF_OPEN_LIMIT, HALF_OPEN_TIMEOUT, SCHEDULER_QUANTUM,
+    FEC_MAX_GROUP, SEGMENT_CACHE_BUDGET, SEGMENT_CACHE_READ_AHEAD, RECEIVE_BUFFER, SOCKET_RCVBUF, SOCKET_SNDBUF,
+    PACING_BURST_SEGMENTS, SESSION_IDLE_TIMEOUT, LINGER, MULTI_SOURCE_CHUNK, TRACE_RING, DAEMON_MAX_CLIENTS,
+    DAEMON_WORKERS, PROFILE_ENV, LOG_LEVEL, METRICS_FORMATS, SEGMENT_SIZE, HEADER_SIZE, MAX_SEGMENT_SIZE,
+    WINDOW_SIZE
+)
+from lib.fec import PARITY_OPTIONS_SIZE
+from lib.logger import LOG_LEVELS
+from lib.rto import RTO_POLICIES
 
 
-def parse_args(is_server: bool = False):
+def add_logging_args(parser: argparse.ArgumentParser):
+    """
+    Add the logging options shared by the server and client.
+    :param parser: the parser to add the options to
+    """
+    parser.add_argument(
+        "--log-level",
+        type=str.upper,
+        choices=LOG_LEVELS,
+        default=LOG_LEVEL,
+        help="The minimum level of the messages to print, per-segment messages are DEBUG"
+    )
+    parser.add_argument(
+        "-q",
+        "--quiet",
+        dest="log_level",
+        action="store_const",
+        const="WARNING",
+        help="Only print warnings and errors"
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        dest="log_level",
+        action="store_const",
+        const="DEBUG",
+        help="Print every segment sent and received"
+    )
+
+
+def add_metrics_args(parser: argparse.ArgumentParser):
+    """
+    Add the metrics export options shared by the server and client.
+    :param parser: the parser to add the options to
+    """
+    parser.add_argument(
+        "--metrics-out",
+        type=str,
+        help="Write the connection metrics to this file at exit and on SIGUSR1, - for stdout"
+    )
+    parser.add_argument(
+        "--metrics-format",
+        choices=METRICS_FORMATS,
+        default=METRICS_FORMATS[0],
+        help="The format of the exported metrics"
+    )
+
+
+def add_profiling_args(parser: argparse.ArgumentParser):
+    """
+    Add the profiling options shared by the server and client.
+    :param parser: the parser to add the options to
+    """
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=bool(os.environ.get(PROFILE_ENV)),
+        help=f"Time the hot-path stages and print a breakdown at exit, also enabled by setting {PROFILE_ENV}"
+    )
+    parser.add_argument(
+        "--profile-out",
+        type=str,
+        help="Write the stage breakdown to this JSON file instead of printing it"
+    )
+    parser.add_argument(
+        "--cprofile",
+        type=str,
+        help="Also run under cProfile and dump its statistics to this file, - to print them"
+    )
+
+
+def add_trace_args(parser: argparse.ArgumentParser):
+    """
+    Add the datagram trace options shared by the server and client.
+    :param parser: the parser to add the options to
+    """
+    parser.add_argument(
+        "--trace",
+        type=str,
+        help="Record the header of every datagram sent and received to this binary file, read by analyze_trace.py"
+    )
+    parser.add_argument(
+        "--trace-ring",
+        type=int,
+        default=TRACE_RING,
+        help="Only keep the last this many datagrams in memory and write them to --trace at exit "
+             "or on SIGUSR2, 0 to write every datagram as it comes"
+    )
+
+
+def add_pacing_args(parser: argparse.ArgumentParser):
+    """
+    Add the options pacing the segments sent by the server.
+    :param parser: the parser to add the options to
+    """
+    parser.add_argument(
+        "--pacing-rate",
+        type=float,
+        default=0.0,
+        help="The maximum rate of each connection in bytes per second, 0 for no limit"
+    )
+    parser.add_argument(
+        "--global-rate",
+        type=float,
+        default=0.0,
+        help="The maximum rate of all the connections together in bytes per second, 0 for no limit"
+    )
+    parser.add_argument(
+        "--pacing-auto",
+        action="store_true",
+        help="Pace each connection at its window size divided by its smoothed RTT"
+    )
+    parser.add_argument(
+        "--pacing-burst",
+        type=positive_int,
+        default=PACING_BURST_SEGMENTS,
+        help="The number of segments that can be sent back to back when pacing"
+    )
+
+
+def add_scheduler_args(parser: argparse.ArgumentParser):
+    """
+    Add the options of the scheduler sharing the sending among the clients served at once.
+    :param parser: the parser to add the options to
+    """
+    parser.add_argument(
+        "--quantum",
+        type=positive_int,
+        default=SCHEDULER_QUANTUM,
+        help="The bytes each transfer sends per round of the send scheduler, times its priority"
+    )
+    parser.add_argument(
+        "--priority",
+        type=network_value,
+        action="append",
+        default=[],
+        help="A network and the weight of its clients in the send scheduler, like 10.0.0.0/8=4, "
+             "can be repeated; the other clients have weight 1"
+    )
+    parser.add_argument(
+        "--client-rate",
+        type=network_value,
+        action="append",
+        default=[],
+        help="A network and the rate cap of each of its clients in bytes per second, like 10.0.0.0/8=1000000, "
+             "can be repeated; the other clients are capped by --pacing-rate"
+    )
+
+
+def add_connection_table_args(parser: argparse.ArgumentParser):
+    """
+    Add the options of the table of the clients the server keeps state for.
+    :param parser: the parser to add the options to
+    """
+    parser.add_argument(
+        "--max-connections",
+        type=int,
+        default=CONNECTION_TABLE_SIZE,
+        help="The maximum number of clients the server keeps state for, the least recently heard "
+             "from one not being served is evicted past it"
+    )
+    parser.add_argument(
+        "--max-half-open",
+        type=int,
+        default=HALF_OPEN_LIMIT,
+        help="The maximum number of clients whose handshake is not done, the next connection "
+             "requests get a SYN cookie and no state until they complete the handshake; 0 to always send cookies"
+    )
+    parser.add_argument(
+        "--half-open-timeout",
+        type=float,
+        default=HALF_OPEN_TIMEOUT,
+        help="Seconds the server waits for a client to complete its handshake before giving it up"
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=CONNECTION_IDLE_TIMEOUT,
+        help="Seconds a connected client waiting to be served is kept without hearing from it"
+    )
+
+
+def add_cache_args(parser: argparse.ArgumentParser):
+    """
+    Add the options of the segment cache shared by the connections of the server.
+    :param parser: the parser to add the options to
+    """
+    parser.add_argument(
+        "--cache-size",
+        type=non_negative,
+        default=SEGMENT_CACHE_BUDGET,
+        help="The bytes of encoded segments kept in memory for all the clients, 0 to read every send from disk"
+    )
+    parser.add_argument(
+        "--read-ahead",
+        type=positive_int,
+        default=SEGMENT_CACHE_READ_AHEAD,
+        help="The number of segments read at once while a file is read in order"
+    )
+
+
+def add_socket_args(parser: argparse.ArgumentParser):
+    """
+    Add the socket buffer options shared by the server and client.
+    :param parser: the parser to add the options to
+    """
+    parser.add_argument(
+        "--rcvbuf",
+        type=int,
+        default=SOCKET_RCVBUF,
+        help="The size of the socket receive buffer in bytes, 0 for the kernel default"
+    )
+    parser.add_argument(
+        "--sndbuf",
+        type=int,
+        default=SOCKET_SNDBUF,
+        help="The size of the socket send buffer in bytes, 0 for the kernel default"
+    )
+
+
+def add_daemon_args(parser: argparse.ArgumentParser):
+    """
+    Add the options of the server daemon mode.
+    :param parser: the parser to add the options to
+    """
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep running and serve the files clients ask for from the path_file directory"
+    )
+    parser.add_argument(
+        "--max-clients",
+        type=positive_int,
+        default=DAEMON_MAX_CLIENTS,
+        help="The maximum number of clients served at once by the daemon, the next requests wait for a free slot"
+    )
+    parser.add_argument(
+        "--allow",
+        type=str,
+        action="append",
+        default=[],
+        help="A network (like 10.0.0.0/8) the daemon accepts clients from, can be repeated, any when not given"
+    )
+    parser.add_argument(
+        "--workers",
+        type=positive_int,
+        default=DAEMON_WORKERS,
+        help="The number of daemon processes sharing the port with SO_REUSEPORT, each serving its own clients"
+    )
+
+
+def segment_size(value: str) -> int:
+    """Argument type of a segment size, which has to fit a header and a UDP datagram"""
+    size = int(value)
+    if not HEADER_SIZE < size <= MAX_SEGMENT_SIZE:
+        raise argparse.ArgumentTypeError(
+            f"segment size has to be between {HEADER_SIZE + 1} and {MAX_SEGMENT_SIZE}"
+        )
+    return size
+
+
+def positive_int(value: str) -> int:
+    """Argument type of a count that has to be at least 1"""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected an integer: {value}")
+    if number <= 0:
+        raise argparse.ArgumentTypeError("the value has to be positive")
+    return number
+
+
+def non_negative(value: str) -> int:
+    """Argument type of a count that may be 0"""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected an integer: {value}")
+    if number < 0:
+        raise argparse.ArgumentTypeError("the value cannot be negative")
+    return number
+
+
+def network_value(value: str) -> tuple:
+    """Argument type of a NETWORK=VALUE pair, like 10.0.0.0/8=4, with a positive value"""
+    network, _, number = value.partition("=")
+    try:
+        pair = (ipaddress.ip_network(network, strict=False), float(number))
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(f"expected NETWORK=VALUE, like 10.0.0.0/8=4: {exc}")
+    if pair[1] <= 0:
+        raise argparse.ArgumentTypeError("the value of a network has to be positive")
+    return pair
+
+
+def source_address(value: str) -> tuple:
+    """Argument type of a HOST:PORT server address, like 10.0.0.2:9999, [::1]:9999 or unix:/tmp/udp:9999"""
+    host, _, port = value.rpartition(":")
+    if not host or not port.isdigit():
+        raise argparse.ArgumentTypeError(f"expected HOST:PORT, like 10.0.0.2:9999: {value}")
+    return host, int(port)
+
+
+def chunk_size(value: str) -> int:
+    """Argument type of the bytes of the ranges of a multi-source fetch"""
+    size = int(value)
+    if size <= 0:
+        raise argparse.ArgumentTypeError("the ranges have to hold at least one byte")
+    return size
+
+
+def add_sources_args(parser: argparse.ArgumentParser):
+    """
+    Add the options fetching the file from several servers at once.
+    :param parser: the parser to add the options to
+    """
+    parser.add_argument(
+        "--sources",
+        type=source_address,
+        nargs="+",
+        default=[],
+        help="More servers to fetch path_file from at the same time as server_ip, as HOST:PORT. "
+             "The file is split into ranges the servers take as they go; the client binds client_port "
+             "for the first server and the ports after it for the others"
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=chunk_size,
+        default=MULTI_SOURCE_CHUNK,
+        help="The bytes of the ranges a file fetched with --sources is split into"
+    )
+
+
+def add_loss_args(parser: argparse.ArgumentParser):
+    """
+    Add the options to drop sent datagrams on purpose, used to test and benchmark retransmission.
+    :param parser: the parser to add the options to
+    """
+    parser.add_argument(
+        "--loss-rate",
+        type=float,
+        default=0.0,
+        help="The fraction of the sent datagrams to drop on purpose"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        help="The seed of the random datagram drops"
+    )
+
+
+def parse_args(is_server: bool = False, argv: list = None):
     """
     Parse the argument when running the server or client.
     :param is_server: whether the program is a server or client
-    :return: the port(s) and path file
+    :param argv: the arguments to parse, sys.argv when None
+    :return: the parsed arguments, holding the port(s), path file and options
     """
     if is_server:
         parser = argparse.ArgumentParser(
@@ -25,17 +389,79 @@ def parse_args(is_server: bool = False):
         parser.add_argument(
             "path_file",
             type=str,
-            help="The path to the file to be sent"
+            help="The path to the file to be sent, or of the directory to serve with --daemon"
         )
         parser.add_argument(
             "server_ip",
             type=str,
-            help="The ip address of the server",
+            help="The ip address of the server, an IPv6 one for UDP over IPv6, or unix:DIR or mem:NAME for another transport",
             const="127.0.0.1",
             nargs="?"
         )
-        args = parser.parse_args()
-        return args.broadcast_port, args.path_file, args.server_ip
+        parser.add_argument(
+            "--segment-size",
+            type=segment_size,
+            default=SEGMENT_SIZE,
+            help="The size of the segments sent, header included"
+        )
+        parser.add_argument(
+            "--window-size",
+            type=positive_int,
+            default=WINDOW_SIZE,
+            help="The number of segments sent before waiting for their ACK"
+        )
+        parser.add_argument(
+            "--rto",
+            choices=list(RTO_POLICIES),
+            default="fixed",
+            help="How long to wait for an ACK: a fixed timeout or one adapted to the measured RTT"
+        )
+        parser.add_argument(
+            "--clients",
+            type=int,
+            help="Start the transfer once this many clients connected, without prompting"
+        )
+        parser.add_argument(
+            "--no-fast-open",
+            dest="fast_open",
+            action="store_false",
+            help="Always use the full handshake, even with clients asking for a fast open"
+        )
+        parser.add_argument(
+            "--fec",
+            type=non_negative,
+            default=0,
+            help="Send an XOR parity segment after every group of this many data segments, "
+                 "to clients that accept it; 0 for no forward error correction"
+        )
+        add_pacing_args(parser)
+        add_scheduler_args(parser)
+        parser.add_argument(
+            "--session-idle",
+            type=float,
+            default=SESSION_IDLE_TIMEOUT,
+            help="Seconds a client session can stay idle, sending keepalives, before it is closed"
+        )
+        parser.add_argument(
+            "--linger",
+            type=float,
+            default=LINGER,
+            help="Seconds a closed connection lingers to acknowledge the FIN-ACK of its client again"
+        )
+        add_daemon_args(parser)
+        add_connection_table_args(parser)
+        add_cache_args(parser)
+        add_socket_args(parser)
+        add_loss_args(parser)
+        add_logging_args(parser)
+        add_metrics_args(parser)
+        add_profiling_args(parser)
+        add_trace_args(parser)
+        args = parser.parse_args(argv)
+        # A parity segment carries its options on top of a full payload, and has to fit a UDP datagram
+        if args.fec and args.segment_size + PARITY_OPTIONS_SIZE > MAX_SEGMENT_SIZE:
+            parser.error(f"--fec needs a --segment-size of at most {MAX_SEGMENT_SIZE - PARITY_OPTIONS_SIZE}")
+        return args
 
     parser = argparse.ArgumentParser(
         description="Client for the file transfer application using UDP"
@@ -58,19 +484,58 @@ def parse_args(is_server: bool = False):
     parser.add_argument(
         "server_ip",
         type=str,
-        help="The ip address of the server",
+        help="The ip address of the server, an IPv6 one for UDP over IPv6, or unix:DIR or mem:NAME for another transport",
         const="127.0.0.1",
         nargs="?"
     )
     parser.add_argument(
         "client_ip",
         type=str,
-        help="The ip address of the client",
+        help="The ip address of the client, on the transport of the server: 127.0.0.1 by default, :: for an IPv6 server and the host of the server for the other transports",
         const="127.0.0.1",
         nargs="?"
     )
-    args = parser.parse_args()
-    return args.client_port, args.broadcast_port, args.path_file, args.server_ip, args.client_ip
+    parser.add_argument(
+        "--session",
+        type=str,
+        nargs="+",
+        default=[],
+        help="More files to fetch after path_file over the same connection"
+    )
+    parser.add_argument(
+        "--pause",
+        type=float,
+        default=0.0,
+        help="Seconds to keep the session idle with keepalives before each request of --session"
+    )
+    parser.add_argument(
+        "--no-fast-open",
+        dest="fast_open",
+        action="store_false",
+        help="Do not ask the server to send the metadata and first window with its SYN"
+    )
+    parser.add_argument(
+        "--fec",
+        type=non_negative,
+        default=FEC_MAX_GROUP,
+        help="The largest group of data segments the server can send one parity segment for, "
+             "0 to refuse forward error correction"
+    )
+    parser.add_argument(
+        "--receive-buffer",
+        type=int,
+        default=RECEIVE_BUFFER,
+        help="The bytes of received data held while they are written to disk, advertised to the "
+             "server as the receive window; 0 writes synchronously and advertises no window"
+    )
+    add_sources_args(parser)
+    add_socket_args(parser)
+    add_loss_args(parser)
+    add_logging_args(parser)
+    add_metrics_args(parser)
+    add_profiling_args(parser)
+    add_trace_args(parser)
+    return parser.parse_args(argv)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,77 @@
+"""
+parserProxy.py is a module to parse the argument when running the impairment proxy.
+The format is python3 proxy.py [listen_port] [server_port] [server_ip] [listen_ip].
+"""
+
+import argparse
+from lib.parser import add_logging_args
+
+
+def parse_args_proxy(argv: list = None):
+    """
+    Parse the argument when running the impairment proxy.
+    :param argv: the arguments to parse, sys.argv when None
+    :return: the parsed arguments, holding the ports, addresses and impairments
+    """
+    parser = argparse.ArgumentParser(
+        description="UDP relay that injects loss, delay, reordering, duplication and corruption "
+                    "between the clients and the server"
+    )
+    parser.add_argument(
+        "listen_port",
+        type=int,
+        help="The port the clients send to instead of the server broadcast port"
+    )
+    parser.add_argument(
+        "server_port",
+        type=int,
+        help="The broadcast port of the server"
+    )
+    parser.add_argument(
+        "server_ip",
+        type=str,
+        help="The ip address of the server",
+        default="127.0.0.1",
+        nargs="?"
+    )
+    parser.add_argument(
+        "listen_ip",
+        type=str,
+        help="The ip address the proxy listens on",
+        default="127.0.0.1",
+        nargs="?"
+    )
+    parser.add_argument("--loss", type=float, default=0.0,
+                        help="The probability of dropping a datagram")
+    parser.add_argument("--burst-enter", type=float, default=0.0,
+                        help="The probability of entering a loss burst (Gilbert-Elliott model)")
+    parser.add_argument("--burst-exit", type=float, default=0.5,
+                        help="The probability of leaving a loss burst")
+    parser.add_argument("--burst-loss", type=float, default=1.0,
+                        help="The probability of dropping a datagram during a loss burst")
+    parser.add_argument("--delay", type=float, default=0.0,
+                        help="The one-way delay in milliseconds")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="The maximum variation of the delay in milliseconds")
+    parser.add_argument("--reorder", type=float, default=0.0,
+                        help="The probability of holding a datagram back so it is reordered")
+    parser.add_argument("--reorder-delay", type=float, default=10.0,
+                        help="How long reordered datagrams are held back in milliseconds")
+    parser.add_argument("--duplicate", type=float, default=0.0,
+                        help="The probability of sending a datagram twice")
+    parser.add_argument("--corrupt", type=float, default=0.0,
+                        help="The probability of flipping one byte of a datagram")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="The link rate in bytes per second, 0 for no limit")
+    parser.add_argument("--queue-limit", type=int,
+                        help="The bytes queued on a rate limited link before datagrams are dropped")
+    parser.add_argument("--direction", choices=["both", "to-server", "to-client"], default="both",
+                        help="The direction of the traffic to impair")
+    parser.add_argument("--seed", type=int,
+                        help="The seed of the random impairments, for reproducible runs")
+    add_logging_args(parser)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    print(parse_args_proxy())
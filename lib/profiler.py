@@ -0,0 +1,179 @@
+"""
+profiler.py is a module to find where the time of a transfer goes.
+When enabled, the hot-path functions (crc16, Segment encoding and decoding, Connection
+send and receive) and the file reads and writes are replaced by wrappers adding their
+duration to a per-stage accumulator. Nothing is wrapped until the profiler is enabled,
+so it costs nothing when it is off.
+
+The stages are inclusive: crc16 also counts in segment_encode and checksum_verify, and the
+file reads and encoding of the segments read on a cache miss count in segment_cache.
+Receives that end with a timeout count in receive_timeout instead of receive.
+"""
+import atexit
+import cProfile
+import functools
+import importlib
+import inspect
+import json
+import pstats
+import sys
+import time
+from typing import Dict, List
+from lib.logger import get_logger
+
+LOG = get_logger("profiler")
+
+# (module, attribute, stage) of the functions timed by the profiler
+HOT_PATHS = [
+    ("lib.segment", "crc16", "crc16"),
+    # The metadata checksum of a split file
+    ("lib.sent_file", "crc16", "crc16"),
+    ("lib.segment", "Segment.to_bytes", "segment_encode"),
+    ("lib.segment", "SegmentTemplate.encode", "segment_encode"),
+    ("lib.segment", "Segment.parse", "segment_decode"),
+    ("lib.segment", "Segment.is_valid", "checksum_verify"),
+    ("lib.segment_cache", "SegmentCache.get", "segment_cache"),
+    ("lib.connection", "Connection.send", "send"),
+    ("lib.connection", "Connection.receive", "receive"),
+]
+CPROFILE_TOP = 25
+
+
+class Stage:
+    """Number of calls and total duration of one stage"""
+
+    __slots__ = ("calls", "seconds")
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.seconds = 0.0
+
+
+class ProfiledFile:
+    """File wrapper timing read and write, every other attribute goes to the file"""
+
+    def __init__(self, file, profiler: "Profiler") -> None:
+        self._file = file
+        self.read = profiler.wrap(file.read, "file_read")
+        self.write = profiler.wrap(file.write, "file_write")
+
+    def __getattr__(self, name: str):
+        return getattr(self._file, name)
+
+
+class Profiler:
+    """Per-stage timing of the hot path, and optionally a cProfile of the whole process"""
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.stages: Dict[str, Stage] = {}
+        self.started = None
+        self.profile = None
+        self.instrumented = set()
+
+    def stage(self, name: str) -> Stage:
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = Stage()
+        return stage
+
+    def wrap(self, func, name: str):
+        """Return func timed under the stage name"""
+        stage = self.stage(name)
+        timeout_stage = self.stage(f"{name}_timeout")
+        clock = time.perf_counter
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                result = func(*args, **kwargs)
+            except TimeoutError:
+                timeout_stage.calls += 1
+                timeout_stage.seconds += clock() - start
+                raise
+            stage.calls += 1
+            stage.seconds += clock() - start
+            return result
+
+        return timed
+
+    def instrument(self, owner, attribute: str, name: str):
+        """Replace owner.attribute (a function, method, classmethod or staticmethod) by its timed version"""
+        key = (id(owner), attribute)
+        if key in self.instrumented:
+            return
+        self.instrumented.add(key)
+        original = inspect.getattr_static(owner, attribute)
+        if isinstance(original, classmethod):
+            timed = classmethod(self.wrap(original.__func__, name))
+        elif isinstance(original, staticmethod):
+            timed = staticmethod(self.wrap(original.__func__, name))
+        else:
+            timed = self.wrap(original, name)
+        setattr(owner, attribute, timed)
+
+    def wrap_file(self, file):
+        """Return file with its reads and writes timed, or file itself when the profiler is off"""
+        if not self.enabled:
+            return file
+        return ProfiledFile(file, self)
+
+    def enable(self, out: str = None, cprofile: str = None):
+        """
+        Start timing the hot path, and report the stages when the process exits.
+        :param out: the JSON file to write the stages to, logged when None
+        :param cprofile: the file to dump the cProfile statistics to, - to print them, no cProfile when None
+        """
+        if not self.enabled:
+            self.enabled = True
+            self.started = time.perf_counter()
+            for module, path, name in HOT_PATHS:
+                owner = importlib.import_module(module)
+                *parents, attribute = path.split(".")
+                for parent in parents:
+                    owner = getattr(owner, parent)
+                self.instrument(owner, attribute, name)
+            atexit.register(self.report, out)
+        if cprofile is not None and self.profile is None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+            atexit.register(self.dump_cprofile, cprofile)
+
+    def breakdown(self) -> List[dict]:
+        """The stages that were called, slowest first"""
+        wall = time.perf_counter() - self.started if self.started is not None else 0.0
+        rows = [
+            {
+                "stage": name,
+                "calls": stage.calls,
+                "seconds": stage.seconds,
+                "mean_us": stage.seconds / stage.calls * 1e6,
+                "wall_fraction": stage.seconds / wall if wall else 0.0,
+            }
+            for name, stage in self.stages.items() if stage.calls
+        ]
+        return sorted(rows, key=lambda row: row["seconds"], reverse=True)
+
+    def report(self, out: str = None):
+        """Log the per-stage breakdown, or write it as JSON to out"""
+        rows = self.breakdown()
+        if out is not None:
+            with open(out, "w") as file:
+                json.dump(rows, file, indent=2)
+            return
+        LOG.info("Profile (%.3f s since start):", time.perf_counter() - self.started)
+        for row in rows:
+            LOG.info("%-16s %8d calls %10.4f s %10.1f us/call %6.1f%%", row["stage"], row["calls"],
+                     row["seconds"], row["mean_us"], row["wall_fraction"] * 100)
+
+    def dump_cprofile(self, out: str):
+        """Stop the cProfile and dump its statistics to out, or print them when out is -"""
+        self.profile.disable()
+        if out == "-":
+            pstats.Stats(self.profile, stream=sys.stdout).sort_stats("cumulative").print_stats(CPROFILE_TOP)
+        else:
+            self.profile.dump_stats(out)
+
+
+PROFILER = Profiler()
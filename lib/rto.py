@@ -0,0 +1,57 @@
+"""
+rto.py is a module for the retransmission timeout (RTO) policies of the sender.
+The sender asks the policy how long to wait for an ACK, and reports every RTT sample
+and every timeout back to it.
+"""
+from lib.constants import TIMEOUT, RTO_INITIAL, RTO_MIN, RTO_MAX, RTO_CLOCK_GRANULARITY
+
+
+class FixedRTO:
+    """Always wait the same time for an ACK"""
+
+    def __init__(self, timeout: float = TIMEOUT) -> None:
+        self.rto = timeout
+
+    def timeout(self) -> float:
+        return self.rto
+
+    def on_sample(self, rtt: float):
+        pass
+
+    def on_timeout(self):
+        pass
+
+
+class AdaptiveRTO:
+    """RTO estimated from the smoothed RTT and its variation, as in RFC 6298"""
+
+    def __init__(self, initial: float = RTO_INITIAL, minimum: float = RTO_MIN, maximum: float = RTO_MAX) -> None:
+        self.rto = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.srtt = None
+        self.rttvar = None
+
+    def timeout(self) -> float:
+        return self.rto
+
+    def on_sample(self, rtt: float):
+        """Update the estimate with an RTT sample of a segment that was not retransmitted"""
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        rto = self.srtt + max(RTO_CLOCK_GRANULARITY, 4 * self.rttvar)
+        self.rto = min(max(rto, self.minimum), self.maximum)
+
+    def on_timeout(self):
+        """Back off exponentially after a timeout"""
+        self.rto = min(self.rto * 2, self.maximum)
+
+
+RTO_POLICIES = {
+    "fixed": FixedRTO,
+    "adaptive": AdaptiveRTO,
+}
@@ -0,0 +1,163 @@
+"""
+scheduler.py is a module to share the sending of the server among the clients it serves at once.
+Every transfer asks the SendScheduler for a turn before each datagram it sends, and the
+scheduler grants the turns by deficit round robin: the transfers waiting for a turn are
+visited in rounds, each one sending up to a quantum of bytes times its weight before the
+next one. A big transfer then cannot hold back the small ones, and a client with a short
+RTT, which asks for turns more often, gets no more than its share while the others wait.
+
+A transfer whose pacer has no tokens, for its own rate cap or the global rate, sits out the
+rounds until it has, and the scheduler sets a timer for the first one to get them. The
+ClientPolicy gives the weight and the rate cap of each client from the network it is in.
+"""
+import ipaddress
+from collections import deque
+from typing import Dict, Hashable, List, Optional, Tuple
+from lib.pacing import Pacer
+from lib.constants import SCHEDULER_QUANTUM
+
+
+class Flow:
+    """Datagrams of one connection, as seen by the scheduler"""
+    __slots__ = ("pacer", "weight", "deficit", "size")
+
+    def __init__(self, pacer: Optional[Pacer], weight: float) -> None:
+        self.pacer = pacer
+        self.weight = weight
+        # Bytes the flow can still send in its round
+        self.deficit = 0.0
+        # Size of the datagram waiting for a turn, None when the flow is not waiting
+        self.size = None
+
+
+class SendScheduler:
+    """Deficit round robin over the connections of the server waiting to send"""
+
+    def __init__(self, timers, quantum: int = SCHEDULER_QUANTUM) -> None:
+        """
+        :param timers: the TimerWheel the wake up of paced flows is scheduled on
+        :param quantum: the bytes a flow of weight 1 sends per round
+        """
+        self.timers = timers
+        self.quantum = quantum
+        self.flows: Dict[Hashable, Flow] = {}
+        # Flows waiting for a turn, in the order of the round
+        self.active = deque()
+        # Flow that got the last turn, it keeps its place while its deficit lasts
+        self.current = None
+        self.wake = None
+
+    def add(self, key: Hashable, pacer: Optional[Pacer] = None, weight: float = 1.0):
+        """Schedule the datagrams of key, paced by pacer, replacing the pacer and weight it had"""
+        flow = self.flows.get(key)
+        if flow is None:
+            self.flows[key] = Flow(pacer, weight)
+        else:
+            flow.pacer = pacer
+            flow.weight = weight
+
+    def remove(self, key: Hashable):
+        """Stop scheduling key, dropping the turn it waits for"""
+        flow = self.flows.pop(key, None)
+        if flow is not None and flow.size is not None:
+            self.active.remove(key)
+        if self.current == key:
+            self.current = None
+
+    def waiting(self, key: Hashable) -> bool:
+        """Whether key waits for a turn"""
+        flow = self.flows.get(key)
+        return flow is not None and flow.size is not None
+
+    def request(self, key: Hashable, size: int):
+        """Make key wait for a turn to send a datagram of size bytes"""
+        flow = self.flows[key]
+        flow.size = size
+        if key == self.current and flow.deficit >= size:
+            # Its round goes on
+            self.active.appendleft(key)
+        else:
+            self.active.append(key)
+        self.current = None
+
+    def idle(self, key: Hashable):
+        """Note that key has nothing to send, it starts its next round without deficit"""
+        flow = self.flows.get(key)
+        if flow is not None and flow.size is None:
+            flow.deficit = 0.0
+            if self.current == key:
+                self.current = None
+
+    def next(self) -> Optional[Hashable]:
+        """
+        Give the next turn, taking the tokens of the datagram from the pacer of its flow.
+        When every waiting flow is paced, set a timer for the first one to get its tokens.
+        :return: the key of the flow that sends now, None when no flow can
+        """
+        paced = 0
+        while paced < len(self.active):
+            key = self.active[0]
+            flow = self.flows[key]
+            if flow.pacer is not None and flow.pacer.delay() > 0:
+                paced += 1
+                self.active.rotate(-1)
+                continue
+            if flow.deficit < flow.size:
+                flow.deficit += self.quantum * flow.weight
+                if flow.deficit < flow.size:
+                    paced = 0
+                    self.active.rotate(-1)
+                    continue
+            self.active.popleft()
+            flow.deficit -= flow.size
+            if flow.pacer is not None:
+                flow.pacer.take(flow.size)
+            flow.size = None
+            self.current = key
+            return key
+        if self.active:
+            self.schedule_wake(min(self.flows[key].pacer.delay() for key in self.active))
+        return None
+
+    def schedule_wake(self, delay: float):
+        """Make sure a timer fires in delay seconds, at least a tick, so the paced flows get their turn"""
+        deadline = self.timers.now() + max(delay, self.timers.resolution)
+        if self.wake is not None and self.wake.active and self.wake.deadline <= deadline:
+            return
+        self.timers.cancel(self.wake)
+        self.wake = self.timers.schedule_at(deadline, self.woken)
+
+    def woken(self):
+        """Callback of the wake timer, the server asks for the next turn once the timers ran"""
+        self.wake = None
+
+
+class ClientPolicy:
+    """Weight and rate cap of every client, from the most specific network it is in"""
+
+    def __init__(self, priorities: List[Tuple] = None, rates: List[Tuple] = None, rate: float = 0.0) -> None:
+        """
+        :param priorities: the (network, weight) pairs, the weight is 1 in no network
+        :param rates: the (network, rate cap in bytes per second) pairs
+        :param rate: the rate cap in no network, 0 for no cap
+        """
+        self.priorities = priorities or []
+        self.rates = rates or []
+        self.rate = rate
+
+    @staticmethod
+    def lookup(rules: List[Tuple], ip: str, default: float) -> float:
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return default
+        matches = [(network.prefixlen, value) for network, value in rules if address in network]
+        return max(matches)[1] if matches else default
+
+    def weight(self, ip: str) -> float:
+        """Weight of the client, the share of the turns it gets against a client of weight 1"""
+        return self.lookup(self.priorities, ip, 1.0)
+
+    def rate_cap(self, ip: str) -> float:
+        """Rate cap of the client in bytes per second, 0 for no cap"""
+        return self.lookup(self.rates, ip, self.rate)
@@ -2,17 +2,38 @@ import struct
 
 from lib.segment_flag import SegmentFlag
 from lib.crc16 import crc16
+from lib.constants import CRC_INIT, HEADER_SIZE, OPTIONS_FLAG, OPTIONS_VERSION
+
+# seq, ack, flags, options version, checksum
+HEADER = struct.Struct("IIBBH")
+# Length of the options area following the header, without these two bytes
+OPTIONS_LENGTH = struct.Struct("H")
+# Type and length of an option, followed by its value
+OPTION = struct.Struct("BB")
+INT_OPTION = struct.Struct("I")
+# Byte offset and length of OPTION_RANGE
+RANGE_OPTION = struct.Struct("QQ")
+SEQ_ACK = struct.Struct("II")
+CHECKSUM = struct.Struct("H")
+CHECKSUM_OFFSET = 10
 
 class Segment:
     """Class that represent the Segment being transmitted"""
     # -- Private functions --
     def __init__(self):
         """Construct segment"""
-        self.flag = SegmentFlag(0b0)
+        self.flag = SegmentFlag.of(0b0)
         self.seq = 0
         self.ack = 0
         self.checksum = 0
         self.data = ""
+        # Options version of the sender
+        self.version = OPTIONS_VERSION
+        # Option values by type, memoryviews of the received bytes for a received segment
+        self.options = {}
+        # Received options area the checksum covers, None without options
+        self.options_area = None
+        self.malformed = False
 
     def __str__(self):
         """Enable better printout of segments"""
@@ -23,11 +44,13 @@ class Segment:
         output += f"{'-- Flag(ACK) --'}\n{self.flag.ack >> 4}\n"
         output += f"{'-- Flag(FIN) --'}\n{self.flag.fin}\n"
         output += f"{'-- Checksum --'}\n{self.checksum}\n"
+        output += f"{'-- Options --'}\n{sorted(self.options)}\n"
         output += f"{'PayloadSize : '} {len(self.data)}\n"
         return output
 
-    def __calculate_checksum(self) -> int:
-        return crc16(self.data)
+    def __calculate_checksum(self, options_area: bytes = None) -> int:
+        crc = CRC_INIT if options_area is None else crc16(options_area)
+        return crc16(self.data if self.data != "" else b"", crc)
 
     # -- Setters --
     def set_header(self, header: dict):
@@ -43,45 +66,129 @@ class Segment:
     def set_checksum(self, checksum: int):
         self.checksum = checksum
 
+    def set_option(self, kind: int, value: bytes):
+        """Add the option kind to the segment, only send it to a peer with an options version"""
+        self.options[kind] = value
+
+    def set_int_option(self, kind: int, value: int):
+        self.options[kind] = INT_OPTION.pack(value)
+
+    def set_range_option(self, kind: int, offset: int, length: int):
+        self.options[kind] = RANGE_OPTION.pack(offset, length)
+
     # -- Getter --
     def get_payload(self) -> bytes:
         return self.data
-    
+
     def get_flag(self) -> SegmentFlag:
         return self.flag.get_flag()
 
     def get_header(self) -> dict:
         return {"seq": self.seq, "ack": self.ack}
-    
+
+    def get_option(self, kind: int):
+        """Value of the option kind, None when the segment does not have it"""
+        return self.options.get(kind)
+
+    def get_int_option(self, kind: int):
+        value = self.options.get(kind)
+        if value is None or len(value) < INT_OPTION.size:
+            return None
+        return INT_OPTION.unpack_from(value)[0]
+
+    def get_range_option(self, kind: int):
+        """(offset, length) of the range option kind, None when the segment does not have it"""
+        value = self.options.get(kind)
+        if value is None or len(value) < RANGE_OPTION.size:
+            return None
+        return RANGE_OPTION.unpack_from(value)
+
     # -- Byte operations --
+    def parse(self, src: bytes):
+        """
+        Fill this segment from the src byte in place, replacing what it held before, so the
+        receive loops reuse one object instead of building a Segment per datagram.
+        Options are read in place, their values are views of src. Unknown options are
+        kept but have no effect, so peers can add options the others do not know.
+        :return: this segment
+        """
+        self.seq, self.ack, flag, self.version, self.checksum = HEADER.unpack_from(src)
+        self.flag = SegmentFlag.of(flag & ~OPTIONS_FLAG)
+        if self.options:
+            self.options.clear()
+        self.options_area = None
+        self.malformed = False
+        if not flag & OPTIONS_FLAG:
+            self.data = src[HEADER_SIZE:]
+            return self
+        view = memoryview(src)
+        start = HEADER_SIZE + OPTIONS_LENGTH.size
+        end = start + OPTIONS_LENGTH.unpack_from(src, HEADER_SIZE)[0] if len(src) >= start else len(src)
+        if end > len(src):
+            self.malformed = True
+            end = len(src)
+        self.options_area = view[HEADER_SIZE:end]
+        offset = start
+        while offset + OPTION.size <= end:
+            kind, length = OPTION.unpack_from(src, offset)
+            offset += OPTION.size
+            if offset + length > end:
+                self.malformed = True
+                break
+            self.options[kind] = view[offset:offset + length]
+            offset += length
+        self.data = src[end:]
+        return self
+
     @classmethod
     def from_bytes(cls, src: bytes):
-        """Get a Segment object constructed from the src byte."""
-        segment = Segment()
-        segment.seq = struct.unpack("I", src[0:4])[0]
-        segment.ack = struct.unpack("I", src[4:8])[0]
-        segment.flag = SegmentFlag(struct.unpack("B", src[8:9])[0])
-        segment.checksum = struct.unpack("H", src[10:12])[0]
-        segment.data = src[12:]
-        return segment
+        """Get a Segment object constructed from the src byte"""
+        return cls().parse(src)
 
     def to_bytes(self) -> bytes:
         """Convert the Segment object to pure bytes"""
-        self.checksum = self.__calculate_checksum()
-        result = b""
-        result += struct.pack("II", self.seq, self.ack)
-        result += self.flag.to_flag_bytes()
-        result += struct.pack("x")
-        result += struct.pack("H", self.checksum)
+        flag = self.flag.get_flag()
+        data = self.data if self.data != "" else b""
+        if not self.options:
+            self.checksum = self.__calculate_checksum()
+            return HEADER.pack(self.seq, self.ack, flag, self.version, self.checksum) + data
 
-        # handling if data is empty
-        if self.data == "":
-            return result
-
-        result += self.data
-        return result
+        options = b"".join(OPTION.pack(kind, len(value)) + bytes(value) for kind, value in self.options.items())
+        options_area = OPTIONS_LENGTH.pack(len(options)) + options
+        self.checksum = self.__calculate_checksum(options_area)
+        return HEADER.pack(self.seq, self.ack, flag | OPTIONS_FLAG, self.version, self.checksum) + options_area + data
 
     # -- Checksum --
     def is_valid(self) -> bool:
-        """Check whether the Segment object checksum is correct"""
-        return self.__calculate_checksum() == self.checksum
\ No newline at end of file
+        """Check whether the Segment object checksum is correct, options included"""
+        if self.malformed:
+            return False
+        return self.__calculate_checksum(self.options_area) == self.checksum
+
+
+class SegmentTemplate:
+    """
+    Segment without payload encoded once, where only seq, ack and the values of integer
+    options change, for the ACK sent for every received segment
+    """
+
+    def __init__(self, flag_list: list, options: tuple = ()):
+        segment = Segment()
+        segment.set_flag(flag_list)
+        for kind in options:
+            segment.set_int_option(kind, 0)
+        self.buffer = bytearray(segment.to_bytes())
+        self.has_options = bool(options)
+        # Offset of the value of every option, after the area length and the type and length of each option
+        first = HEADER_SIZE + OPTIONS_LENGTH.size + OPTION.size
+        self.offsets = [first + index * (OPTION.size + INT_OPTION.size) for index in range(len(options))]
+
+    def encode(self, seq: int, ack: int, *values) -> bytes:
+        """Get the bytes of the segment with the given seq, ack and option values"""
+        buffer = self.buffer
+        SEQ_ACK.pack_into(buffer, 0, seq, ack)
+        if self.has_options:
+            for offset, value in zip(self.offsets, values):
+                INT_OPTION.pack_into(buffer, offset, value)
+            CHECKSUM.pack_into(buffer, CHECKSUM_OFFSET, crc16(memoryview(buffer)[HEADER_SIZE:]))
+        return bytes(buffer)
@@ -0,0 +1,80 @@
+"""
+segment_cache.py is a module to read and encode every data segment of a file once, however
+many clients it is sent to.
+The SegmentCache of the process holds encoded datagrams keyed by the identity of their file
+and their index in it, up to a byte budget, evicting the least recently used ones first. A
+miss following the previous segment read by the same reader of the file reads the next
+read_ahead segments with it, in a single file read, since a transfer reads its file in order.
+The first miss of a reader does not read ahead, it may only want that segment.
+"""
+from collections import OrderedDict
+from typing import Callable, Hashable, List
+from lib.constants import SEGMENT_CACHE_BUDGET, SEGMENT_CACHE_READ_AHEAD
+
+
+class SegmentCache:
+    """
+    Encoded segments of the files sent by the process, shared by all its connections.
+    A file identity has to change when the content of the file does.
+    """
+
+    def __init__(self, budget: int = SEGMENT_CACHE_BUDGET, read_ahead: int = SEGMENT_CACHE_READ_AHEAD) -> None:
+        self.budget = budget
+        self.read_ahead = read_ahead
+        # (file identity, index) -> encoded datagram, least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        # Index of the last segment read of each (file identity, reader)
+        self.last_index = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def configure(self, budget: int, read_ahead: int):
+        """Change the byte budget and read ahead, evicting segments until the cache fits"""
+        self.budget = budget
+        self.read_ahead = max(read_ahead, 1)
+        self._evict()
+
+    def _evict(self):
+        while self.size > self.budget and self.entries:
+            _, data = self.entries.popitem(last=False)
+            self.size -= len(data)
+            self.evictions += 1
+
+    def get(self, source: Hashable, index: int, load: Callable[[int, int], List[bytes]],
+            reader: Hashable = None) -> bytes:
+        """
+        Get the encoded segment index of the file source.
+        :param load: called on a miss with the first index and the number of segments to read,
+            returns their encoded datagrams, fewer at the end of the file or when it does not read ahead
+        :param reader: who reads the file, each reader is read ahead for on its own
+        """
+        key = (source, index)
+        data = self.entries.get(key)
+        stream = (source, reader)
+        sequential = self.last_index.get(stream) == index - 1
+        self.last_index[stream] = index
+        if data is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return data
+        self.misses += 1
+        # Without a budget, nothing read ahead would be kept
+        loaded = load(index, self.read_ahead if sequential and self.budget else 1)
+        for offset, encoded in enumerate(loaded):
+            loaded_key = (source, index + offset)
+            previous = self.entries.pop(loaded_key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self.entries[loaded_key] = encoded
+            self.size += len(encoded)
+        self._evict()
+        return loaded[0]
+
+    def forget(self, source: Hashable, reader: Hashable = None):
+        """Stop tracking the reads of reader in source, the segments are left to be evicted"""
+        self.last_index.pop((source, reader), None)
+
+
+SEGMENT_CACHE = SegmentCache()
@@ -3,7 +3,13 @@ from lib.constants import ACK_FLAG, FIN_FLAG, SYN_FLAG
 
 
 class SegmentFlag:
-    """Class that represent the syn, ack, and fin flags of the Segment object"""
+    """
+    Class that represent the syn, ack, and fin flags of the Segment object.
+    Flags are never changed once built, so segments share one object per flag value.
+    """
+    # Shared flags by flag value, see of
+    cache = {}
+
     def __init__(self, flag: bytes):
         # Init flag variable from flag byte
         self.syn = flag & SYN_FLAG
@@ -17,6 +23,14 @@ class SegmentFlag:
     def get_flag(self) -> int:
         return self.syn | self.ack | self.fin
 
+    @classmethod
+    def of(cls, flag: int):
+        """Get the shared SegmentFlag of the flag byte, without building a new one per segment"""
+        shared = cls.cache.get(flag)
+        if shared is None:
+            shared = cls.cache[flag] = SegmentFlag(flag)
+        return shared
+
     @classmethod
     def from_flag_list(cls, flag_list: list):
         """Get a SegmentFlag object from the given flag_list"""
@@ -28,4 +42,4 @@ class SegmentFlag:
                 new_flag |= ACK_FLAG
             elif flag == "FIN":
                 new_flag |= FIN_FLAG
-        return SegmentFlag(new_flag)
+        return SegmentFlag.of(new_flag)
@@ -0,0 +1,161 @@
+"""
+sent_file.py is a module for the files the server sends.
+A SentFile is an open file, or the stream of a directory, with the metadata segment
+describing it and its number of segments. Its data segments are read and encoded when
+they are first sent, through the segment cache of the process, so the clients served at
+once share a SentFile and the clients of the same file share its cached segments.
+
+A SentFile can also be a byte range of its file, asked for by a client fetching the file
+from several servers at once: its metadata still describes the whole file, and its data
+segments, numbered from the first data sequence number, only cover the range.
+"""
+import hashlib
+import os
+from math import ceil
+from typing import List, Optional, Tuple
+from lib.constants import METADATA_SEQ, MULTI_SOURCE_DIGEST
+from lib.crc16 import crc16
+from lib.fec import parity_segment
+from lib.logger import get_logger
+from lib.segment import Segment
+
+LOG = get_logger("server")
+
+
+class SentFile:
+    """File or directory sent to clients, split into its metadata segment and data segments"""
+
+    def __init__(self, file, path: str, payload_size: int, byte_range: Optional[Tuple[int, int]] = None,
+                 shared: bool = False) -> None:
+        """
+        :param file: the file handle, or a lib.manifest.DirectoryStream
+        :param path: the path of the file, its name goes in the metadata
+        :param payload_size: the bytes of data per segment
+        :param byte_range: the offset and length of the part of the file sent, None for all of it
+        :param shared: whether the file handle belongs to another SentFile, which closes it
+        """
+        self.file = file
+        self.path = path
+        self.name = path.split("/")[-1]
+        self.payload_size = payload_size
+        self.byte_range = byte_range
+        self.shared = shared
+        self.metadata_segment = None
+        # Metadata and data segments, 0 until split and for a refused request
+        self.segment_count = 0
+        # Bytes of the file the data segments cover, from start to end
+        self.start = self.end = 0
+        # Key of the file in the segment cache
+        self.key = None
+
+    def get_file_size(self):
+        """
+        Return the size of the file
+        """
+        try:
+            position = self.file.tell()
+            size = self.file.seek(0, os.SEEK_END)
+            self.file.seek(position)
+            return size
+        except:
+            LOG.error("Error reading file %s. Aborting.", self.path)
+
+    def split(self):
+        """
+        Split the file into segments: the metadata segment, and the data segments read and
+        encoded through the segment cache when they are first sent.
+        :raise IndexError: when the name of a file has no extension
+        """
+        # SYN : 0
+        # ACK : 1
+        # Metadata : 2
+        # Data : 3 - n
+        # Metadata of a directory : name,,stream size,manifest size
+        metadata_segment = Segment()
+        filesize = self.get_file_size()
+        LOG.info("Filesize : %s bytes", filesize)
+        manifest_size = getattr(self.file, "manifest_size", None)
+        if manifest_size is None:
+            filename = self.name.split(".")[0]
+            extension = self.name.split(".")[1]
+            metadata = filename.encode() + ",".encode() + extension.encode() + \
+                ",".encode() + str(filesize).encode()
+        else:
+            LOG.info("Sending %d files with a %d bytes manifest", len(self.file.manifest), manifest_size)
+            metadata = f"{self.name},,{filesize},{manifest_size}".encode()
+        metadata_segment.set_payload(metadata)
+        metadata_segment.set_header({"seq": METADATA_SEQ, "ack": 0})
+        metadata_segment.set_checksum(crc16(metadata))
+        self.metadata_segment = metadata_segment
+        self.key = self.identity()
+        self.start, self.end = 0, filesize
+        if self.byte_range is not None:
+            offset, length = self.byte_range
+            self.start = min(offset, filesize)
+            self.end = min(offset + length, filesize)
+            # Its segments are numbered from the start of the range
+            self.key = (self.key, "range", self.start)
+            LOG.info("Sending bytes %d to %d", self.start, self.end)
+        self.segment_count = ceil((self.end - self.start) / self.payload_size) + 1
+
+        LOG.info("File splitted into %d segments", self.segment_count)
+
+    def identity(self):
+        """
+        Key of the file in the segment cache: its path, modification time and size, and the
+        payload size, so a changed file is read again. A file without a path gets a new key.
+        """
+        try:
+            stat = os.fstat(self.file.fileno())
+        except (AttributeError, OSError):
+            return object()
+        return (os.path.realpath(self.path), stat.st_mtime_ns, stat.st_size, self.payload_size)
+
+    def read_payloads(self, index: int, count: int) -> List[bytes]:
+        """Read the payloads of the data segments index to index + count - 1 in a single file read"""
+        position = self.start + index * self.payload_size
+        self.file.seek(position)
+        data = self.file.read(min(count * self.payload_size, self.end - position))
+        return [data[i * self.payload_size:(i + 1) * self.payload_size] for i in range(count)]
+
+    def read_segments(self, index: int, count: int) -> List[bytes]:
+        """
+        Read the data segments index to index + count - 1 in a single file read, and return
+        them encoded. Called by the segment cache on a miss.
+        """
+        count = max(min(count, self.segment_count - 1 - index), 1)
+        encoded = []
+        for i, payload in enumerate(self.read_payloads(index, count)):
+            segment = Segment()
+            segment.set_header({"seq": index + i + 3, "ack": 3})
+            segment.set_payload(payload)
+            encoded.append(segment.to_bytes())
+        return encoded
+
+    def read_parity(self, group_size: int, group: int, count: int) -> List[bytes]:
+        """
+        Encode the parity segment of the group-th group of group_size data segments, from their
+        payloads read in a single file read. Called by the segment cache on a miss, never reads ahead.
+        """
+        data_segments = self.segment_count - 1
+        first = group * group_size
+        payloads = self.read_payloads(first, min(group_size, data_segments - first))
+        return [parity_segment(first + 3, payloads).to_bytes()]
+
+    def range(self, byte_range: Tuple[int, int]) -> "SentFile":
+        """The byte range of this file, sharing its file handle"""
+        return SentFile(self.file, self.path, self.payload_size, byte_range, shared=True)
+
+    def digest(self) -> bytes:
+        """Digest of the whole file, read from its start, its position is kept"""
+        digest = hashlib.new(MULTI_SOURCE_DIGEST)
+        position = self.file.tell()
+        self.file.seek(0)
+        for block in iter(lambda: self.file.read(1048576), b""):
+            digest.update(block)
+        self.file.seek(position)
+        return digest.digest()
+
+    def close(self):
+        if not self.shared:
+            self.file.close()
@@ -0,0 +1,262 @@
+"""
+simulation.py is a module to run the server and client on a simulated network.
+The network has a virtual clock and delivers datagrams through an Impairment per link,
+so a transfer with 5 second timeouts finishes in the time it takes to run the code.
+
+Every endpoint of the network runs its protocol code in its own thread, but only one
+thread runs at a time: when the running thread blocks on a receive or a sleep, the
+network moves the clock to the next delivery or deadline and wakes exactly the thread
+it belongs to. Runs are therefore deterministic for a given seed.
+"""
+import heapq
+import itertools
+import threading
+from math import ceil
+from collections import deque
+from socket import timeout
+from typing import Callable, Dict, List, Tuple
+from lib.constants import TIMEOUT
+from lib.impairment import Impairment
+
+INFINITY = float("inf")
+
+
+class SimulationAborted(Exception):
+    """Raised in the endpoints still running when the simulation reaches its time limit"""
+
+
+class SimulatedClock:
+    """Clock of an endpoint, reading the virtual time of its network"""
+
+    def __init__(self, network: "SimulatedNetwork", endpoint: "SimulatedConnection") -> None:
+        self.network = network
+        self.endpoint = endpoint
+
+    def time(self) -> float:
+        return self.network.now
+
+    def monotonic(self) -> float:
+        return self.network.now
+
+    def sleep(self, seconds: float):
+        self.network.wait(self.endpoint, seconds, for_datagram=False)
+
+
+class SimulatedConnection:
+    """Endpoint of a simulated network, with the same interface as lib.connection.Connection"""
+
+    def __init__(self, network: "SimulatedNetwork", ip: str, port: int, broadcast: int) -> None:
+        self.network = network
+        self.ip = ip
+        self.port = port
+        self.broadcast_port = broadcast
+        self.address = (ip, port)
+        self.timeout = TIMEOUT
+        self.clock = SimulatedClock(network, self)
+        self.inbox = deque()
+        self.condition = threading.Condition(network.lock)
+        self.active = False
+        self.blocked = False
+        self.for_datagram = False
+        self.deadline = INFINITY
+
+    def send(self, msg, ip: str, port: int):
+        self.network.send(self, bytes(msg), (ip, port))
+
+    def set_timeout(self, timeout: float):
+        self.timeout = timeout
+
+    def close(self):
+        pass
+
+    def kernel_drops(self) -> int:
+        """Datagrams dropped by the queues of the links into this endpoint, like a full socket buffer"""
+        return sum(link.stats["queue_dropped"] for (_, dst), link in self.network.links.items()
+                   if dst == self.address)
+
+    def listen_segment(self):
+        return self.network.wait(self, self.timeout, for_datagram=True)
+
+    def listen_until(self, timers):
+        if timers.run():
+            return None
+        wait = timers.time_left()
+        try:
+            return self.network.wait(self, self.timeout if wait is None else wait, for_datagram=True)
+        except timeout:
+            timers.run()
+            return None
+
+    def poll(self):
+        with self.network.lock:
+            return self.inbox.popleft() if self.inbox else None
+
+
+class SimulatedDisk:
+    """
+    File written at rate bytes per virtual second behind a buffer of capacity bytes, like a
+    lib.write_behind.WriteBehindFile on a slow disk. A write waits while the buffer is full,
+    so a capacity of 0 models writing synchronously.
+    """
+
+    def __init__(self, file, rate: float, capacity: int, clock) -> None:
+        self.file = file
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.queued = 0.0
+        self.updated = clock.monotonic()
+
+    @property
+    def backlog(self) -> int:
+        now = self.clock.monotonic()
+        self.queued = max(self.queued - (now - self.updated) * self.rate, 0.0)
+        self.updated = now
+        return ceil(self.queued)
+
+    def write(self, data) -> int:
+        overflow = self.backlog + len(data) - self.capacity
+        if overflow > 0:
+            self.clock.sleep(overflow / self.rate)
+        self.queued = self.backlog + len(data)
+        return self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+
+class SimulatedNetwork:
+    """Virtual time network connecting SimulatedConnection endpoints"""
+
+    def __init__(self, link_factory: Callable[[tuple, tuple], Impairment] = None, time_limit: float = INFINITY) -> None:
+        """
+        :param link_factory: builds the Impairment of the link from a source to a destination address
+        :param time_limit: virtual time after which the endpoints still running are aborted
+        """
+        self.lock = threading.Lock()
+        self.now = 0.0
+        self.time_limit = time_limit
+        self.link_factory = link_factory or (lambda src, dst: Impairment())
+        self.links: Dict[Tuple[tuple, tuple], Impairment] = {}
+        self.endpoints: Dict[tuple, SimulatedConnection] = {}
+        # Heap of (delivery time, order, destination, datagram, source)
+        self.events = []
+        self.order = itertools.count()
+        self.aborted = False
+        self.delivered = 0
+
+    def connection(self, ip: str, port: int, broadcast: int = None) -> SimulatedConnection:
+        """Create the endpoint bound to (ip, port), broadcast is only kept for the Connection interface"""
+        endpoint = SimulatedConnection(self, ip, port, port if broadcast is None else broadcast)
+        self.endpoints[endpoint.address] = endpoint
+        return endpoint
+
+    def link(self, src: tuple, dst: tuple) -> Impairment:
+        """Get the impairment of the link from src to dst"""
+        impairment = self.links.get((src, dst))
+        if impairment is None:
+            impairment = self.link_factory(src, dst)
+            self.links[(src, dst)] = impairment
+        return impairment
+
+    def send(self, endpoint: SimulatedConnection, data: bytes, dst: tuple):
+        with self.lock:
+            for deliver_at, datagram in self.link(endpoint.address, dst).process(data, self.now):
+                heapq.heappush(self.events, (deliver_at, next(self.order), dst, datagram, endpoint.address))
+
+    def wait(self, endpoint: SimulatedConnection, seconds: float, for_datagram: bool):
+        """
+        Block endpoint until it receives a datagram (when for_datagram is set) or until
+        the given number of virtual seconds passed, letting the other endpoints run.
+        """
+        with self.lock:
+            deadline = INFINITY if seconds is None else self.now + seconds
+            while True:
+                if self.aborted:
+                    raise SimulationAborted()
+                if for_datagram and endpoint.inbox:
+                    return endpoint.inbox.popleft()
+                if self.now >= deadline:
+                    if for_datagram:
+                        raise timeout("timed out")
+                    return None
+                endpoint.blocked = True
+                endpoint.for_datagram = for_datagram
+                endpoint.deadline = deadline
+                self._dispatch()
+                while endpoint.blocked:
+                    endpoint.condition.wait()
+
+    def _wake(self, endpoint: SimulatedConnection):
+        endpoint.blocked = False
+        endpoint.condition.notify()
+
+    def _dispatch(self):
+        """Advance the clock and wake the next endpoint to run, called with the lock held"""
+        active = [endpoint for endpoint in self.endpoints.values() if endpoint.active]
+        if any(not endpoint.blocked for endpoint in active):
+            return
+        while active:
+            for endpoint in active:
+                if endpoint.for_datagram and endpoint.inbox:
+                    self._wake(endpoint)
+                    return
+
+            next_event = self.events[0][0] if self.events else INFINITY
+            next_deadline = min(endpoint.deadline for endpoint in active)
+            if min(next_event, next_deadline) > self.time_limit:
+                self.aborted = True
+                for endpoint in active:
+                    self._wake(endpoint)
+                return
+
+            if next_event <= next_deadline:
+                deliver_at, _, dst, datagram, src = heapq.heappop(self.events)
+                self.now = max(self.now, deliver_at)
+                target = self.endpoints.get(dst)
+                if target is not None and target.active:
+                    target.inbox.append((datagram, src))
+                    self.delivered += 1
+            else:
+                self.now = max(self.now, next_deadline)
+                for endpoint in active:
+                    if endpoint.deadline == next_deadline:
+                        self._wake(endpoint)
+                        return
+
+    def run(self, tasks: List[Tuple[SimulatedConnection, Callable]]) -> List[BaseException]:
+        """
+        Run every (endpoint, function) task in its own thread until they all return.
+        :return: the exceptions raised by the tasks
+        """
+        errors = []
+        threads = []
+
+        def runner(endpoint: SimulatedConnection, func: Callable):
+            with self.lock:
+                while endpoint.blocked:
+                    endpoint.condition.wait()
+            try:
+                func()
+            except BaseException as exc:  # pylint: disable=broad-except
+                errors.append(exc)
+            finally:
+                with self.lock:
+                    endpoint.active = False
+                    endpoint.blocked = False
+                    self._dispatch()
+
+        with self.lock:
+            for endpoint, func in tasks:
+                # Every task starts blocked with an expired deadline, so they start one by one
+                endpoint.active = True
+                endpoint.blocked = True
+                endpoint.for_datagram = False
+                endpoint.deadline = self.now
+                thread = threading.Thread(target=runner, args=(endpoint, func), daemon=True)
+                threads.append(thread)
+                thread.start()
+            self._dispatch()
+        for thread in threads:
+            thread.join()
+        return errors
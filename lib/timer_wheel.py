@@ -0,0 +1,209 @@
+"""
+timer_wheel.py is a module for the deadlines of the server and client: retransmissions,
+window probes, window updates, keepalives and teardowns.
+A TimerWheel keeps every timer of the process in a hierarchical timing wheel: level 0 has
+one slot per tick, and each level above has slots as long as the whole level below. A
+timer goes into the lowest level its deadline fits in, and moves down one level each
+time the wheel turns past its slot, so scheduling and cancelling take constant time
+whatever the number of timers. Connection.listen_until sleeps until the next deadline
+of the wheel or the next datagram, whichever comes first.
+"""
+import time
+from typing import Callable, List, Optional
+from lib.constants import TIMER_RESOLUTION, TIMER_SLOTS, TIMER_LEVELS
+
+
+class Timer:
+    """Deadline scheduled on a TimerWheel, calling callback(*args) once it passed"""
+    __slots__ = ("deadline", "tick", "callback", "args", "slot", "level")
+
+    def __init__(self, deadline: float, tick: int, callback: Callable, args: tuple) -> None:
+        self.deadline = deadline
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        # Slot holding the timer, None once it fired or was cancelled
+        self.slot = None
+        self.level = 0
+
+    @property
+    def active(self) -> bool:
+        return self.slot is not None
+
+
+class TimerWheel:
+    """
+    Timers of one process, read from clock.monotonic().
+    Timers fire in the order of their deadlines, never before them.
+    """
+
+    def __init__(self, clock=None, resolution: float = TIMER_RESOLUTION,
+                 slots: int = TIMER_SLOTS, levels: int = TIMER_LEVELS) -> None:
+        self.clock = clock
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = levels
+        # Ticks covered by one slot of each level
+        self.spans = [slots ** level for level in range(levels)]
+        self.wheels = [[{} for _ in range(slots)] for _ in range(levels)]
+        # Timers of every level, and the last count for the overflow
+        self.counts = [0] * (levels + 1)
+        self.overflow = {}
+        self.current = int(self.now() // resolution)
+        # Earliest deadline, None when it has to be looked up again
+        self.earliest = None
+
+    def __len__(self) -> int:
+        return sum(self.counts)
+
+    def now(self) -> float:
+        return time.monotonic() if self.clock is None else self.clock.monotonic()
+
+    def _insert(self, timer: Timer):
+        diff = timer.tick - self.current
+        if diff >= self.spans[-1] * self.slots:
+            # Past the last level, moved into it once the wheel gets close enough
+            self.overflow[timer] = None
+            timer.slot = self.overflow
+            timer.level = self.levels
+            self.counts[self.levels] += 1
+            return
+        level = 0
+        if diff <= 0:
+            # Due in the current tick, or already late: the next run fires it
+            tick = self.current
+        else:
+            tick = timer.tick
+            while level + 1 < self.levels and diff >= self.spans[level + 1]:
+                level += 1
+        slot = self.wheels[level][(tick // self.spans[level]) % self.slots]
+        slot[timer] = None
+        timer.slot = slot
+        timer.level = level
+        self.counts[level] += 1
+
+    def schedule(self, delay: float, callback: Callable, *args) -> Timer:
+        """Call callback(*args) in delay seconds"""
+        return self.schedule_at(self.now() + delay, callback, *args)
+
+    def schedule_at(self, deadline: float, callback: Callable, *args) -> Timer:
+        """Call callback(*args) once the monotonic clock reaches deadline"""
+        timer = Timer(deadline, int(deadline // self.resolution), callback, args)
+        self._insert(timer)
+        if self.earliest is not None and deadline < self.earliest:
+            self.earliest = deadline
+        return timer
+
+    def cancel(self, timer: Optional[Timer]):
+        """Stop timer from firing, doing nothing when it already fired or is None"""
+        if timer is None:
+            return
+        # Also keeps a timer due in the current run from firing
+        timer.callback = None
+        if timer.slot is None:
+            return
+        del timer.slot[timer]
+        timer.slot = None
+        self.counts[timer.level] -= 1
+        if timer.deadline == self.earliest:
+            self.earliest = None
+
+    def next_deadline(self) -> Optional[float]:
+        """Earliest deadline of the timers, None when there is no timer"""
+        if self.earliest is not None or not any(self.counts):
+            return self.earliest
+        if self.overflow:
+            self.earliest = min(timer.deadline for timer in self.overflow)
+        for level in range(self.levels):
+            if not self.counts[level]:
+                continue
+            span = self.spans[level]
+            # Slots of a level in the order the wheel reaches them, the first one holding a
+            # timer has the earliest of the level. A lower level can hold later timers, added
+            # after the wheel turned.
+            first = self.current // span + (0 if level == 0 else 1)
+            for offset in range(self.slots):
+                slot = self.wheels[level][(first + offset) % self.slots]
+                if slot:
+                    earliest = min(timer.deadline for timer in slot)
+                    if self.earliest is None or earliest < self.earliest:
+                        self.earliest = earliest
+                    break
+        return self.earliest
+
+    def time_left(self) -> Optional[float]:
+        """Seconds until the next deadline, 0 when it passed, None when there is no timer"""
+        deadline = self.next_deadline()
+        if deadline is None:
+            return None
+        return max(deadline - self.now(), 0.0)
+
+    def _collect(self, now: float, due: List[Timer]):
+        slot = self.wheels[0][self.current % self.slots]
+        if not slot:
+            return
+        for timer in [timer for timer in slot if timer.deadline <= now]:
+            del slot[timer]
+            timer.slot = None
+            self.counts[0] -= 1
+            due.append(timer)
+
+    def _cascade(self):
+        for level in range(self.levels - 1, 0, -1):
+            span = self.spans[level]
+            if self.current % span:
+                continue
+            slot = self.wheels[level][(self.current // span) % self.slots]
+            if not slot:
+                continue
+            timers = list(slot)
+            slot.clear()
+            self.counts[level] -= len(timers)
+            for timer in timers:
+                self._insert(timer)
+        if self.overflow and not self.current % self.spans[-1]:
+            timers = list(self.overflow)
+            self.overflow.clear()
+            self.counts[self.levels] -= len(timers)
+            for timer in timers:
+                self._insert(timer)
+
+    def run(self) -> int:
+        """
+        Fire the timers whose deadline passed, in the order of their deadlines.
+        :return: the number of timers fired
+        """
+        now = self.now()
+        target = int(now // self.resolution)
+        due = []
+        self._collect(now, due)
+        while self.current < target:
+            # Jump to the next tick where a slot fires or moves down a level
+            span = 0
+            for level in range(self.levels):
+                if self.counts[level]:
+                    span = self.spans[level]
+                    break
+            if span:
+                tick = (self.current // span + 1) * span
+            elif self.overflow:
+                # Last level boundary from which the earliest overflow timer fits in the wheel
+                span = self.spans[-1]
+                earliest = min(timer.tick for timer in self.overflow) - span * self.slots + 1
+                tick = max(-(-earliest // span), self.current // span + 1) * span
+            else:
+                self.current = target
+                break
+            self.current = min(tick, target)
+            self._cascade()
+            self._collect(now, due)
+        if not due:
+            return 0
+        self.earliest = None
+        due.sort(key=lambda timer: timer.deadline)
+        fired = 0
+        for timer in due:
+            if timer.callback is not None:
+                timer.callback(*timer.args)
+                fired += 1
+        return fired
@@ -0,0 +1,162 @@
+"""
+trace.py is a module to record the datagrams a Connection sends and receives.
+A TraceRecorder writes one fixed-size binary record per datagram: the time, the direction,
+the peer, and the seq, ack, flags, length and checksum validity of its header. The payload
+is not kept, and the checksum is checked with lib.crc16, computed in C, so tracing a
+transfer costs little. Nothing is recorded unless the Connection is given a recorder.
+
+The records go to the trace file as they come, or with a ring size, only the latest ones
+are kept in memory and written at exit, or when the process receives SIGUSR2. Peers are
+numbered in the order they are first seen, a peer record names each number.
+analyze_trace.py reads the trace back to rebuild the RTT samples, the data in flight, the
+retransmissions and the stalls of every connection.
+"""
+import atexit
+import signal
+import struct
+import time
+from typing import Dict, List, Tuple
+from lib.constants import HEADER_SIZE, TRACE_RING
+from lib.crc16 import crc16
+from lib.logger import get_logger
+from lib.segment import HEADER
+
+LOG = get_logger("trace")
+
+TRACE_MAGIC = b"UDPTRACE"
+TRACE_VERSION = 1
+# magic, version, wall clock time of the start
+FILE_HEADER = struct.Struct("<8sBd")
+# seconds since the start, kind, peer, seq, ack, flags, length, checksum validity
+RECORD = struct.Struct("<dBHIIBIB")
+
+# Kinds of record: a datagram sent, received, or dropped on purpose by the loss rate of the
+# Connection, and the name of a peer, whose length bytes follow the record
+SENT = 0
+RECEIVED = 1
+DROPPED = 2
+PEER = 3
+KINDS = ["sent", "received", "dropped", "peer"]
+
+
+def peer_name(address) -> str:
+    """Name of a peer address in the trace"""
+    if isinstance(address, tuple):
+        return ":".join(str(part) for part in address[:2])
+    return str(address)
+
+
+class TraceRecorder:
+    """Binary trace of the datagrams of a Connection, to a file or a ring buffer"""
+
+    def __init__(self, path: str, ring: int = TRACE_RING, clock=time.monotonic) -> None:
+        """
+        :param path: the file the trace is written to
+        :param ring: the number of latest datagrams kept in memory until the trace is
+            written, 0 to write every datagram as it comes
+        :param clock: a function returning monotonic seconds
+        """
+        self.path = path
+        self.clock = clock
+        self.origin = clock()
+        self.started = time.time()
+        # Number of every peer, by address
+        self.peers: Dict[object, int] = {}
+        self.ring = max(ring, 0)
+        self.count = 0
+        self.closed = False
+        if self.ring:
+            self.buffer = bytearray(self.ring * RECORD.size)
+            self.file = None
+        else:
+            self.buffer = None
+            self.file = open(path, "wb")
+            self.file.write(FILE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, self.started))
+        atexit.register(self.close)
+        if hasattr(signal, "SIGUSR2"):
+            signal.signal(signal.SIGUSR2, self.flush)
+
+    def peer(self, address) -> int:
+        number = self.peers.get(address)
+        if number is None:
+            number = self.peers[address] = len(self.peers)
+            if self.file is not None:
+                self.file.write(self.peer_record(address, number))
+        return number
+
+    @staticmethod
+    def peer_record(address, number: int) -> bytes:
+        name = peer_name(address).encode()
+        return RECORD.pack(0.0, PEER, number, 0, 0, 0, len(name), 0) + name
+
+    def record(self, kind: int, data: bytes, address):
+        """Record the header of the datagram data sent to or received from address"""
+        if self.closed:
+            return
+        if len(data) >= HEADER_SIZE:
+            seq, ack, flags, _, checksum = HEADER.unpack_from(data)
+            valid = crc16(memoryview(data)[HEADER_SIZE:]) == checksum
+        else:
+            seq = ack = flags = 0
+            valid = False
+        values = (self.clock() - self.origin, kind, self.peer(address), seq, ack, flags, len(data), valid)
+        if self.file is not None:
+            self.file.write(RECORD.pack(*values))
+        else:
+            RECORD.pack_into(self.buffer, (self.count % self.ring) * RECORD.size, *values)
+        self.count += 1
+
+    def flush(self, *_):
+        """Write what the trace holds so far: flush the file, or write the ring buffer"""
+        if self.closed:
+            return
+        if self.file is not None:
+            self.file.flush()
+            return
+        kept = min(self.count, self.ring)
+        first = (self.count - kept) % self.ring
+        with open(self.path, "wb") as file:
+            file.write(FILE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, self.started))
+            for address, number in self.peers.items():
+                file.write(self.peer_record(address, number))
+            # Oldest first: from the oldest record to the end of the buffer, then its start
+            view = memoryview(self.buffer)
+            end = min(first + kept, self.ring)
+            file.write(view[first * RECORD.size:end * RECORD.size])
+            file.write(view[:(first + kept - end) * RECORD.size])
+        LOG.info("Wrote the last %d of %d datagrams to %s", kept, self.count, self.path)
+
+    def close(self):
+        self.flush()
+        self.closed = True
+        if self.file is not None:
+            self.file.close()
+
+
+def read_trace(path: str) -> Tuple[float, Dict[int, str], List[tuple]]:
+    """
+    Read a trace written by a TraceRecorder.
+    :return: the wall clock time of its start, the name of every peer by number, and the
+        (time, kind, peer, seq, ack, flags, length, valid) of every datagram in order
+    :raise ValueError: when path is not a trace
+    """
+    with open(path, "rb") as file:
+        data = file.read()
+    if len(data) < FILE_HEADER.size:
+        raise ValueError(f"{path} is not a trace")
+    magic, version, started = FILE_HEADER.unpack_from(data)
+    if magic != TRACE_MAGIC or version != TRACE_VERSION:
+        raise ValueError(f"{path} is not a trace of version {TRACE_VERSION}")
+    peers = {}
+    records = []
+    offset = FILE_HEADER.size
+    # A trace cut short by a crash ends with a partial record
+    while offset + RECORD.size <= len(data):
+        record = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        if record[1] == PEER:
+            peers[record[2]] = data[offset:offset + record[6]].decode()
+            offset += record[6]
+        else:
+            records.append(record)
+    return started, peers, records
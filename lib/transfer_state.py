@@ -0,0 +1,73 @@
+"""
+transfer_state.py is a module for the state of a file transfer of the server.
+A TransferState holds what the steps of Server.transfer_file share while the session of the
+client waits between them: the Go-Back-N window, the timers of the segments in flight and of
+a fast open, and the pacer, RTO policy and metrics of the connection.
+"""
+from typing import Dict, List, Optional, Tuple
+from lib.connection_table import Peer
+from lib.constants import METADATA_SEQ
+from lib.logger import Summary
+from lib.metrics import ConnectionMetrics
+from lib.pacing import Pacer
+from lib.segment import Segment
+from lib.sent_file import SentFile
+
+
+class TransferState:
+    """State of the transfer of a file to a client"""
+    __slots__ = ("client", "sent_file", "peer", "metrics", "pacer", "rto", "summary", "start", "segment_count",
+                 "window_size", "sb", "window", "highest_sent", "sent_at", "receive_window", "probe",
+                 "retransmit_timers", "timer_base", "probe_timer", "expired", "syn_segment", "handshake_pending",
+                 "handshake_timer", "handshake_expired", "reset", "abandoned")
+
+    def __init__(self, client: Tuple[str, int], sent_file: SentFile, peer: Peer, metrics: ConnectionMetrics,
+                 pacer: Pacer, rto, summary: Summary, start: float, window_size: int) -> None:
+        self.client = client
+        self.sent_file = sent_file
+        self.peer = peer
+        self.metrics = metrics
+        self.pacer = pacer
+        self.rto = rto
+        self.summary = summary
+        # Time the transfer started, for the handshake and transfer times
+        self.start = start
+        # Sequence number following the last data segment
+        self.segment_count = sent_file.segment_count + 2
+        self.window_size = window_size
+        # Sequence base, the first segment not acknowledged yet
+        self.sb = METADATA_SEQ
+        # Number of segments sent in the current window, whose ACKs are waited for
+        self.window = 0
+        self.highest_sent = METADATA_SEQ - 1
+        # First send time of the segments that have not been retransmitted, for RTT samples
+        self.sent_at: Dict[int, float] = {}
+        # Bytes the client can take beyond sb, None until it advertises a receive window
+        self.receive_window: Optional[int] = None
+        # Whether the next window is a single segment probing a full receive window
+        self.probe = False
+        # Retransmission timer of each segment in flight from timer_base on, and the window probe timer
+        self.retransmit_timers = {}
+        self.timer_base = METADATA_SEQ
+        self.probe_timer = None
+        # Sequence numbers whose timer expired before they were acknowledged
+        self.expired: List[int] = []
+        # SYN carrying the metadata of a fast open, None for a transfer after a handshake
+        self.syn_segment: Optional[Segment] = None
+        # Whether the client has not acknowledged the SYN of the fast open yet
+        self.handshake_pending = False
+        self.handshake_timer = None
+        # Set once the client took longer than the half-open timeout to answer a fast open
+        self.handshake_expired = False
+        # Whether the client asked to reset the connection, or never answered the fast open
+        self.reset = False
+        self.abandoned = False
+
+    def expire(self, seq_number: int):
+        """Timer callback of the segment seq_number, which is sent again unless acknowledged meanwhile"""
+        if seq_number >= self.sb:
+            self.expired.append(seq_number)
+
+    def expire_handshake(self):
+        """Timer callback of the fast open, given up unless the client answered meanwhile"""
+        self.handshake_expired = True
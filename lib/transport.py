@@ -0,0 +1,244 @@
+"""
+transport.py is a module for the ways a Connection sends and receives its datagrams.
+A transport binds an endpoint at a host and port, and sends and receives datagrams to and
+from (host, port) addresses, whatever the kind of socket underneath, so the protocol code
+is the same on every transport. It is chosen by the host:
+
+- unix:DIR for AF_UNIX datagram sockets, the endpoint of port P being the socket file
+  DIR/P.sock. Same-host transfers skip the IP and UDP layers of the kernel.
+- mem:NAME for queues between the threads of one process, for benchmarks and tests.
+- an IPv6 address for UDP over IPv6.
+- anything else for UDP over IPv4.
+"""
+import atexit
+import errno
+import ipaddress
+import os
+import selectors
+import socket
+import stat
+import threading
+from collections import deque
+from typing import Dict, Tuple
+from lib.constants import DEFAULT_IP, DEFAULT_IP6, QUEUE_SCHEME, QUEUE_TRANSPORT_LIMIT, UNIX_SCHEME
+
+
+class UdpTransport:
+    """UDP over IPv4"""
+    family = socket.AF_INET
+    # Whether the kernel counts the datagrams it drops on the receive queue of the socket
+    counts_drops = True
+    # Whether several sockets can bind the same port with SO_REUSEPORT
+    shares_port = True
+
+    def __init__(self, host: str) -> None:
+        self.host = host
+        self.socket = socket.socket(self.family, socket.SOCK_DGRAM)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ)
+
+    @staticmethod
+    def native(address):
+        """Socket address of a (host, port) address"""
+        return address
+
+    @staticmethod
+    def address(native) -> Tuple:
+        """(host, port) address of a socket address"""
+        return native
+
+    def bind(self, port: int, as_server: bool = False, reuse_port: bool = False):
+        if as_server:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket.bind(self.native((self.host, port)))
+
+    def sendto(self, data, address):
+        self.socket.sendto(data, self.native(address))
+
+    def recvfrom(self, size: int):
+        data, native = self.socket.recvfrom(size)
+        return data, self.address(native)
+
+    def recvmsg(self, size: int, ancillary_size: int):
+        data, ancillary, _, native = self.socket.recvmsg(size, ancillary_size)
+        return data, ancillary, self.address(native)
+
+    def settimeout(self, timeout: float):
+        self.socket.settimeout(timeout)
+
+    def gettimeout(self) -> float:
+        return self.socket.gettimeout()
+
+    def wait(self, timeout: float) -> bool:
+        """Wait up to timeout seconds for a datagram, with epoll where available"""
+        return bool(self.selector.select(timeout))
+
+    def close(self):
+        self.selector.close()
+        self.socket.close()
+
+
+class Udp6Transport(UdpTransport):
+    """UDP over IPv6"""
+    family = socket.AF_INET6
+
+    @staticmethod
+    def native(address):
+        return address[0].strip("[]"), address[1]
+
+    @staticmethod
+    def address(native) -> Tuple:
+        # Without the flow info and scope id
+        return native[:2]
+
+
+class UnixTransport(UdpTransport):
+    """AF_UNIX datagram sockets, the endpoint of port P of unix:DIR being the socket file DIR/P.sock"""
+    family = socket.AF_UNIX
+    counts_drops = False
+    shares_port = False
+
+    def __init__(self, host: str) -> None:
+        super().__init__(host)
+        self.directory = host[len(UNIX_SCHEME):] or "."
+        self.path = None
+        # Sending never blocks: a datagram to a peer with a full queue is dropped, like with UDP
+        self.sender = self.socket.dup()
+        self.sender.setblocking(False)
+
+    @staticmethod
+    def native(address):
+        return os.path.join(address[0][len(UNIX_SCHEME):] or ".", f"{address[1]}.sock")
+
+    @staticmethod
+    def address(native) -> Tuple:
+        directory, name = os.path.split(native or "")
+        port = name[:-len(".sock")]
+        return UNIX_SCHEME + directory, int(port) if port.isdigit() else 0
+
+    def bind(self, port: int, as_server: bool = False, reuse_port: bool = False):
+        if reuse_port:
+            raise OSError(errno.EOPNOTSUPP, "AF_UNIX sockets cannot share their path")
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.native((self.host, port))
+        # The socket file of an endpoint that exited is left behind
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self.socket.bind(path)
+        self.path = path
+        atexit.register(self.unlink)
+
+    def sendto(self, data, address):
+        try:
+            self.sender.sendto(data, self.native(address))
+        except (BlockingIOError, FileNotFoundError, ConnectionRefusedError):
+            # The peer is gone or its queue is full
+            pass
+
+    def unlink(self):
+        """Remove the socket file, which outlives the socket"""
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+
+    def close(self):
+        super().close()
+        self.sender.close()
+        self.unlink()
+
+
+class QueueTransport:
+    """Queues between the threads of a process, the endpoints of mem:NAME being found by (host, port)"""
+    counts_drops = False
+    shares_port = False
+    socket = None
+    # Bound endpoint of every address
+    endpoints: Dict[Tuple[str, int], "QueueTransport"] = {}
+    lock = threading.Lock()
+
+    def __init__(self, host: str) -> None:
+        self.host = host
+        self.bound = None
+        self.timeout = None
+        self.inbox = deque()
+        self.condition = threading.Condition()
+
+    def bind(self, port: int, as_server: bool = False, reuse_port: bool = False):
+        with self.lock:
+            if (self.host, port) in self.endpoints or reuse_port:
+                raise OSError(errno.EADDRINUSE, f"{self.host}:{port} is already bound")
+            self.bound = (self.host, port)
+            self.endpoints[self.bound] = self
+
+    def sendto(self, data, address):
+        peer = self.endpoints.get(tuple(address))
+        if peer is None:
+            return
+        with peer.condition:
+            if len(peer.inbox) < QUEUE_TRANSPORT_LIMIT:
+                peer.inbox.append((bytes(data), self.bound))
+                peer.condition.notify()
+
+    def recvfrom(self, size: int):
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.inbox, self.timeout):
+                raise TimeoutError("timed out")
+            data, address = self.inbox.popleft()
+        return data[:size], address
+
+    def settimeout(self, timeout: float):
+        self.timeout = timeout
+
+    def gettimeout(self) -> float:
+        return self.timeout
+
+    def wait(self, timeout: float) -> bool:
+        with self.condition:
+            return bool(self.condition.wait_for(lambda: self.inbox, timeout))
+
+    def close(self):
+        with self.lock:
+            if self.bound is not None and self.endpoints.get(self.bound) is self:
+                del self.endpoints[self.bound]
+
+
+def is_ipv6(host: str) -> bool:
+    try:
+        return ipaddress.ip_address(host.strip("[]")).version == 6
+    except ValueError:
+        return False
+
+
+def transport_class(host: str):
+    """Transport of the endpoints at host, from its scheme or IP version"""
+    if host.startswith(UNIX_SCHEME):
+        return UnixTransport
+    if host.startswith(QUEUE_SCHEME):
+        return QueueTransport
+    if is_ipv6(host):
+        return Udp6Transport
+    return UdpTransport
+
+
+def canonical_host(host: str) -> str:
+    """Host as received datagrams give it back, the short form of an IPv6 address"""
+    if is_ipv6(host):
+        return str(ipaddress.ip_address(host.strip("[]")))
+    return host
+
+
+def default_host(server_host: str) -> str:
+    """Host a client binds when none is given, reachable by the server at server_host"""
+    if server_host.startswith((UNIX_SCHEME, QUEUE_SCHEME)):
+        return server_host
+    if is_ipv6(server_host):
+        return DEFAULT_IP6
+    return DEFAULT_IP
@@ -0,0 +1,100 @@
+"""
+workers.py is a module to run the server daemon on several cores.
+A Supervisor forks worker processes that each run their own daemon, with its own socket
+bound to the same port with SO_REUSEPORT. The kernel hashes the address of every client to
+one of the sockets, so a client is served by a single worker from its connection request to
+its teardown, and the workers share nothing. The supervisor restarts the workers that crash.
+"""
+import os
+import signal
+import time
+from typing import Dict, Optional, Tuple
+from lib.constants import WORKER_RESTART_DELAY, WORKER_RESTART_MAX_DELAY, WORKER_STABLE_UPTIME
+from lib.logger import get_logger
+
+LOG = get_logger("workers")
+
+
+def _interrupt(*_):
+    raise KeyboardInterrupt
+
+
+def worker_path(path: Optional[str], index: int) -> Optional[str]:
+    """Output file of the worker index, path with the worker before its extension"""
+    if path is None or path == "-":
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}.worker{index}{extension}"
+
+
+class Supervisor:
+    """Parent of the worker processes of the daemon, which keeps count of them running"""
+
+    def __init__(self, count: int) -> None:
+        self.count = count
+        # Index and start time of every running worker, by pid
+        self.workers: Dict[int, Tuple[int, float]] = {}
+        self.delays = [WORKER_RESTART_DELAY] * count
+        self.stopping = False
+
+    def spawn(self, index: int) -> bool:
+        """
+        Fork the worker index.
+        :return: True in the worker, False in the supervisor
+        """
+        pid = os.fork()
+        if pid == 0:
+            # Only the supervisor stops the workers, each one once with SIGTERM
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, _interrupt)
+            LOG.info("Worker %d started with pid %d", index, os.getpid())
+            return True
+        self.workers[pid] = (index, time.monotonic())
+        return False
+
+    def stop(self, *_):
+        """Stop every worker, then the supervisor once they exited"""
+        if self.stopping:
+            return
+        self.stopping = True
+        LOG.info("Stopping %d worker(s)", len(self.workers))
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                continue
+
+    def run(self) -> Optional[int]:
+        """
+        Fork the workers, then wait for them, restarting the ones that crash, until all of them exited.
+        Returns in every worker as well, like os.fork.
+        :return: the index of the worker in a worker, None in the supervisor
+        """
+        for index in range(self.count):
+            if self.spawn(index):
+                return index
+        signal.signal(signal.SIGTERM, self.stop)
+        while self.workers:
+            try:
+                pid, status = os.wait()
+                index, started = self.workers.pop(pid)
+                code = os.waitstatus_to_exitcode(status)
+                if self.stopping or code == 0:
+                    LOG.info("Worker %d (pid %d) exited", index, pid)
+                    continue
+                if time.monotonic() - started >= WORKER_STABLE_UPTIME:
+                    self.delays[index] = WORKER_RESTART_DELAY
+                delay = self.delays[index]
+                # A worker crashing again right away waits longer each time
+                self.delays[index] = min(delay * 2, WORKER_RESTART_MAX_DELAY)
+                LOG.error("Worker %d (pid %d) crashed with status %d, restarting it in %.0f s",
+                          index, pid, code, delay)
+                time.sleep(delay)
+                if not self.stopping and self.spawn(index):
+                    return index
+            except KeyboardInterrupt:
+                self.stop()
+            except ChildProcessError:
+                break
+        LOG.info("All workers exited")
+        return None
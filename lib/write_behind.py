@@ -0,0 +1,76 @@
+"""
+write_behind.py is a module to write the received data without stalling the receiver.
+A WriteBehindFile queues the writes and a background thread drains them into the file,
+so the client keeps receiving and acknowledging segments while the disk catches up. The
+bytes still queued are the write backlog the client advertises its receive window from.
+"""
+import threading
+from collections import deque
+
+
+class WriteBehindFile:
+    """File written by a background thread, holding at most capacity bytes queued"""
+
+    def __init__(self, file, capacity: int) -> None:
+        self.file = file
+        self.capacity = capacity
+        self.queue = deque()
+        self.backlog = 0
+        self.error = None
+        self.closing = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._drain, daemon=True)
+        self.thread.start()
+
+    def _drain(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closing:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                data = self.queue[0]
+            try:
+                self.file.write(data)
+            except Exception as exc:  # pylint: disable=broad-except
+                # Raised again by the next write or by close
+                with self.condition:
+                    self.error = exc
+                    self.queue.clear()
+                    self.backlog = 0
+                    self.condition.notify_all()
+                return
+            with self.condition:
+                self.queue.popleft()
+                self.backlog -= len(data)
+                self.condition.notify_all()
+
+    def write(self, data) -> int:
+        """Queue data, waiting first when the backlog is full"""
+        data = bytes(data)
+        with self.condition:
+            while self.backlog and self.backlog + len(data) > self.capacity and self.error is None:
+                self.condition.wait()
+            if self.error is not None:
+                raise self.error
+            self.queue.append(data)
+            self.backlog += len(data)
+            self.condition.notify_all()
+        return len(data)
+
+    def flush(self):
+        """Wait until every queued write is done"""
+        with self.condition:
+            while self.queue and self.error is None:
+                self.condition.wait()
+            if self.error is not None:
+                raise self.error
+
+    def close(self):
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+        self.thread.join()
+        self.file.close()
+        if self.error is not None:
+            raise self.error
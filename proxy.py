@@ -0,0 +1,133 @@
+"""
+The module for the network impairment proxy of the file transfer application using UDP
+"""
+import heapq
+import itertools
+import selectors
+import socket
+import time
+from lib.parserProxy import parse_args_proxy
+from lib.impairment import Impairment
+from lib.logger import get_logger, configure_logging
+from lib.constants import MAX_SEGMENT_SIZE, PROXY_POLL_INTERVAL, PROXY_QUEUE_LIMIT
+
+LOG = get_logger("proxy")
+
+
+class ImpairmentProxy:
+    """
+    UDP relay sitting between the clients and the server.
+    Clients send to the proxy as if it were the server, the proxy forwards their datagrams
+    to the server and the answers back to them, applying an Impairment to each direction.
+    Every client gets its own upstream socket, so the server still sees different clients.
+    """
+
+    def __init__(self, listen_ip: str, listen_port: int, server_ip: str, server_port: int,
+                 to_server: Impairment, to_client: Impairment) -> None:
+        self.server_addr = (server_ip, server_port)
+        self.to_server = to_server
+        self.to_client = to_client
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((listen_ip, listen_port))
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ, None)
+        self.upstreams = {}
+        # Heap of (delivery time, order, socket, datagram, address) waiting to be sent
+        self.pending = []
+        self.order = itertools.count()
+        self.running = False
+        LOG.info("Proxy listening on %s:%s, forwarding to %s:%s",
+                 listen_ip, listen_port, server_ip, server_port)
+
+    def upstream(self, client_addr) -> socket.socket:
+        """Get the socket forwarding the datagrams of client_addr to the server"""
+        sock = self.upstreams.get(client_addr)
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind((self.socket.getsockname()[0], 0))
+            self.selector.register(sock, selectors.EVENT_READ, client_addr)
+            self.upstreams[client_addr] = sock
+            LOG.info("New client %s:%s relayed through port %s",
+                     client_addr[0], client_addr[1], sock.getsockname()[1])
+        return sock
+
+    def schedule(self, impairment: Impairment, data: bytes, sock: socket.socket, addr):
+        """Queue the deliveries decided by impairment for a received datagram"""
+        for deliver_at, datagram in impairment.process(data, time.monotonic()):
+            heapq.heappush(self.pending, (deliver_at, next(self.order), sock, datagram, addr))
+
+    def flush(self):
+        """Send the queued datagrams that are due"""
+        now = time.monotonic()
+        while self.pending and self.pending[0][0] <= now:
+            _, _, sock, datagram, addr = heapq.heappop(self.pending)
+            sock.sendto(datagram, addr)
+
+    def serve_forever(self):
+        """Relay datagrams until stop is called"""
+        self.running = True
+        while self.running:
+            timeout = PROXY_POLL_INTERVAL
+            if self.pending:
+                timeout = min(timeout, max(self.pending[0][0] - time.monotonic(), 0))
+            for key, _ in self.selector.select(timeout):
+                data, addr = key.fileobj.recvfrom(MAX_SEGMENT_SIZE)
+                if key.data is None:
+                    self.schedule(self.to_server, data, self.upstream(addr), self.server_addr)
+                else:
+                    self.schedule(self.to_client, data, self.socket, key.data)
+            self.flush()
+
+    def stop(self):
+        """Make serve_forever return, can be called from another thread"""
+        self.running = False
+
+    def close(self):
+        """Close every socket held by the proxy and log the impairment stats"""
+        LOG.info("To server: %s", self.to_server.stats)
+        LOG.info("To client: %s", self.to_client.stats)
+        for sock in [self.socket] + list(self.upstreams.values()):
+            self.selector.unregister(sock)
+            sock.close()
+        self.selector.close()
+
+
+def impairments_from_args(args):
+    """Build the (to server, to client) impairments described by the parsed arguments"""
+    def build(direction: str, active: bool) -> Impairment:
+        if not active:
+            return Impairment()
+        return Impairment(
+            loss=args.loss,
+            burst_enter=args.burst_enter,
+            burst_exit=args.burst_exit,
+            burst_loss=args.burst_loss,
+            delay=args.delay / 1000,
+            jitter=args.jitter / 1000,
+            reorder=args.reorder,
+            reorder_delay=args.reorder_delay / 1000,
+            duplicate=args.duplicate,
+            corrupt=args.corrupt,
+            rate=args.rate,
+            queue_limit=PROXY_QUEUE_LIMIT if args.queue_limit is None else args.queue_limit,
+            seed=None if args.seed is None else f"{args.seed}/{direction}",
+        )
+
+    return (
+        build("to-server", args.direction in ["both", "to-server"]),
+        build("to-client", args.direction in ["both", "to-client"]),
+    )
+
+
+if __name__ == "__main__":
+    ARGS = parse_args_proxy()
+    configure_logging(ARGS.log_level)
+    TO_SERVER, TO_CLIENT = impairments_from_args(ARGS)
+    PROXY = ImpairmentProxy(ARGS.listen_ip, ARGS.listen_port, ARGS.server_ip, ARGS.server_port,
+                            TO_SERVER, TO_CLIENT)
+    try:
+        PROXY.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        PROXY.close()
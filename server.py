@@ -3,15 +3,41 @@ The module for the server class of the file transfer application using UDP
 """
 import sys
 import os
-from typing import List
-from math import ceil
+import struct
+from collections import OrderedDict, deque
+from functools import partial
+from typing import Deque, Dict, Generator, List, Optional, Tuple
 from socket import timeout
 from lib.parser import parse_args
+from lib.logger import get_logger, configure_logging, Summary
+from lib.metrics import ConnectionMetrics, MetricsRegistry, install_exporter
 from lib.connection import Connection
+from lib.clock import SystemClock
+from lib.profiler import PROFILER
+from lib.trace import TraceRecorder
+from lib.transport import canonical_host, transport_class
+from lib.rto import RTO_POLICIES
+from lib.pacing import Pacer, TokenBucket
+from lib.scheduler import ClientPolicy, SendScheduler
+from lib.admission import AdmissionPolicy
+from lib.connection_table import ConnectionTable, HALF_OPEN, Peer, SynCookies
+from lib.manifest import DirectoryStream
 from lib.segment import Segment
-from lib.constants import SEGMENT_SIZE, PAYLOAD_SIZE, SYN_FLAG, SYN_ACK_FLAG, WINDOW_SIZE, ACK_FLAG, FIN_ACK_FLAG, DEFAULT_IP, TIMEOUT_LISTEN
-from lib.crc16 import crc16
-import time
+from lib.segment_cache import SEGMENT_CACHE
+from lib.sent_file import SentFile
+from lib.workers import Supervisor, worker_path
+from lib.timer_wheel import TimerWheel
+from lib.transfer_state import TransferState
+from lib.constants import (
+    ACK_REPORT_FORMAT, ACK_REPORT_SIZE, CAPABILITIES, CAPABILITY_ACK_REPORT, CAPABILITY_FEC,
+    OPTION_CAPABILITIES, OPTION_FEC_GROUP, OPTION_SYN_COOKIE, OPTION_RANGE, OPTION_DIGEST, OPTION_SOCKET_DROPS,
+    OPTION_RECEIVE_WINDOW, CONNECT_FAST_OPEN, METADATA_SEQ, DROPS_REPORT_SIZE, HEADER_SIZE, CONNECT_FLAG,
+    SYN_FLAG, SYN_ACK_FLAG, ACK_FLAG, FIN_ACK_FLAG, DEFAULT_IP, DIGEST_CACHE_SIZE, DRAIN_LIMIT, FIN_RETRIES,
+    RTO_INITIAL, RTO_MIN, TIMEOUT, TIMEOUT_LISTEN
+)
+import logging
+
+LOG = get_logger("server")
 
 
 class Server:
@@ -22,305 +48,965 @@ class Server:
     2. Send the file to the client
     """
 
-    def __init__(self) -> None:
-        args = parse_args(True)
-        broadcast_port, input_file_path, server_ip = args
+    def __init__(self, args=None, conn=None, clock=None, file=None) -> None:
+        """
+        Create the server from the command line arguments, or from args when given.
+        conn, clock and file replace the UDP connection, the system clock and the input
+        file, which is how the simulator runs the server.
+        """
+        if args is None:
+            args = parse_args(True)
+        configure_logging(args.log_level)
+        broadcast_port, input_file_path, server_ip = args.broadcast_port, args.path_file, args.server_ip
         if server_ip is None:
             server_ip = DEFAULT_IP
-        self.ip = server_ip
-        self.conn = Connection(
-            ip=self.ip,
-            broadcast=broadcast_port,
-            as_server=True
-        )
+        self.ip = canonical_host(server_ip)
+        if conn is None:
+            conn = Connection(
+                ip=self.ip,
+                broadcast=broadcast_port,
+                as_server=True,
+                loss_rate=args.loss_rate,
+                seed=args.seed,
+                rcvbuf=args.rcvbuf,
+                sndbuf=args.sndbuf,
+                reuse_port=args.daemon and args.workers > 1,
+                trace=TraceRecorder(args.trace, args.trace_ring) if args.trace else None
+            )
+        self.conn = conn
+        self.clock = SystemClock() if clock is None else clock
+        self.rto_policy = RTO_POLICIES[args.rto]
+        self.payload_size = args.segment_size - HEADER_SIZE
+        self.window_size = args.window_size
+        self.expected_clients = args.clients
+        self.session_idle = args.session_idle
+        self.fast_open = args.fast_open
+        self.fec_group = max(args.fec, 0)
+        self.capabilities = CAPABILITIES if self.fec_group else CAPABILITIES & ~CAPABILITY_FEC
+        # Every client from its connection request to the end of its session, with what was agreed on
+        self.connections = ConnectionTable(self.clock.monotonic, args.max_connections, args.max_half_open,
+                                           args.half_open_timeout, args.idle_timeout)
+        self.cookies = SynCookies(self.clock.monotonic)
+        self.pacing_auto = args.pacing_auto
+        self.pacing_burst = args.pacing_burst * args.segment_size
+        self.global_bucket = TokenBucket(args.global_rate, self.pacing_burst, self.clock) if args.global_rate else None
+        self.policy = ClientPolicy(args.priority, args.client_rate, args.pacing_rate)
         self.input_file_path = 'sent_file/' + input_file_path
-        self.input_file_name = self.input_file_path.split("/")[-1]
-        self.file = self.open_file()
+        if args.profile or args.cprofile:
+            PROFILER.enable(args.profile_out, args.cprofile)
+        self.daemon = args.daemon
+        self.admission = AdmissionPolicy(args.max_clients, args.allow)
+        if self.daemon:
+            self.serve_dir = os.path.realpath(self.input_file_path)
+            self.file = None
+        else:
+            self.file = self.open_file() if file is None else file
+            self.file = PROFILER.wrap_file(self.file)
         self.segment = Segment()
-        self.segment_list: List[Segment] = []
+        # Deadlines of every connection, waited for together with the segments
+        self.timers = TimerWheel(self.clock)
+        # The input file sent to every client, the daemon loads the files of each request instead
+        self.sent_file: Optional[SentFile] = None
+        # Digest of every file served in ranges by its identity, least recently used first
+        self.digests: Dict[object, bytes] = OrderedDict()
+        self.cache = SEGMENT_CACHE
+        self.cache.configure(args.cache_size, args.read_ahead)
+        self.scheduler = SendScheduler(self.timers, args.quantum)
+        # Session of every client being served, and the datagrams it got while waiting for a turn to send
+        self.sessions: Dict[Tuple[str, int], Generator] = {}
+        self.inboxes: Dict[Tuple[str, int], Deque] = {}
+        # Linger timer of every connection closed after its session
+        self.closing: Dict[Tuple[str, int], object] = {}
+        self.linger_time = args.linger
         self.client_list = []
+        # Metrics of every client being served, folded into closed_metrics once its session ends
+        self.metrics: Dict[Tuple[str, int], ConnectionMetrics] = {}
+        self.closed_metrics = MetricsRegistry(self.clock.monotonic, role="server", peer="closed")
+        self.closed_sessions = self.closed_metrics.counter("sessions_closed_total",
+                                                           "Sessions ended, whose counters are in these totals")
+        if args.metrics_out:
+            install_exporter(lambda: [self.connections.metrics, self.closed_metrics] + list(self.metrics.values()),
+                             args.metrics_out, args.metrics_format)
+
+    def get_metrics(self, client) -> ConnectionMetrics:
+        """Get the metrics of the connection to client, creating them if needed"""
+        metrics = self.metrics.get(client)
+        if metrics is None:
+            metrics = ConnectionMetrics(self.clock.monotonic, role="server",
+                                        peer=f"{client[0]}:{client[1]}")
+            self.metrics[client] = metrics
+        return metrics
+
+    def close_metrics(self, client):
+        """Drop the metrics of client, whose session ended, adding its counters to the totals of closed_metrics"""
+        metrics = self.metrics.pop(client, None)
+        if metrics is not None:
+            self.closed_metrics.fold(metrics)
+            self.closed_sessions.inc()
 
     def listen_for_clients(self):
-        print("[ INFO ] Listening for clients")
+        """
+        Listen for connection requests, asking whether to wait for more clients after each one.
+        When the number of expected clients is set, stop once that many are connected instead.
+        Clients that stop resending their request are dropped after the half-open timeout.
+        """
+        LOG.info("Listening for clients")
         while True:
             try:
+                self.reap_connections()
                 segment, client_addr = self.conn.listen_segment()
                 client_ip, client_port = client_addr
+                try:
+                    request = Segment.from_bytes(segment)
+                except struct.error:
+                    continue
+                peer = self.answer_request(client_addr, request)
+                if peer is None or client_addr in self.client_list:
+                    # The client resends its request until the handshake starts
+                    continue
                 self.client_list.append(client_addr)
-                print(
-                    f"[ INFO ] Received connection request from client: {client_ip}:{client_port}")
+                LOG.info("Received connection request from client: %s:%s",
+                         client_ip, client_port)
+
+                if self.expected_clients is not None:
+                    if len(self.client_list) >= self.expected_clients:
+                        break
+                    continue
 
                 answer = input(
                     "[ PROMPT ] Do you want to add more clients? (y/n) ")
                 while not (answer.lower() in ["y", "n"]):
-                    print("[ ERROR ] Invalid input")
+                    LOG.error("Invalid input")
                     answer = input(
                         "[ PROMPT ] Do you want to add more clients? (y/n) ")
                 if answer.lower() == "n":
-                    print("\n[ INFO ] The following clients will be served:")
+                    self.reap_connections()
+                    LOG.info("The following clients will be served:")
                     for idx, client in enumerate(self.client_list):
-                        print(f"[ INFO ] {idx+1}. {client[0]}:{client[1]}")
-                    print()
+                        LOG.info("%d. %s:%s", idx + 1, client[0], client[1])
                     break
 
             except timeout:
-                print("[ TIMEOUT ] Timeout while listening for client, exiting")
+                if self.expected_clients is not None:
+                    # Clients resend their request, keep waiting for all of them
+                    continue
+                LOG.warning("Timeout while listening for client, exiting")
                 break
 
+    def reap_connections(self):
+        """Drop the clients waiting to be served that went quiet for too long"""
+        for client in self.connections.reap():
+            LOG.warning("[Client %s:%s] No news from the client, dropping it", *client)
+            if client in self.client_list:
+                self.client_list.remove(client)
+
+    def answer_request(self, client_addr, request: Segment) -> Optional[Peer]:
+        """
+        Answer a segment of a client not being served yet. A valid connection request adds the client
+        half-open, remembering whether it asked for a fast open, or gets a SYN cookie when too many
+        clients are half-open. A SYN-ACK acknowledging a valid cookie adds the client with its
+        handshake done, and gets the ACK ending it.
+        :return: the peer of the client, None when the segment did not come from a client to serve
+        """
+        if not request.is_valid():
+            return None
+        flag = request.get_flag()
+        if flag == CONNECT_FLAG:
+            peer = self.connections.open(client_addr, request.version)
+            if peer is None:
+                self.send_cookie(client_addr, request)
+            elif peer.state == HALF_OPEN:
+                peer.fast_open = self.fast_open and bool(request.get_header()["ack"] & CONNECT_FAST_OPEN)
+                peer.name = request.get_payload().decode(errors="replace") or None
+                peer.byte_range = request.get_range_option(OPTION_RANGE)
+                peer.capabilities = peer.fec_group = 0
+            return peer
+        if flag == SYN_ACK_FLAG:
+            peer = self.connections.get(client_addr)
+            if peer is None or peer.state == HALF_OPEN:
+                if not self.cookies.check(client_addr, request.get_header()["ack"] - 1):
+                    self.connections.metrics.cookies_rejected.inc()
+                    return None
+                peer = self.connections.establish(client_addr, request.version)
+                if peer is None:
+                    return None
+                self.connections.metrics.cookies_accepted.inc()
+                # The client names its file in the SYN-ACK answering a cookie, older ones do not
+                peer.name = request.get_payload().decode(errors="replace") or None
+                peer.byte_range = request.get_range_option(OPTION_RANGE)
+                peer.fast_open = False
+                self.agree_capabilities(client_addr, request)
+                LOG.info("[Client %s:%s] Three-way handshake established with a SYN cookie", *client_addr)
+            # Sent again for every SYN-ACK, the client resends it until it gets the ACK
+            ack_segment = Segment()
+            ack_segment.set_header({"seq": 1, "ack": 1})
+            ack_segment.set_flag(["ACK"])
+            self.conn.send(ack_segment.to_bytes(), *client_addr)
+            return peer
+        # Leftover segment of a previous connection, or a client waiting to be served
+        peer = self.connections.touch(client_addr)
+        return peer if peer is not None and peer.state != HALF_OPEN else None
+
+    def send_cookie(self, client_addr, request: Segment):
+        """Answer the connection request of client_addr with a SYN whose sequence number is a cookie"""
+        syn_segment = Segment()
+        syn_segment.set_flag(["SYN"])
+        syn_segment.set_header({"seq": self.cookies.make(client_addr), "ack": 0})
+        self.offer_capabilities(request.version, syn_segment)
+        if request.version >= 1:
+            syn_segment.set_int_option(OPTION_SYN_COOKIE, 1)
+        self.conn.send(syn_segment.to_bytes(), *client_addr)
+        self.connections.metrics.cookies_sent.inc()
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug("[Client %s:%s] Too many half-open connections, sent a SYN cookie", *client_addr)
+
+    def offer_capabilities(self, version: int, segment: Segment):
+        """
+        Add the capabilities of the server to the SYN sent to a client that understands options,
+        the one whose request had this options version, with the FEC group size when it offers FEC
+        """
+        if version >= 1:
+            segment.set_int_option(OPTION_CAPABILITIES, self.capabilities)
+            if self.capabilities & CAPABILITY_FEC:
+                segment.set_int_option(OPTION_FEC_GROUP, self.fec_group)
+
+    def agree_capabilities(self, client_addr, segment: Segment):
+        """
+        Keep the capabilities the client answered with in its SYN-ACK that the server has too.
+        A client accepting FEC answers with the group size it takes, at most the one offered.
+        """
+        offered = segment.get_int_option(OPTION_CAPABILITIES)
+        peer = self.connections.get(client_addr)
+        if offered is None or peer is None:
+            return
+        capabilities = self.capabilities & offered
+        group = segment.get_int_option(OPTION_FEC_GROUP)
+        if capabilities & CAPABILITY_FEC and group and group <= self.fec_group:
+            peer.fec_group = group
+        else:
+            capabilities &= ~CAPABILITY_FEC
+            peer.fec_group = 0
+        peer.capabilities = capabilities
+        LOG.info("[Client %s:%s] Agreed on capabilities %#x", client_addr[0], client_addr[1], capabilities)
+        if capabilities & CAPABILITY_FEC:
+            LOG.info("[Client %s:%s] Sending a parity segment every %d segments", client_addr[0], client_addr[1],
+                     peer.fec_group)
+
+    def read_ack_report(self, client_addr, segment: Segment) -> Tuple[Optional[int], Optional[int]]:
+        """
+        Get the socket drops and the receive window the client reported in an ACK, None when missing.
+        Clients that agreed on CAPABILITY_ACK_REPORT send them as options, the others in the payload.
+        """
+        peer = self.connections.get(client_addr)
+        if peer is not None and peer.capabilities & CAPABILITY_ACK_REPORT:
+            return segment.get_int_option(OPTION_SOCKET_DROPS), segment.get_int_option(OPTION_RECEIVE_WINDOW)
+        payload = segment.get_payload()
+        drops = window = None
+        if len(payload) >= DROPS_REPORT_SIZE:
+            drops = struct.unpack("I", payload[:DROPS_REPORT_SIZE])[0]
+        if len(payload) >= ACK_REPORT_SIZE:
+            window = struct.unpack(ACK_REPORT_FORMAT, payload[:ACK_REPORT_SIZE])[1]
+        return drops, window
+
     def three_way_handshake(self, client_addr):
         """
-        Establishes a three-way handshake connection with the client
+        Establishes a three-way handshake connection with the client, as a step of its session
         1. Receive SYN from client
         2. Send SYN-ACK to client
         3. Receive ACK from client
+        The client is given up when it does not answer within the half-open timeout.
+        :return: whether the handshake is done
         """
-        print(
-            f"[ INFO ] [Client {client_addr[0]}:{client_addr[1]}] Initiating three-way handshake"
-        )
-        self.segment.set_flag(["SYN"])
+        LOG.info("[Client %s:%s] Initiating three-way handshake", *client_addr)
+        metrics = self.get_metrics(client_addr)
+        peer = self.connections.get(client_addr)
+        start = self.clock.monotonic()
+        # A SYN with a payload would be taken for a fast open
+        segment = Segment()
+        segment.set_flag(["SYN"])
+        syn_segment = Segment()
+        syn_segment.set_flag(["SYN"])
+        self.offer_capabilities(peer.version, syn_segment)
+        # Timers that fired: "resend" to send the SYN again, "abandon" to give up on the client
+        expired = []
+        abandon = self.timers.schedule(self.connections.half_open_timeout, expired.append, "abandon")
 
         while True:
-            if self.segment.get_flag() == SYN_FLAG:
-                print(
-                    f"[ INFO ] [Client {client_addr[0]}:{client_addr[1]}] sent SYN to server"
-                )
-                header = self.segment.get_header()
-                header["seq"] = 0
-                header["ack"] = 0
-                self.segment.set_header(header)
-                self.conn.send(self.segment.to_bytes(), *client_addr)
+            if segment.get_flag() == SYN_FLAG:
+                LOG.info("[Client %s:%s] sent SYN to server", *client_addr)
+                self.conn.send(syn_segment.to_bytes(), *client_addr)
+                metrics.segments_sent.inc()
+                resend = self.timers.schedule(TIMEOUT, expired.append, "resend")
+                result = None
+                while result is None and not expired:
+                    result = yield
+                self.timers.cancel(resend)
+                if result is None:
+                    if "abandon" in expired:
+                        self.abandon(client_addr)
+                        return False
+                    expired.clear()
+                    LOG.warning(
+                        "[Client %s:%s] ACK response timeout, resending SYN", *client_addr)
+                    metrics.handshake_retries.inc()
+                    continue
                 try:
-                    data, _ = self.conn.listen_segment()
-                    self.segment = Segment.from_bytes(data)
-                except timeout:
-                    print(
-                        f"[ TIMEOUT ] [Client {client_addr[0]}:{client_addr[1]}] ACK response timeout, resending SYN"
-                    )
-
-            elif self.segment.get_flag() == SYN_ACK_FLAG:
-                print(
-                    f"[ INFO ] [Client {client_addr[0]}:{client_addr[1]}] received SYN-ACK from server"
-                )
-                print(
-                    f"[ INFO ] [Client {client_addr[0]}:{client_addr[1]}] sent ACK to server"
-                )
-                header = self.segment.get_header()
-                header["seq"] = 1
-                header["ack"] = 1
-                self.segment.set_header(header)
-                self.segment.set_flag(["ACK"])
-                self.conn.send(self.segment.to_bytes(), *client_addr)
+                    segment.parse(result[0])
+                except struct.error:
+                    continue
+                metrics.segments_received.inc()
+                if segment.get_flag() == CONNECT_FLAG:
+                    # A resent connection request, the SYN may have been lost
+                    segment.set_flag(["SYN"])
+
+            elif segment.get_flag() == SYN_ACK_FLAG:
+                LOG.info("[Client %s:%s] received SYN-ACK from server", *client_addr)
+                self.agree_capabilities(client_addr, segment)
+                LOG.info("[Client %s:%s] sent ACK to server", *client_addr)
+                ack_segment = Segment()
+                ack_segment.set_header({"seq": 1, "ack": 1})
+                ack_segment.set_flag(["ACK"])
+                self.conn.send(ack_segment.to_bytes(), *client_addr)
+                metrics.segments_sent.inc()
                 break
 
             else:
-                print(
-                    f"[ INFO ] [Client {client_addr[0]}:{client_addr[1]}] is waiting for file already, ending three-way handshake"
-                )
+                LOG.info(
+                    "[Client %s:%s] is waiting for file already, ending three-way handshake", *client_addr)
                 break
 
-        print(
-            f"[ INFO ] [Client {client_addr[0]}:{client_addr[1]}] Three-way handshake established"
-        )
+        self.timers.cancel(abandon)
+        self.connections.establish(client_addr, peer.version)
+        metrics.handshake_time.set(self.clock.monotonic() - start)
+        LOG.info("[Client %s:%s] Three-way handshake established", *client_addr)
+        return True
+
+    def abandon(self, client_addr):
+        """Give up on a client that never completed its handshake, its metrics are dropped with it"""
+        LOG.warning("[Client %s:%s] No answer to the handshake, giving up", *client_addr)
+        self.connections.metrics.abandoned.inc()
+        self.metrics.pop(client_addr, None)
 
     def open_file(self):
         """
-        Return the file handle of the input file
+        Return the file handle of the input file, or the stream of the manifest and
+        files of the input directory
         """
         try:
+            if os.path.isdir(self.input_file_path):
+                return DirectoryStream(self.input_file_path)
             file = open(f"{self.input_file_path}", "rb")
             return file
         except FileNotFoundError:
-            print(
-                f"[Error] {self.input_file_path} doesn't exists. Server exiting...")
+            LOG.error("%s doesn't exists. Server exiting...", self.input_file_path)
             sys.exit(1)
 
-    def get_file_size(self):
+    def resolve_file(self, name: str):
+        """
+        Return the path of the file or directory name inside the served directory,
+        None when it does not exist, is outside of the directory or is the directory itself
+        """
+        path = os.path.realpath(os.path.join(self.serve_dir, name))
+        if (path == self.serve_dir or os.path.commonpath([path, self.serve_dir]) != self.serve_dir
+                or not os.path.exists(path)):
+            return None
+        return path
+
+    def load_file(self, name: Optional[str], byte_range: Tuple[int, int] = None) -> Optional[SentFile]:
         """
-        Return the size of the input file
+        Open name, a file or directory of the served directory, and split it into segments.
+        Each request opens its file, the clients of a file share its segments through the cache.
+        :param byte_range: the offset and length of the part of the file to send, None for all of it
+        :return: the file to send, None when it cannot be served or no file was named
         """
+        if name is None:
+            LOG.error("Requested file was not named")
+            return None
+        path = self.resolve_file(name)
+        if path is None:
+            LOG.error("Requested file %s is not served", name)
+            return None
         try:
-            return os.path.getsize(f"{self.input_file_path}")
-        except:
-            print("Error reading file", self.input_file_path, ". Aborting.")
+            file = DirectoryStream(path) if os.path.isdir(path) else open(path, "rb")
+        except OSError as exc:
+            LOG.error("Requested file %s cannot be read: %s", name, exc)
+            return None
+        sent_file = SentFile(PROFILER.wrap_file(file), path, self.payload_size, byte_range)
+        try:
+            sent_file.split()
+        except IndexError:
+            LOG.error("Requested file %s has no extension, it cannot be described in the metadata", name)
+            sent_file.close()
+            return None
+        return sent_file
+
+    def request_file(self, name: Optional[str], byte_range: Optional[Tuple[int, int]]) -> Optional[SentFile]:
+        """
+        File answering a request: the file it names for the daemon, the input file otherwise.
+        A range request gets that range of the file, with the digest of the whole file in its metadata.
+        :return: the file to send, None when the request cannot be served
+        """
+        if self.daemon:
+            sent_file = self.load_file(name, byte_range)
+        elif byte_range is None:
+            return self.sent_file
+        else:
+            sent_file = self.sent_file.range(byte_range)
+            sent_file.split()
+        if sent_file is not None and byte_range is not None:
+            sent_file.metadata_segment.set_option(OPTION_DIGEST, self.file_digest(sent_file))
+        return sent_file
+
+    def file_digest(self, sent_file: SentFile) -> bytes:
+        """Digest of the whole file of sent_file, read once for all the ranges of the file"""
+        key = sent_file.identity()
+        digest = self.digests.get(key)
+        if digest is None:
+            digest = self.digests[key] = sent_file.digest()
+            if len(self.digests) > DIGEST_CACHE_SIZE:
+                self.digests.popitem(last=False)
+        else:
+            self.digests.move_to_end(key)
+        return digest
+
+    def accept(self, client_addr, data: bytes):
+        """
+        Answer a datagram of a client the daemon does not serve, starting its session at once when
+        it is admitted. Clients beyond the maximum resend their request until a session ends.
+        """
+        self.reap_connections()
+        try:
+            request = Segment.from_bytes(data)
+        except struct.error:
+            return
+        if not self.admission.admits(client_addr, len(self.sessions)):
+            if request.get_flag() == CONNECT_FLAG and request.is_valid():
+                LOG.warning("Rejected connection request from client: %s:%s", *client_addr)
+            return
+        peer = self.answer_request(client_addr, request)
+        if peer is None:
+            # Leftover segment of a previous connection, or a request answered with a SYN cookie
+            return
+        LOG.info("Received connection request from client: %s:%s for %s", client_addr[0], client_addr[1], peer.name)
+        self.start_session(client_addr, peer.name)
+
+    def serve_forever(self):
+        """Serve the clients with the files they ask for until interrupted"""
+        LOG.info("Serving %s, waiting for clients", self.serve_dir)
+        self.serve([], accept=True)
 
     def split_file(self):
-        """Split the file into segments"""
-        # SYN : 0
-        # ACK : 1
-        # Metadata : 2
-        # Data : 3 - n
-        metadata_segment = Segment()
-        filename = self.input_file_name.split(".")[0]
-        extension = self.input_file_name.split(".")[1]
-        filesize = self.get_file_size()
-        print(f'[INFO] Filesize : {filesize} bytes')
-        metadata = filename.encode() + ",".encode() + extension.encode() + \
-            ",".encode() + str(filesize).encode()
-        metadata_segment.set_payload(metadata)
-        header = metadata_segment.get_header()
-        header["seq"] = 2
-        header["ack"] = 0
-        metadata_segment.set_header(header)
-        metadata_segment.set_checksum(crc16(metadata))
-        self.segment_list.append(metadata_segment)
-
-        segment_count = self.get_segment_count()
-        offset = 0
-        for i in range(segment_count):
-            segment = Segment()
-
-            # Create payload
-            self.file.seek(offset)
-            offset += PAYLOAD_SIZE
-            data_to_set = self.file.read(PAYLOAD_SIZE)
-            segment.set_payload(data_to_set)
-
-            # Create header
-            header = segment.get_header()
-            # TODO : Change the number below
-            header["seq"] = i + 3
-            header["ack"] = 3
-            segment.set_header(header)
-
-            # Set checksum
-            segment.set_checksum(crc16(data_to_set))
-            self.segment_list.append(segment)
-
-        print("[ INFO ] File splitted into", len(self.segment_list), "segments")
-
-    def get_segment_count(self):
-        """Get how many segment has to be created to send the given file"""
-        return ceil(self.get_file_size() / SEGMENT_SIZE)
+        """Split the input file into its metadata segment and its data segments, sent to every client"""
+        self.sent_file = SentFile(self.file, self.input_file_path, self.payload_size)
+        self.sent_file.split()
 
     def initiate_transfer(self):
-        """Initiate file transfer to all clients"""
-        for client in self.client_list:
-            self.three_way_handshake(client)
-            self.transfer_file(client)
-
-    def transfer_file(self, client):
-        """Starts transferring file to client"""
-        segment_count = len(self.segment_list) + 2
-        window_size = min(segment_count - 2, WINDOW_SIZE)
-        sb = 2  # Sequence base
-        reset = False
-        print(f'[Client {client[0]}:{client[1]}] Initiating file transfer')
-        while (sb < segment_count and not (reset)):
-            sm = window_size
-            # Kirimkan data
-            for i in range(sm):
-                print(
-                    f"[Client {client[0]}:{client[1]}][Num={sb + i}] Sending Segment"
-                )
-                if i + sb < segment_count:
-                    self.conn.send(
-                        self.segment_list[i + sb -
-                                          2].to_bytes(), client[0], client[1]
-                    )
-            for i in range(sm):
-                try:
-                    response, client_addr = self.conn.listen_segment()
-                    self.segment = Segment.from_bytes(response)
-                    if (client_addr == client and self.segment.get_flag() == ACK_FLAG):
-                        header = self.segment.get_header()
-                        acked_num = header["ack"]
-                        if (acked_num == sb + 1):
-                            print(
-                                f'[ INFO ] [Client {client[0]}:{client[1]}][Num={acked_num}] Received ACK from client')
-                            sb += 1
-                            window_size = min(segment_count - sb, WINDOW_SIZE)
-                        else:
-                            print(
-                                f'[ INFO ] [Client {client[0]}:{client[1]}][Num={acked_num}] Received ACK for wrong segment')
-                            if (acked_num > sb):
-                                sm = (sm-sb) + acked_num
-                                sb = acked_num
-                    elif (client_addr != client):
-                        print(
-                            f'[ ERROR ] [Client {client[0]}:{client[1]}][Num={i+sb}] Received message from wrong client')
-                    elif (self.segment.get_flag() == SYN_ACK_FLAG):
-                        print(
-                            f'[ INFO ] [Client {client[0]}:{client[1]}] Asked to reset connection')
-                        reset = True
-                        break
-                    else:
-                        print(
-                            f'[ ERROR ] [Client {client[0]}:{client[1]}][Num={i+sb}] Received non-ACK flag')
-                except TimeoutError:
-                    print(
-                        f'[ ERROR ] [Client {client[0]}:{client[1]}][Num={i+sb}] Connection time out, resending previous segments')
-
-        if reset:
-            self.three_way_handshake(client)
-            self.transfer_file(client)
+        """Initiate file transfer to all clients at once"""
+        self.serve([(client, None) for client in self.client_list])
+
+    def serve(self, batch: List[Tuple[Tuple[str, int], Optional[str]]], accept: bool = False):
+        """
+        Serve the (client address, requested file name) pairs of batch at once, until every session is
+        closed and the closed connections stopped lingering; with accept, serve the new clients too, forever.
+        A session is a generator that yields None to wait for a datagram, which is sent into it,
+        or for its timers, which resumes it with None; and that yields the size of the next
+        datagram it sends to wait for its turn from the send scheduler.
+        """
+        for client, name in batch:
+            self.start_session(client, name)
+        while self.sessions or self.closing or accept:
+            client = self.scheduler.next()
+            if client is not None:
+                self.resume(client)
+                continue
+            result = self.conn.listen_until(self.timers)
+            if result is not None:
+                self.dispatch(result, accept)
+                continue
+            # Timers fired: the datagrams already queued are handed out first, so a session
+            # does not act on a timeout for a reply that came in before it
+            for _ in range(DRAIN_LIMIT):
+                result = self.conn.poll()
+                if result is None:
+                    break
+                self.dispatch(result, accept)
+            # Every session waiting for a datagram checks its own timers
+            for client in list(self.sessions):
+                if client in self.sessions and not self.scheduler.waiting(client):
+                    self.resume(client)
+
+    def dispatch(self, result, accept: bool):
+        """Hand the (data, address) received to the session, closed connection or new client it is for"""
+        client = result[1]
+        if client in self.sessions:
+            if self.scheduler.waiting(client):
+                self.inboxes[client].append(result)
+            else:
+                self.resume(client, result)
+        elif client in self.closing and self.answer_closing(client, result[0]):
+            return
+        elif accept:
+            self.accept(client, result[0])
         else:
-            print(
-                f'[Client {client[0]}:{client[1]}] File transfer finished, sending FIN message')
+            LOG.debug("Received message from client %s:%s, which is not being served", *client)
 
-            fin_acked = False
-            client_still_active = True
-            time_limit = time.time() + TIMEOUT_LISTEN
+    def start_session(self, client, name: Optional[str]):
+        """Start serving client the file name, run its session until it waits"""
+        self.timers.cancel(self.closing.pop(client, None))
+        self.connections.activate(client)
+        self.sessions[client] = self.serve_client(client, name)
+        self.inboxes[client] = deque()
+        self.resume(client)
 
-            while not fin_acked:
-                self.segment.set_payload(bytes())
-                self.segment.set_flag(["FIN", "ACK"])
-                header = self.segment
-                self.conn.send(self.segment.to_bytes(), client[0], client[1])
-                try:
-                    response, client_addr = self.conn.listen_segment()
-                    self.segment = Segment.from_bytes(response)
-                    if (client_addr == client and self.segment.get_flag() == ACK_FLAG):
-                        print(
-                            f'[Client {client[0]}:{client[1]}] Received ACK for FIN from client')
-                        fin_acked = True
-                    elif (client_addr != client):
-                        print(
-                            f'[Client {client[0]}:{client[1]}] Received message from wrong client')
-                    else:
-                        print(
-                            f'[Client {client[0]}:{client[1]}] Received non-ACK flag')
-                except:
-                    if time.time() > time_limit:
-                        print(
-                            f"[ WARNING ] [Client {client[0]}:{client[1]}] [Timeout] Server waited too long, connection closed."
-                        )
-                        break
-                    print(
-                        f'[Client {client[0]}:{client[1]}] Connection timed out. Resending FIN message')
-                    client_still_active = False
+    def resume(self, client, result=None):
+        """
+        Run the session of client until it waits again, result being what it waited for.
+        The datagrams it got while waiting for its turn to send are handed to it first.
+        """
+        session = self.sessions[client]
+        inbox = self.inboxes[client]
+        while True:
+            try:
+                size = session.send(result)
+            except StopIteration:
+                del self.sessions[client]
+                del self.inboxes[client]
+                self.scheduler.remove(client)
+                self.connections.remove(client)
+                self.close_metrics(client)
+                return
+            if size is not None:
+                self.scheduler.request(client, size)
+                return
+            if not inbox:
+                self.scheduler.idle(client)
+                return
+            result = inbox.popleft()
 
-            client_fin_acked = False
-            time_limit = time.time() + TIMEOUT_LISTEN
-            while (not client_fin_acked and client_still_active):
-                try:
-                    response, client_addr = self.conn.listen_segment()
-                    self.segment = Segment.from_bytes(response)
-                    if (client_addr == client and self.segment.get_flag() == FIN_ACK_FLAG):
-                        print(
-                            f'[Client {client[0]}:{client[1]}] Received FIN request from client. Sending ACK and shutting down connection.')
-                        self.segment.set_payload(bytes())
-                        self.segment.set_flag(["ACK"])
-                        self.conn.send(self.segment.to_bytes(),
-                                       client[0], client[1])
-                        client_fin_acked = True
-                    elif (client_addr != client):
-                        print(
-                            f'[Client {client[0]}:{client[1]}] Received message from wrong client')
-                    else:
-                        print(
-                            f'[Client {client[0]}:{client[1]}] Received non-FIN-ACK flag')
-                except TimeoutError:
-                    if time.time() > time_limit:
-                        print(
-                            f"[ WARNING ] [Client {client[0]}:{client[1]}] [Timeout] Server waited too long, connection closed."
-                        )
-                        break
-                    print(
-                        f'[Client {client[0]}:{client[1]}] Connection timed out. Waiting again.')
+    def linger(self, client):
+        """Keep the closed connection to client for a while, to acknowledge the FIN-ACK of the client again"""
+        self.timers.cancel(self.closing.get(client))
+        self.closing[client] = self.timers.schedule(self.linger_time, self.closing.pop, client, None)
+
+    def answer_closing(self, client, data: bytes) -> bool:
+        """
+        Acknowledge the FIN-ACK of a client whose connection lingers after its session.
+        :return: whether the datagram was for the closed connection, a new connection request is not
+        """
+        try:
+            self.segment.parse(data)
+        except struct.error:
+            return True
+        if self.segment.get_flag() == CONNECT_FLAG:
+            return False
+        if self.segment.get_flag() == FIN_ACK_FLAG:
+            LOG.info(
+                "[Client %s:%s] Received FIN request from client. Sending ACK and shutting down connection.", *client)
+            self.segment.set_payload(bytes())
+            self.segment.set_flag(["ACK"])
+            self.conn.send(self.segment.to_bytes(), client[0], client[1])
+        return True
+
+    def serve_client(self, client, name: str = None):
+        """
+        Session of client: send client its file, then answer the next requests of its session until
+        the connection is closed. The daemon serves the files named in the requests, otherwise every
+        request gets the input file. A client asking for a fast open gets its first file without a
+        separate handshake, one that completed a SYN cookie handshake gets it right away.
+        """
+        peer = self.connections.get(client)
+        fast_open = peer.fast_open
+        peer.fast_open = False
+        sent_file = self.request_file(name, peer.byte_range)
+        if not (fast_open and sent_file is not None):
+            fast_open = False
+            if peer.state == HALF_OPEN and not (yield from self.three_way_handshake(client)):
+                return
+        while True:
+            # Without a file, the request is refused with a FIN-ACK and no metadata
+            sent = sent_file is None or (yield from self.transfer_file(client, sent_file, fast_open))
+            name = (yield from self.end_transfer(client, sent_file)) if sent else None
+            if sent_file is not None and sent_file is not self.sent_file:
+                sent_file.close()
+            if name is None:
+                break
+            fast_open = False
+            sent_file = self.request_file(name, peer.byte_range)
+
+    def read_cached(self, metrics: ConnectionMetrics, source, index: int, load, client) -> bytes:
+        """Get a segment through the segment cache, counting its hits and misses in the metrics of client"""
+        hits, misses = self.cache.hits, self.cache.misses
+        data = self.cache.get(source, index, load, client)
+        metrics.cache_hits.inc(self.cache.hits - hits)
+        metrics.cache_misses.inc(self.cache.misses - misses)
+        return data
+
+    def transfer_file(self, client, sent_file: SentFile, fast_open: bool = False):
+        """
+        Starts transferring file to client, as a step of its session
+        :param sent_file: the file sent
+        :param fast_open: send the metadata as a SYN, the handshake is done once the client acknowledges it
+        :return: whether the file was sent, False when the client never answered a fast open
+        """
+        transfer = self.start_transfer(client, sent_file, fast_open)
+        while transfer.sb < transfer.segment_count and not (transfer.reset or transfer.abandoned):
+            yield from self.send_window(transfer)
+            yield from self.receive_acks(transfer)
+            self.check_timeouts(transfer)
+        if not self.finish_transfer(transfer):
+            return False
+        if transfer.reset:
+            if not (yield from self.three_way_handshake(client)):
+                return False
+            return (yield from self.transfer_file(client, sent_file))
+        return True
+
+    def start_transfer(self, client, sent_file: SentFile, fast_open: bool) -> TransferState:
+        """Set up the transfer of sent_file to client, starting the timer of its fast open"""
+        peer = self.connections.get(client)
+        window_size = min(sent_file.segment_count, self.window_size)
+        pacer = Pacer(self.clock, self.policy.rate_cap(client[0]), self.pacing_burst, self.global_bucket,
+                      self.pacing_auto, window_size * (self.payload_size + HEADER_SIZE))
+        self.scheduler.add(client, pacer, self.policy.weight(client[0]))
+        transfer = TransferState(client, sent_file, peer, self.get_metrics(client), pacer, self.rto_policy(),
+                                 Summary(LOG, f"[Client {client[0]}:{client[1]}] Transfer progress:"),
+                                 self.clock.monotonic(), window_size)
+        LOG.info("[Client %s:%s] Initiating file transfer", *client)
+        if fast_open:
+            LOG.info("[Client %s:%s] Fast open, sending SYN with the metadata and the first window", *client)
+            transfer.syn_segment = self.fast_open_syn(peer, sent_file)
+            transfer.handshake_pending = True
+            transfer.handshake_timer = self.timers.schedule(self.connections.half_open_timeout,
+                                                            transfer.expire_handshake)
+        return transfer
+
+    def fast_open_syn(self, peer: Peer, sent_file: SentFile) -> Segment:
+        """SYN of a fast open, carrying the metadata of sent_file and the capabilities offered to peer"""
+        syn_segment = Segment()
+        syn_segment.set_flag(["SYN"])
+        syn_segment.set_header({"seq": METADATA_SEQ, "ack": 0})
+        syn_segment.set_payload(sent_file.metadata_segment.get_payload())
+        for kind, value in sent_file.metadata_segment.options.items():
+            syn_segment.set_option(kind, value)
+        self.offer_capabilities(peer.version, syn_segment)
+        return syn_segment
+
+    def complete_fast_open(self, transfer: TransferState):
+        """The client acknowledged the SYN of the fast open, the connection is established"""
+        transfer.handshake_pending = False
+        # The timer may have fired while the answer was queued
+        self.timers.cancel(transfer.handshake_timer)
+        transfer.handshake_expired = False
+        self.connections.establish(transfer.client, transfer.peer.version)
+        transfer.metrics.handshake_time.set(self.clock.monotonic() - transfer.start)
+        LOG.info("[Client %s:%s] Three-way handshake established", *transfer.client)
+
+    def send_turn(self, transfer: TransferState, data: bytes):
+        """Send data to the client once the send scheduler and its pacer give the connection its turn"""
+        asked = self.clock.monotonic()
+        yield len(data)
+        transfer.metrics.pacing_wait.inc(self.clock.monotonic() - asked)
+        self.conn.send(data, transfer.client[0], transfer.client[1])
+
+    def send_window(self, transfer: TransferState):
+        """
+        Send the window from the sequence base, as far as the receive window of the client allows,
+        each segment closing an FEC group followed by the parity of the group
+        """
+        client, sent_file, metrics = transfer.client, transfer.sent_file, transfer.metrics
+        sb = transfer.sb
+        sm = transfer.window_size
+        if transfer.receive_window is not None:
+            # Never send more than the client said it can take
+            sm = min(sm, transfer.receive_window // self.payload_size)
+            if sm == 0:
+                if transfer.probe:
+                    sm = 1
+                else:
+                    metrics.zero_windows.inc()
+                    transfer.probe_timer = self.timers.schedule(transfer.rto.timeout(), transfer.expire, sb)
+                    if LOG.isEnabledFor(logging.DEBUG):
+                        LOG.debug("[Client %s:%s] Receive window full, waiting for it to open", *client)
+        transfer.probe = False
+        transfer.window = sm
+        metrics.window_size.record(sm)
+        # Kirimkan data
+        for seq_number in range(sb, min(sb + sm, transfer.segment_count)):
+            if LOG.isEnabledFor(logging.DEBUG):
+                LOG.debug("[Client %s:%s][Num=%d] Sending Segment", client[0], client[1], seq_number)
+            if seq_number == METADATA_SEQ:
+                segment = sent_file.metadata_segment if transfer.syn_segment is None else transfer.syn_segment
+                data = segment.to_bytes()
+                payload_size = len(segment.data)
+            else:
+                data = self.read_cached(metrics, sent_file.key, seq_number - 3, sent_file.read_segments, client)
+                payload_size = len(data) - HEADER_SIZE
+            yield from self.send_turn(transfer, data)
+            self.timers.cancel(transfer.retransmit_timers.get(seq_number))
+            transfer.retransmit_timers[seq_number] = self.timers.schedule(transfer.rto.timeout(), transfer.expire,
+                                                                          seq_number)
+            transfer.summary.count("sent")
+            metrics.segments_sent.inc()
+            metrics.bytes_sent.inc(payload_size)
+            fec_group = transfer.peer.fec_group
+            if fec_group and seq_number > METADATA_SEQ and ((seq_number - 2) % fec_group == 0
+                                                            or seq_number == transfer.segment_count - 1):
+                # Last segment of its group, followed by the parity of the group
+                parity = self.read_cached(metrics, (sent_file.key, "parity", fec_group), (seq_number - 3) // fec_group,
+                                          partial(sent_file.read_parity, fec_group), client)
+                yield from self.send_turn(transfer, parity)
+                metrics.fec_parity_sent.inc()
+            if seq_number <= transfer.highest_sent:
+                metrics.retransmits.inc()
+                transfer.sent_at.pop(seq_number, None)
+            else:
+                transfer.highest_sent = seq_number
+                transfer.sent_at[seq_number] = self.clock.monotonic()
+
+    def receive_acks(self, transfer: TransferState):
+        """Wait for the ACKs of the window, until every segment sent is acknowledged or a timer fires"""
+        received = 0
+        while (received < max(transfer.window, 1) and not transfer.expired and not transfer.handshake_expired
+               and (transfer.retransmit_timers or transfer.probe_timer is not None)):
+            result = yield
+            if result is None:
+                continue
+            response, client_addr = result
+            try:
+                self.segment.parse(response)
+            except struct.error:
+                continue
+            if not self.segment.is_valid():
+                transfer.metrics.checksum_failures.inc()
+                continue
+            received += 1
+            self.handle_ack(transfer, client_addr)
+            if transfer.reset:
+                break
+
+    def handle_ack(self, transfer: TransferState, client_addr):
+        """Act on the segment received from client_addr while the window is waited for, parsed in self.segment"""
+        client, metrics = transfer.client, transfer.metrics
+        debug = LOG.isEnabledFor(logging.DEBUG)
+        if (transfer.syn_segment is not None and self.segment.get_flag() == SYN_ACK_FLAG
+                and self.segment.get_header()["ack"] == METADATA_SEQ + 1):
+            # The SYN-ACK of a fast open acknowledges the metadata sent with the SYN
+            self.agree_capabilities(client, self.segment)
+            self.segment.set_flag(["ACK"])
+        if (client_addr == client and self.segment.get_flag() == ACK_FLAG):
+            metrics.segments_received.inc()
+            acked_num = self.segment.get_header()["ack"]
+            if transfer.handshake_pending:
+                self.complete_fast_open(transfer)
+            sent = transfer.sent_at.pop(acked_num - 1, None)
+            if sent is not None:
+                rtt = self.clock.monotonic() - sent
+                metrics.rtt.observe(rtt)
+                transfer.rto.on_sample(rtt)
+                peer = transfer.peer
+                peer.srtt = rtt if peer.srtt is None else 0.875 * peer.srtt + 0.125 * rtt
+                transfer.pacer.on_rtt(rtt)
+            # The client reports how many datagrams its kernel dropped so far
+            drops, window = self.read_ack_report(client, self.segment)
+            if drops is not None:
+                if drops > metrics.peer_socket_drops.value:
+                    if transfer.pacer.on_drops(drops - metrics.peer_socket_drops.value):
+                        LOG.warning("[Client %s:%s] Client socket dropped %d datagrams, pacing at %.0f B/s",
+                                    client[0], client[1], drops, transfer.pacer.bucket.rate)
+                    metrics.peer_socket_drops.set(drops)
+            if window is not None:
+                transfer.receive_window = window
+                metrics.receive_window.set(window)
+            if (acked_num == transfer.sb + 1):
+                if debug:
+                    LOG.debug("[Client %s:%s][Num=%d] Received ACK from client",
+                              client[0], client[1], acked_num)
+                transfer.summary.count("acked")
+                transfer.sb += 1
+                transfer.window_size = min(transfer.segment_count - transfer.sb, self.window_size)
+            else:
+                if debug:
+                    LOG.debug("[Client %s:%s][Num=%d] Received ACK for wrong segment",
+                              client[0], client[1], acked_num)
+                transfer.summary.count("wrong_ack")
+                metrics.duplicates.inc()
+                if (acked_num > transfer.sb):
+                    transfer.window = (transfer.window - transfer.sb) + acked_num
+                    transfer.sb = acked_num
+            # The acknowledged segments need no retransmission
+            while transfer.timer_base < transfer.sb:
+                self.timers.cancel(transfer.retransmit_timers.pop(transfer.timer_base, None))
+                transfer.timer_base += 1
+        elif (client_addr != client):
+            LOG.error("[Client %s:%s][Num=%d] Received message from wrong client",
+                      client[0], client[1], transfer.sb)
+        elif (self.segment.get_flag() == SYN_ACK_FLAG):
+            LOG.info("[Client %s:%s] Asked to reset connection", *client)
+            transfer.reset = True
+        else:
+            LOG.error("[Client %s:%s][Num=%d] Received non-ACK flag",
+                      client[0], client[1], transfer.sb)
+
+    def check_timeouts(self, transfer: TransferState):
+        """
+        Once the window is no longer waited for, give up a fast open the client did not answer in time,
+        or go back to the sequence base if a segment timed out
+        """
+        self.timers.cancel(transfer.probe_timer)
+        transfer.probe_timer = None
+        if transfer.handshake_pending and transfer.handshake_expired:
+            transfer.abandoned = True
+            return
+        if not transfer.expired:
+            return
+        # Go back to sb, the segments of the window are all sent again with new timers
+        transfer.expired.clear()
+        for timer in transfer.retransmit_timers.values():
+            self.timers.cancel(timer)
+        transfer.retransmit_timers.clear()
+        transfer.timer_base = transfer.sb
+        transfer.rto.on_timeout()
+        if transfer.window == 0:
+            # The window update may have been lost, probe the client with the next segment
+            transfer.probe = True
+            return
+        LOG.error("[Client %s:%s][Num=%d] Connection time out, resending previous segments",
+                  transfer.client[0], transfer.client[1], transfer.sb)
+        transfer.metrics.timeouts.inc()
+
+    def finish_transfer(self, transfer: TransferState) -> bool:
+        """
+        Stop the timers of the transfer and record its metrics
+        :return: whether the transfer went through, False when the fast open was abandoned
+        """
+        client, sent_file, metrics = transfer.client, transfer.sent_file, transfer.metrics
+        for timer in transfer.retransmit_timers.values():
+            self.timers.cancel(timer)
+        self.timers.cancel(transfer.handshake_timer)
+        transfer.summary.flush()
+        self.cache.forget(sent_file.key, client)
+        self.cache.forget((sent_file.key, "parity", transfer.peer.fec_group), client)
+        if transfer.abandoned:
+            self.abandon(client)
+            return False
+        drops = self.conn.kernel_drops()
+        if drops is not None:
+            metrics.socket_drops.set(drops)
+        elapsed = self.clock.monotonic() - transfer.start
+        metrics.transfer_time.set(metrics.transfer_time.value + elapsed)
+        if metrics.transfer_time.value > 0:
+            metrics.goodput.set((sent_file.end - sent_file.start) / metrics.transfer_time.value)
+        return True
+
+    def end_transfer(self, client, sent_file: Optional[SentFile]):
+        """
+        Send FIN-ACK to end the transfer to client, as a step of its session. A client keeping its
+        session open answers with keepalives and its next request instead of closing the connection.
+        A FIN-ACK without metadata before it tells the client its request was refused.
+        The FIN-ACK is sent again after a few RTTs of the connection, backing off, and the client is
+        given up after FIN_RETRIES of them. Once the client acknowledged it, the session ends and the
+        connection lingers, without a session, to acknowledge the FIN-ACK of the client.
+        :param sent_file: the file sent, None for a refused request
+        :return: the name of the file requested next, None once the connection is closed
+        """
+        LOG.info("[Client %s:%s] File transfer finished, sending FIN message", *client)
+        fin_segment = Segment()
+        fin_segment.set_flag(["FIN", "ACK"])
+        # Sequence number following the last data segment, so the client can tell a late copy apart
+        segment_count = 0 if sent_file is None else sent_file.segment_count
+        fin_segment.set_header({"seq": segment_count + 2, "ack": segment_count + 2})
+        peer = self.connections.get(client)
+        interval = RTO_INITIAL if peer.srtt is None else max(2 * peer.srtt, RTO_MIN)
+        retries = 0
+
+        # Whether the client received the FIN-ACK and keeps its session open
+        idle = False
+        # Timers that fired: "resend" to send the FIN-ACK again, "teardown" to close an idle session
+        expired = []
+        session_limit = self.clock.monotonic() + self.session_idle
+        teardown = None
+
+        while True:
+            if not idle:
+                self.conn.send(fin_segment.to_bytes(), client[0], client[1])
+            resend = self.timers.schedule(interval, expired.append, "resend")
+            result = None
+            while result is None and not expired:
+                result = yield
+            self.timers.cancel(resend)
+            if result is None:
+                if "teardown" in expired or (not idle and retries >= FIN_RETRIES):
+                    LOG.warning(
+                        "[Client %s:%s] [Timeout] Server waited too long, connection closed.", *client)
+                    break
+                expired.clear()
+                if not idle:
+                    LOG.warning("[Client %s:%s] Connection timed out. Resending FIN message", *client)
+                    retries += 1
+                    interval = min(interval * 2, TIMEOUT)
+                continue
+            response, client_addr = result
+            try:
+                self.segment.parse(response)
+            except struct.error:
+                continue
+            if (client_addr == client and self.segment.get_flag() == ACK_FLAG
+                    and self.segment.get_header()["seq"] >= fin_segment.get_header()["seq"]):
+                LOG.info("[Client %s:%s] Received ACK for FIN from client", *client)
+                self.linger(client)
+                break
+            elif (client_addr == client and self.segment.get_flag() == FIN_ACK_FLAG):
+                # The client sends its FIN-ACK after its ACK, which was lost
+                self.linger(client)
+                self.answer_closing(client, response)
+                break
+            elif (client_addr == client and self.segment.get_flag() == ACK_FLAG):
+                # Late ACK of a data segment, the client has not received the FIN-ACK yet
+                continue
+            elif (client_addr == client and self.segment.get_flag() == CONNECT_FLAG):
+                name = self.segment.get_payload().decode(errors="replace")
+                if name:
+                    LOG.info("[Client %s:%s] Received request for %s in the session", client[0], client[1], name)
+                    peer.byte_range = self.segment.get_range_option(OPTION_RANGE)
+                    self.timers.cancel(teardown)
+                    return name
+                # Keepalive of an idle session, echoed back
+                self.conn.send(self.segment.to_bytes(), client[0], client[1])
+                idle = True
+                interval = TIMEOUT
+                self.timers.cancel(teardown)
+                teardown = self.timers.schedule_at(min(self.clock.monotonic() + TIMEOUT_LISTEN, session_limit),
+                                                   expired.append, "teardown")
+            elif (client_addr != client):
+                LOG.warning("[Client %s:%s] Received message from wrong client", *client)
+            else:
+                LOG.warning("[Client %s:%s] Received non-ACK flag", *client)
+        self.timers.cancel(teardown)
+        return None
 
 
 if __name__ == "__main__":
-    SERVER = Server()
-    SERVER.split_file()
-    SERVER.listen_for_clients()
-    SERVER.initiate_transfer()
+    ARGS = parse_args(True)
+    if ARGS.daemon and ARGS.workers > 1:
+        configure_logging(ARGS.log_level)
+        if not transport_class(ARGS.server_ip or DEFAULT_IP).shares_port:
+            LOG.error("Workers share their port with SO_REUSEPORT, which needs a UDP address")
+            sys.exit(1)
+        WORKER = Supervisor(ARGS.workers).run()
+        if WORKER is None:
+            sys.exit(0)
+        # Every worker writes its own metrics, profiles and trace
+        ARGS.metrics_out = worker_path(ARGS.metrics_out, WORKER)
+        ARGS.profile_out = worker_path(ARGS.profile_out, WORKER)
+        ARGS.cprofile = worker_path(ARGS.cprofile, WORKER)
+        ARGS.trace = worker_path(ARGS.trace, WORKER)
+    SERVER = Server(ARGS)
+    if SERVER.daemon:
+        try:
+            SERVER.serve_forever()
+        except KeyboardInterrupt:
+            LOG.info("Server daemon stopped")
+    else:
+        SERVER.split_file()
+        SERVER.listen_for_clients()
+        SERVER.initiate_transfer()
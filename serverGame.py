@@ -3,15 +3,19 @@ The module for the server class of the file transfer application using UDP
 """
 import sys
 import os
-import time
+import struct
 from typing import List
 from math import ceil
 from socket import timeout
 from lib.parserGame import parse_args_game
 from lib.connection import Connection
 from lib.segment import Segment
-from lib.constants import DEFAULT_IP, SEGMENT_SIZE, PAYLOAD_SIZE, SYN_FLAG, SYN_ACK_FLAG, ACK_FLAG, TIMEOUT_LISTEN, FIN_ACK_FLAG
+from lib.constants import (
+    DEFAULT_IP, SEGMENT_SIZE, PAYLOAD_SIZE, SYN_FLAG, SYN_ACK_FLAG, ACK_FLAG, FIN_ACK_FLAG, FIN_RETRIES, LINGER,
+    RTO_INITIAL, TIMEOUT
+)
 from lib.tictactoe import TicTacToe
+from lib.timer_wheel import TimerWheel
 from lib.crc16 import crc16
 
 class ServerGame:
@@ -29,6 +33,7 @@ class ServerGame:
         self.segment_list : List[Segment] = []
         self.client_list = []
         self.tic_tac_toe = TicTacToe()
+        self.timers = TimerWheel()
 
     def listen_for_clients(self) :
         print("[ INFO ] Listening for clients")
@@ -159,55 +164,74 @@ class ServerGame:
         self.conn.close()
 
     def close_connection(self, client) :
-        self.segment.set_flag([])
-        fin_acked = False
-        time_limit = time.time() + TIMEOUT_LISTEN
+        """Close the connection to client, see close_connections"""
+        self.close_connections([client])
 
-        while not fin_acked:
-            try :
-                self.segment.set_payload(bytes())
-                self.segment.set_flag(["FIN", "ACK"])
-                self.conn.send(self.segment.to_bytes(), client[0], client[1])
-                response, client_addr = self.conn.listen_segment()
-                self.segment = Segment.from_bytes(response)
-                if (client_addr == client and self.segment.get_flag() == ACK_FLAG) :
-                    print(f'[Client {client[0]}:{client[1]}] Received ACK for FIN from client')
-                    fin_acked = True
-                elif (client_addr != client) :
-                    print(f'[Client {client[0]}:{client[1]}] Received message from wrong client')
-                else :
-                    print(f'[Client {client[0]}:{client[1]}] Received non-ACK flag')
-            except :
-                if time.time() > time_limit:
-                    print(
-                        f"[ WARNING ] [Client {client[0]}:{client[1]}] [Timeout] Server waited too long, connection closed."
-                    )
-                    break
-                print(f'[Client {client[0]}:{client[1]}] Connection timed out. Resending FIN message')
-        
-        client_fin_acked = False
-        time_limit = time.time() + TIMEOUT_LISTEN
-        while (not client_fin_acked) :
+    def close_connections(self, clients) :
+        """
+        Close the connections to clients at once, on the timers of the server: the FIN-ACK of each
+        one is sent again from its timer, backing off, and the client is given up after FIN_RETRIES.
+        Once a client acknowledged it, its connection lingers until its linger timer to acknowledge
+        the FIN-ACK of the client, while the others are still being closed.
+        """
+        fin_segment = Segment()
+        fin_segment.set_flag(["FIN", "ACK"])
+        fin = fin_segment.to_bytes()
+        # Timers that fired, as ("resend" or "linger", client)
+        expired = []
+        # Retransmission interval, retries and timer of the clients whose FIN-ACK is not acknowledged
+        closing = {}
+        # Linger timer of the clients that acknowledged it
+        lingering = {}
+        for client in clients :
+            self.conn.send(fin, client[0], client[1])
+            closing[client] = [RTO_INITIAL, 0, self.timers.schedule(RTO_INITIAL, expired.append, ("resend", client))]
+
+        while closing or lingering :
+            result = self.conn.listen_until(self.timers)
+            if result is None :
+                for kind, client in expired :
+                    if kind == "linger" :
+                        print(f'[Client {client[0]}:{client[1]}] Linger over, connection closed.')
+                        lingering.pop(client, None)
+                        continue
+                    state = closing[client]
+                    if state[1] >= FIN_RETRIES :
+                        print(
+                            f"[ WARNING ] [Client {client[0]}:{client[1]}] [Timeout] Server waited too long, connection closed."
+                        )
+                        del closing[client]
+                        continue
+                    print(f'[Client {client[0]}:{client[1]}] Connection timed out. Resending FIN message')
+                    state[0] = min(state[0] * 2, TIMEOUT)
+                    state[1] += 1
+                    self.conn.send(fin, client[0], client[1])
+                    state[2] = self.timers.schedule(state[0], expired.append, ("resend", client))
+                expired.clear()
+                continue
+            response, client_addr = result
             try :
-                response, client_addr = self.conn.listen_segment()
                 self.segment = Segment.from_bytes(response)
-                if (client_addr == client and self.segment.get_flag() == FIN_ACK_FLAG) :
-                    print(f'[Client {client[0]}:{client[1]}] Received FIN request from client. Sending ACK and shutting down connection.')
-                    self.segment.set_payload(bytes())
-                    self.segment.set_flag(["ACK"])
-                    self.conn.send(self.segment.to_bytes(), client[0], client[1])
-                    client_fin_acked = True
-                elif (client_addr != client) :
-                    print(f'[Client {client[0]}:{client[1]}] Received message from wrong client')
-                else :
-                    print(f'[Client {client[0]}:{client[1]}] Received non-FIN-ACK flag')
-            except TimeoutError :
-                if time.time() > time_limit:
-                    print(
-                        f"[ WARNING ] [Client {client[0]}:{client[1]}] [Timeout] Server waited too long, connection closed."
-                    )
-                    break
-                print(f'[Client {client[0]}:{client[1]}] Connection timed out. Waiting again.')
+            except struct.error :
+                continue
+            if client_addr not in closing and client_addr not in lingering :
+                print(f'[Client {client_addr[0]}:{client_addr[1]}] Received message from wrong client')
+            elif self.segment.get_flag() == ACK_FLAG :
+                if client_addr in closing :
+                    print(f'[Client {client_addr[0]}:{client_addr[1]}] Received ACK for FIN from client')
+                    self.timers.cancel(closing.pop(client_addr)[2])
+                    lingering[client_addr] = self.timers.schedule(LINGER, expired.append, ("linger", client_addr))
+            elif self.segment.get_flag() == FIN_ACK_FLAG :
+                # Also ends the closing of a client whose ACK was lost, it sends its FIN-ACK after it
+                print(f'[Client {client_addr[0]}:{client_addr[1]}] Received FIN request from client. Sending ACK and shutting down connection.')
+                self.segment.set_payload(bytes())
+                self.segment.set_flag(["ACK"])
+                self.conn.send(self.segment.to_bytes(), client_addr[0], client_addr[1])
+                if client_addr in closing :
+                    self.timers.cancel(closing.pop(client_addr)[2])
+                self.timers.cancel(lingering.pop(client_addr, None))
+            else :
+                print(f'[Client {client_addr[0]}:{client_addr[1]}] Received non-ACK flag')
 
     def send_move(self, move : int, currClient) :
         header = self.segment.get_header()
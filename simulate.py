@@ -0,0 +1,258 @@
+"""
+simulate.py runs the server and client on the simulated network of lib/simulation.py.
+The protocol code of server.py and client.py runs unchanged on a virtual clock, so a
+transfer that takes minutes on real sockets because of the timeouts finishes in
+milliseconds, and the same seed always gives the same result.
+
+Every combination of the given file sizes, segment sizes, window sizes, loss rates,
+RTTs and RTO policies is run --runs times with different seeds. With --clients, that
+many clients fetch the file at once, and the times are those of the last one to finish. Every run is written
+as one JSON line, followed by a summary of each combination.
+Usage: python3 simulate.py [--window-sizes 1 4 8] [--loss-rates 0 0.05] [--rtts 10 100]
+"""
+import argparse
+import functools
+import io
+import itertools
+import json
+import logging
+import random
+import sys
+import time
+from multiprocessing import Pool
+from lib.constants import PROXY_QUEUE_LIMIT, RECEIVE_BUFFER
+from lib.impairment import Impairment
+from lib.logger import get_logger
+from lib.parser import parse_args
+from lib.rto import RTO_POLICIES
+from lib.simulation import SimulatedDisk, SimulatedNetwork
+from server import Server
+from client import Client
+
+SERVER_ADDRESS = ("10.0.0.1", 9999)
+CLIENT_ADDRESS = ("10.0.0.2", 8000)
+# Virtual seconds after which a transfer counts as stuck
+TIME_LIMIT = 3600
+SUMMARY_KEYS = ["segment_size", "window_size", "loss_rate", "rtt", "jitter", "rto", "pacing_rate", "handshake", "receive_buffer", "fec", "clients"]
+
+
+def parse_simulate_args():
+    """Parse the argument when running the simulator"""
+    parser = argparse.ArgumentParser(
+        description="Deterministic simulation of the file transfer application on a virtual network"
+    )
+    parser.add_argument("--file-sizes", type=int, nargs="+", default=[16384],
+                        help="The sizes of the transferred files in bytes")
+    parser.add_argument("--segment-sizes", type=int, nargs="+", default=[1024],
+                        help="The segment sizes to use, header included")
+    parser.add_argument("--window-sizes", type=int, nargs="+", default=[1, 4, 8],
+                        help="The window sizes to use")
+    parser.add_argument("--loss-rates", type=float, nargs="+", default=[0.0, 0.05],
+                        help="The fraction of the datagrams dropped in each direction")
+    parser.add_argument("--rtts", type=float, nargs="+", default=[10.0, 100.0],
+                        help="The round trip times of the link in milliseconds")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="The one-way delay variation in milliseconds")
+    parser.add_argument("--rto", choices=list(RTO_POLICIES), nargs="+", default=list(RTO_POLICIES),
+                        help="The retransmission timeout policies to compare")
+    parser.add_argument("--link-rate", type=float, default=0.0,
+                        help="The rate of the links in bytes per second, 0 for no limit")
+    parser.add_argument("--queue-limit", type=int, default=PROXY_QUEUE_LIMIT,
+                        help="The bytes that can wait for a rate limited link before datagrams are dropped")
+    parser.add_argument("--pacing-rates", type=float, nargs="+", default=[0.0],
+                        help="The pacing rates of the server in bytes per second to compare, 0 for no pacing")
+    parser.add_argument("--global-rate", type=float, default=0.0,
+                        help="The rate of all the connections of the server together in bytes per second, 0 for no limit")
+    parser.add_argument("--pacing-auto", action="store_true",
+                        help="Also pace the server at its window size divided by the RTT")
+    parser.add_argument("--handshakes", choices=["fast", "full"], nargs="+", default=["fast"],
+                        help="Whether the client asks for a fast open or always does the full handshake")
+    parser.add_argument("--disk-rate", type=float, default=0.0,
+                        help="The rate the client writes to disk in bytes per second, 0 for no limit")
+    parser.add_argument("--receive-buffers", type=int, nargs="+", default=[RECEIVE_BUFFER],
+                        help="The receive buffers of the client to compare, 0 for synchronous writes and no receive window")
+    parser.add_argument("--fec-groups", type=int, nargs="+", default=[0],
+                        help="The FEC group sizes of the server to compare, 0 for no FEC")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1],
+                        help="The numbers of clients fetching the file at once to compare")
+    parser.add_argument("--runs", type=int, default=5,
+                        help="How many seeds every combination is run with")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="The seed of the first run")
+    parser.add_argument("--time-limit", type=float, default=TIME_LIMIT,
+                        help="The virtual seconds after which a transfer is aborted")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="The number of processes running simulations")
+    parser.add_argument("--output", type=str, default="-",
+                        help="The JSON lines file to write the results to, - for stdout")
+    return parser.parse_args()
+
+
+def client_address(index: int) -> tuple:
+    """Address of the client index of a run, the first one being CLIENT_ADDRESS"""
+    return f"10.0.0.{2 + index}", CLIENT_ADDRESS[1]
+
+
+def simulate(case: dict) -> dict:
+    """Run one transfer on a simulated network and return its result"""
+    rng = random.Random(f"{case['seed']}/file")
+    data = rng.randbytes(case["file_size"])
+
+    def link(src, dst) -> Impairment:
+        return Impairment(
+            loss=case["loss_rate"],
+            delay=case["rtt"] / 2000,
+            jitter=case["jitter"] / 1000,
+            rate=case["link_rate"],
+            queue_limit=case["queue_limit"],
+            seed=f"{case['seed']}/{src[0]}/{dst[0]}",
+        )
+
+    network = SimulatedNetwork(link, time_limit=case["time_limit"])
+    server_conn = network.connection(SERVER_ADDRESS[0], SERVER_ADDRESS[1])
+    addresses = [client_address(index) for index in range(case["clients"])]
+    server_args = parse_args(True, [
+        str(SERVER_ADDRESS[1]), "sim.bin", SERVER_ADDRESS[0],
+        "--segment-size", str(case["segment_size"]),
+        "--window-size", str(case["window_size"]),
+        "--rto", case["rto"],
+        "--clients", str(case["clients"]),
+        "--pacing-rate", str(case["pacing_rate"]),
+        "--global-rate", str(case["global_rate"]),
+        "--fec", str(case["fec"]),
+    ] + (["--pacing-auto"] if case["pacing_auto"] else []))
+    server = Server(server_args, server_conn, server_conn.clock, io.BytesIO(data))
+    clients = []
+    for address in addresses:
+        client_conn = network.connection(address[0], address[1], SERVER_ADDRESS[1])
+        client_args = parse_args(False, [
+            str(address[1]), str(SERVER_ADDRESS[1]), "sim.bin", SERVER_ADDRESS[0], address[0],
+            "--receive-buffer", str(case["receive_buffer"]),
+        ] + (["--no-fast-open"] if case["handshake"] == "full" else []))
+        received = io.BytesIO()
+        output = received
+        if case["disk_rate"]:
+            output = SimulatedDisk(received, case["disk_rate"], case["receive_buffer"], client_conn.clock)
+        clients.append((client_conn, Client(client_args, client_conn, client_conn.clock, output), received))
+    get_logger().setLevel(logging.CRITICAL)
+
+    def run_server():
+        server.split_file()
+        server.listen_for_clients()
+        server.initiate_transfer()
+
+    def run_client(client: Client):
+        client.connect()
+        client.three_way_handshake()
+        client.listen_file_transfer()
+
+    started = time.perf_counter()
+    errors = network.run([(server_conn, run_server)] + [
+        (client_conn, functools.partial(run_client, client)) for client_conn, client, _ in clients
+    ])
+    # The sessions that ended are in the totals of the closed connections, the others still have their own
+    server_metrics = [server.closed_metrics] + list(server.metrics.values())
+    client_metrics = [client.metrics for _, client, _ in clients]
+    total = lambda metrics, name: sum(getattr(metric, name).value for metric in metrics)
+    served = lambda name: sum(registry.counter(name).value for registry in server_metrics)
+    # Times of the last client to finish
+    transfer_time = max(metrics.transfer_time.value for metrics in client_metrics)
+    result = dict(case)
+    result.update({
+        "ok": not errors and all(received.getvalue() == data for _, _, received in clients),
+        "aborted": network.aborted,
+        "error": repr(errors[0]) if errors else None,
+        "virtual_seconds": network.now,
+        "wall_seconds": time.perf_counter() - started,
+        "transfer_seconds": transfer_time,
+        "fastest_transfer_seconds": min(metrics.transfer_time.value for metrics in client_metrics),
+        "first_byte_seconds": max(metrics.first_byte_time.value for metrics in client_metrics),
+        "goodput_bytes_per_second": len(data) * len(clients) / transfer_time if transfer_time else 0.0,
+        "segments_sent": served("segments_sent_total"),
+        "retransmits": served("retransmits_total"),
+        "timeouts": served("timeouts_total"),
+        "zero_windows": served("zero_windows_total"),
+        "pacing_wait_seconds": served("pacing_wait_seconds_total"),
+        "queue_dropped": sum(link.stats["queue_dropped"] for link in network.links.values()),
+        "acks_sent": total(client_metrics, "segments_sent"),
+        "fec_parity_sent": served("fec_parity_sent_total"),
+        "fec_recovered": total(client_metrics, "fec_recovered"),
+    })
+    return result
+
+
+def summarize(results: list):
+    """Print the mean result of every combination, over its runs"""
+    groups = {}
+    for result in results:
+        groups.setdefault(tuple(result[key] for key in SUMMARY_KEYS), []).append(result)
+    for key, runs in groups.items():
+        done = [run for run in runs if run["ok"]]
+        description = " ".join(f"{name}={value}" for name, value in zip(SUMMARY_KEYS, key))
+        if not done:
+            print(f"[ SIM ] {description}: 0/{len(runs)} ok", file=sys.stderr)
+            continue
+        mean = lambda field: sum(run[field] for run in done) / len(done)
+        print(f"[ SIM ] {description}: {len(done)}/{len(runs)} ok, "
+              f"first byte {mean('first_byte_seconds'):.3f} s, transfer {mean('transfer_seconds'):.3f} s, "
+              f"goodput {mean('goodput_bytes_per_second'):.0f} B/s, "
+              f"retransmits {mean('retransmits'):.1f}, timeouts {mean('timeouts'):.1f}, "
+              f"rebuilt {mean('fec_recovered'):.1f}, "
+              f"queue drops {mean('queue_dropped'):.1f}", file=sys.stderr)
+
+
+def main():
+    args = parse_simulate_args()
+    output = sys.stdout if args.output == "-" else open(args.output, "w")
+    combinations = itertools.product(
+        args.file_sizes, args.segment_sizes, args.window_sizes, args.loss_rates, args.rtts,
+        args.rto, args.pacing_rates, args.handshakes, args.receive_buffers, args.fec_groups, args.clients,
+        range(args.runs)
+    )
+    cases = [
+        {
+            "file_size": file_size,
+            "segment_size": segment_size,
+            "window_size": window_size,
+            "loss_rate": loss_rate,
+            "rtt": rtt,
+            "jitter": args.jitter,
+            "rto": rto,
+            "link_rate": args.link_rate,
+            "queue_limit": args.queue_limit,
+            "pacing_rate": pacing_rate,
+            "pacing_auto": args.pacing_auto,
+            "global_rate": args.global_rate,
+            "handshake": handshake,
+            "disk_rate": args.disk_rate,
+            "receive_buffer": receive_buffer,
+            "fec": fec,
+            "clients": clients,
+            "seed": args.seed + run,
+            "time_limit": args.time_limit,
+        }
+        for file_size, segment_size, window_size, loss_rate, rtt, rto, pacing_rate, handshake, receive_buffer, fec, clients, run
+        in combinations
+    ]
+
+    started = time.perf_counter()
+    results = []
+    with Pool(args.jobs) as pool:
+        for result in pool.imap(simulate, cases):
+            results.append(result)
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+    if output is not sys.stdout:
+        output.close()
+
+    summarize(results)
+    failed = [result for result in results if not result["ok"]]
+    print(f"[ SIM ] {len(results)} transfers simulated in {time.perf_counter() - started:.1f} s",
+          file=sys.stderr)
+    if failed:
+        print(f"[ ERROR ] {len(failed)} transfer(s) did not complete correctly", file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
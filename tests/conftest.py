@@ -0,0 +1,18 @@
+"""
+Shared setup of the tests: the modules are imported from the root of the repository, like the
+scripts do, and every test runs in its own directory holding sent_file/ and received_file/.
+"""
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Directory the test runs in, with the sent_file/ and received_file/ of the server and client"""
+    (tmp_path / "sent_file").mkdir()
+    (tmp_path / "received_file").mkdir()
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
@@ -0,0 +1,89 @@
+"""Tests of lib.fec and of the parity segments of lib.sent_file"""
+import io
+import random
+import pytest
+from lib.constants import HEADER_SIZE, MAX_SEGMENT_SIZE
+from lib.fec import DATA_SEQ, PARITY_OPTIONS_SIZE, FecReceiver, parity_segment
+from lib.parser import parse_args
+from lib.segment import Segment
+from lib.sent_file import SentFile
+
+GROUP = 4
+PAYLOAD_SIZE = 100
+
+
+def payloads(count: int, last: int = PAYLOAD_SIZE) -> list:
+    """count payloads of random bytes, the last one of last bytes"""
+    rng = random.Random(count)
+    return [rng.randbytes(PAYLOAD_SIZE if i < count - 1 else last) for i in range(count)]
+
+
+def receive(group: list, lost: int) -> list:
+    """
+    Receive the segments of a group starting at DATA_SEQ and then its parity, all but lost.
+    :return: the payloads delivered in order, and whether each one was rebuilt
+    """
+    fec = FecReceiver(GROUP)
+    next_seq = DATA_SEQ
+    delivered = []
+    for seq, payload in enumerate(group, DATA_SEQ):
+        if seq - DATA_SEQ == lost:
+            continue
+        fec.add(next_seq, seq, payload)
+        if seq == next_seq:
+            delivered.append((payload, False))
+            next_seq += 1
+    # The parity goes over the wire
+    assert fec.add_parity(next_seq, Segment.from_bytes(parity_segment(DATA_SEQ, group).to_bytes()))
+    payload, rebuilt = fec.take(next_seq)
+    while payload is not None:
+        delivered.append((payload, rebuilt))
+        next_seq += 1
+        payload, rebuilt = fec.take(next_seq)
+    return delivered
+
+
+@pytest.mark.parametrize("lost", range(GROUP))
+def test_lost_segment_is_rebuilt(lost):
+    group = payloads(GROUP)
+    delivered = receive(group, lost)
+    assert [payload for payload, _ in delivered] == group
+    assert [rebuilt for _, rebuilt in delivered] == [i == lost for i in range(GROUP)]
+
+
+@pytest.mark.parametrize("lost", [0, 1])
+def test_short_last_group_is_rebuilt(lost):
+    # The last group of a file holds fewer segments, the last one shorter than the others
+    group = payloads(2, last=37)
+    delivered = receive(group, lost)
+    assert [payload for payload, _ in delivered] == group
+    assert delivered[lost][1]
+
+
+def test_two_lost_segments_are_not_rebuilt():
+    group = payloads(GROUP)
+    fec = FecReceiver(GROUP)
+    fec.add(DATA_SEQ, DATA_SEQ + 2, group[2])
+    fec.add(DATA_SEQ, DATA_SEQ + 3, group[3])
+    fec.add_parity(DATA_SEQ, parity_segment(DATA_SEQ, group))
+    assert fec.take(DATA_SEQ) == (None, False)
+
+
+def test_parity_of_the_short_last_group_is_read_from_the_file():
+    data = random.Random(3).randbytes(PAYLOAD_SIZE * 6 + 37)
+    sent_file = SentFile(io.BytesIO(data), "data.bin", PAYLOAD_SIZE)
+    sent_file.split()
+    chunks = [data[i:i + PAYLOAD_SIZE] for i in range(0, len(data), PAYLOAD_SIZE)]
+    # Groups of 4 data segments: 0 to 3, then the 3 last ones
+    for group, first in enumerate(range(0, len(chunks), GROUP)):
+        parity = sent_file.read_parity(GROUP, group, 1)
+        assert parity == [parity_segment(DATA_SEQ + first, chunks[first:first + GROUP]).to_bytes()]
+
+
+def test_parity_fits_a_datagram():
+    size = MAX_SEGMENT_SIZE - PARITY_OPTIONS_SIZE
+    args = parse_args(True, ["9000", "data.bin", "--fec", "4", "--segment-size", str(size)])
+    parity = parity_segment(DATA_SEQ, [bytes(args.segment_size - HEADER_SIZE)] * 4)
+    assert len(parity.to_bytes()) <= MAX_SEGMENT_SIZE
+    with pytest.raises(SystemExit):
+        parse_args(True, ["9000", "data.bin", "--fec", "4", "--segment-size", str(size + 1)])
@@ -0,0 +1,98 @@
+"""Tests of lib.scheduler"""
+import ipaddress
+from lib.scheduler import ClientPolicy, SendScheduler
+from lib.timer_wheel import TimerWheel
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+class FakePacer:
+    """Pacer whose tokens are given by the test"""
+
+    def __init__(self, wait: float = 0.0) -> None:
+        self.wait = wait
+        self.taken = 0
+
+    def delay(self) -> float:
+        return self.wait
+
+    def take(self, size: int):
+        self.taken += size
+
+
+def turns(scheduler: SendScheduler, sizes: dict, count: int) -> list:
+    """Give count turns, every flow asking for its next one of sizes[flow] bytes once it got one"""
+    for key, size in sizes.items():
+        scheduler.request(key, size)
+    given = []
+    for _ in range(count):
+        key = scheduler.next()
+        given.append(key)
+        if key is not None:
+            scheduler.request(key, sizes[key])
+    return given
+
+
+def test_flows_share_turns_by_bytes():
+    scheduler = SendScheduler(TimerWheel(FakeClock()), quantum=1000)
+    for key in "ab":
+        scheduler.add(key)
+    given = turns(scheduler, {"a": 1000, "b": 500}, 30)
+    # The flow of small datagrams sends two of them for one of the other
+    assert given.count("b") == 2 * given.count("a")
+
+
+def test_weight_multiplies_the_share():
+    scheduler = SendScheduler(TimerWheel(FakeClock()), quantum=500)
+    scheduler.add("a", weight=3)
+    scheduler.add("b")
+    given = turns(scheduler, {"a": 500, "b": 500}, 40)
+    assert given.count("a") == 3 * given.count("b")
+
+
+def test_datagram_larger_than_quantum_gets_its_turn():
+    scheduler = SendScheduler(TimerWheel(FakeClock()), quantum=100)
+    scheduler.add("a")
+    scheduler.request("a", 1000)
+    assert scheduler.next() == "a"
+    assert not scheduler.waiting("a")
+
+
+def test_paced_flow_waits_for_its_tokens():
+    timers = TimerWheel(FakeClock())
+    scheduler = SendScheduler(timers, quantum=1000)
+    pacer = FakePacer(wait=0.5)
+    scheduler.add("a", pacer)
+    scheduler.request("a", 100)
+    assert scheduler.next() is None
+    # A timer wakes the server once the pacer has tokens
+    assert timers.time_left() >= 0.5
+    pacer.wait = 0.0
+    assert scheduler.next() == "a"
+    assert pacer.taken == 100
+
+
+def test_removed_flow_loses_its_turn():
+    scheduler = SendScheduler(TimerWheel(FakeClock()), quantum=1000)
+    scheduler.add("a")
+    scheduler.request("a", 100)
+    scheduler.remove("a")
+    assert scheduler.next() is None
+    assert not scheduler.waiting("a")
+
+
+def test_policy_uses_the_most_specific_network():
+    policy = ClientPolicy([(ipaddress.ip_network("10.0.0.0/8"), 2.0), (ipaddress.ip_network("10.1.0.0/16"), 5.0)],
+                          [(ipaddress.ip_network("10.0.0.0/8"), 1000.0)], rate=50.0)
+    assert policy.weight("10.1.2.3") == 5.0
+    assert policy.weight("10.2.0.1") == 2.0
+    assert policy.weight("192.168.0.1") == 1.0
+    assert policy.weight("mem:test") == 1.0
+    assert policy.rate_cap("10.2.0.1") == 1000.0
+    assert policy.rate_cap("192.168.0.1") == 50.0
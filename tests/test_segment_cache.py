@@ -0,0 +1,67 @@
+"""Tests of lib.segment_cache"""
+from lib.segment_cache import SegmentCache
+
+
+class Loader:
+    """load function of a file of count segments, recording its calls"""
+
+    def __init__(self, count: int = 100) -> None:
+        self.count = count
+        self.calls = []
+
+    def __call__(self, index: int, count: int) -> list:
+        self.calls.append((index, count))
+        count = max(min(count, self.count - index), 1)
+        return [b"segment %d" % (index + i) for i in range(count)]
+
+
+def test_first_miss_does_not_read_ahead():
+    cache = SegmentCache(budget=1 << 20, read_ahead=8)
+    load = Loader()
+    assert cache.get("file", 0, load) == b"segment 0"
+    assert load.calls == [(0, 1)]
+
+
+def test_sequential_miss_reads_ahead():
+    cache = SegmentCache(budget=1 << 20, read_ahead=8)
+    load = Loader()
+    cache.get("file", 0, load)
+    assert cache.get("file", 1, load) == b"segment 1"
+    for index in range(2, 9):
+        assert cache.get("file", index, load) == b"segment %d" % index
+    assert load.calls == [(0, 1), (1, 8)]
+    assert (cache.hits, cache.misses) == (7, 2)
+    assert cache.size == sum(len(data) for data in cache.entries.values())
+
+
+def test_readers_are_read_ahead_for_on_their_own():
+    cache = SegmentCache(budget=1 << 20, read_ahead=8)
+    load = Loader()
+    cache.get("file", 0, load, "a")
+    cache.get("file", 1, load, "a")
+    # Segment 0 was cached by a, b still has to read it
+    assert cache.get("file", 0, load, "b") == b"segment 0"
+    cache.forget("file", "a")
+    cache.get("file", 20, load, "a")
+    assert load.calls == [(0, 1), (1, 8), (20, 1)]
+
+
+def test_no_read_ahead_without_budget():
+    cache = SegmentCache(budget=0, read_ahead=8)
+    load = Loader()
+    for index in range(3):
+        assert cache.get("file", index, load) == b"segment %d" % index
+    assert load.calls == [(0, 1), (1, 1), (2, 1)]
+    assert not cache.entries and cache.size == 0
+
+
+def test_evicts_least_recently_used_within_budget():
+    cache = SegmentCache(budget=20, read_ahead=1)
+    load = Loader()
+    cache.get("file", 0, load)
+    cache.get("file", 5, load)
+    cache.get("file", 0, load)
+    cache.get("file", 9, load)
+    assert list(cache.entries) == [("file", 0), ("file", 9)]
+    assert cache.evictions == 1
+    assert cache.size <= cache.budget
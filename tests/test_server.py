@@ -0,0 +1,179 @@
+"""
+Tests of the sessions of server.Server against malformed datagrams and unanswered fast opens,
+on a fake connection and clock so the timers fire without waiting.
+"""
+from collections import deque
+import pytest
+from lib.constants import FIN_ACK_FLAG, METADATA_SEQ
+from lib.parser import parse_args
+from lib.segment import Segment
+from server import Server
+
+CLIENT = ("mem:test", 7001)
+# Data segments of the file sent, of 1014 bytes each with a segment size of 1024
+SEGMENTS = 3
+
+
+class FakeClock:
+    """Virtual clock, moved forward by the FakeConnection when the server waits"""
+
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def time(self) -> float:
+        return self.now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+
+class FakeConnection:
+    """
+    Connection of the server to a client that acknowledges every segment in order once it is
+    answering, and whose datagrams in arrivals are queued once the clock reached their time.
+    """
+
+    def __init__(self, clock: FakeClock) -> None:
+        self.clock = clock
+        self.inbox = deque()
+        self.sent = []
+        # (time, datagram) the client sends on its own, earliest first
+        self.arrivals = []
+        self.answering = False
+
+    def send(self, msg, ip: str, port: int):
+        self.sent.append(msg)
+        if not self.answering:
+            return
+        segment = Segment.from_bytes(msg)
+        seq = segment.get_header()["seq"]
+        if segment.get_flag() == FIN_ACK_FLAG:
+            self.inbox.append((ack(seq), CLIENT))
+        elif seq > METADATA_SEQ:
+            self.inbox.append((ack(seq), CLIENT))
+
+    def listen_until(self, timers):
+        if timers.run():
+            return None
+        if self.inbox:
+            return self.inbox.popleft()
+        # Nothing to receive before the next deadline, the datagrams sent meanwhile come after its timers
+        deadline = timers.next_deadline()
+        self.clock.now = max(self.clock.now, deadline + timers.resolution)
+        timers.run()
+        while self.arrivals and self.arrivals[0][0] <= self.clock.now:
+            self.inbox.append((self.arrivals.pop(0)[1], CLIENT))
+        return None
+
+    def poll(self):
+        return self.inbox.popleft() if self.inbox else None
+
+    def set_timeout(self, timeout: float):
+        pass
+
+    def kernel_drops(self):
+        return None
+
+    def close(self):
+        pass
+
+
+def ack(seq: int) -> bytes:
+    """ACK of the client for segment seq"""
+    segment = Segment()
+    segment.set_flag(["ACK"])
+    segment.set_header({"seq": seq, "ack": seq + 1})
+    return segment.to_bytes()
+
+
+@pytest.fixture
+def server(workdir):
+    (workdir / "sent_file" / "data.bin").write_bytes(bytes(range(256)) * 10)
+    clock = FakeClock()
+    server = Server(parse_args(True, ["7000", "data.bin", "mem:test", "--clients", "1", "-q",
+                                      "--segment-size", "1024", "--window-size", "4"]),
+                    conn=FakeConnection(clock), clock=clock)
+    server.split_file()
+    yield server
+    server.sent_file.close()
+
+
+class Session:
+    """Session generator of the server, given a turn to send whenever it asks for one"""
+
+    def __init__(self, generator) -> None:
+        self.generator = generator
+        self.done = False
+        self.value = None
+        self.step(None)
+
+    def step(self, result):
+        """Resume the session with result, until it waits for a datagram or its timers"""
+        try:
+            size = self.generator.send(result)
+            while size is not None:
+                size = self.generator.send(None)
+        except StopIteration as stop:
+            self.done = True
+            self.value = stop.value
+
+
+def start_transfer(server: Server, fast_open: bool) -> Session:
+    peer = server.connections.open(CLIENT, Segment().version)
+    if not fast_open:
+        server.connections.establish(CLIENT, peer.version)
+    return Session(server.transfer_file(CLIENT, server.sent_file, fast_open))
+
+
+def test_transfer_drops_malformed_datagrams(server):
+    session = start_transfer(server, fast_open=False)
+    corrupted = bytearray(ack(METADATA_SEQ + SEGMENTS))
+    corrupted[-1] ^= 0xFF
+    for datagram in [b"", b"\x01\x02\x03", bytes(corrupted)]:
+        session.step((datagram, CLIENT))
+        assert not session.done
+    assert server.get_metrics(CLIENT).checksum_failures.value == 1
+    # The ACKs still complete the transfer
+    for seq in range(METADATA_SEQ, METADATA_SEQ + SEGMENTS + 1):
+        session.step((ack(seq), CLIENT))
+    assert session.done and session.value is True
+
+
+def test_unanswered_fast_open_is_abandoned(server):
+    session = start_transfer(server, fast_open=True)
+    server.clock.now = server.connections.half_open_timeout + 1
+    server.timers.run()
+    session.step(None)
+    assert session.done and session.value is False
+    assert server.connections.metrics.abandoned.value == 1
+    assert CLIENT not in server.metrics
+
+
+def test_fast_open_answered_as_the_handshake_times_out(server):
+    """A SYN-ACK queued when the handshake timer fires is handed to the session before its timers"""
+    conn = server.conn
+    conn.arrivals.append((server.connections.half_open_timeout, syn_ack()))
+    server.connections.open(CLIENT, Segment().version).fast_open = True
+    original_dispatch = server.dispatch
+
+    def dispatch(result, accept):
+        # The client answers the data once its SYN-ACK is received
+        conn.answering = True
+        original_dispatch(result, accept)
+
+    server.dispatch = dispatch
+    server.serve([(CLIENT, None)])
+    assert server.connections.metrics.abandoned.value == 0
+    assert server.closed_sessions.value == 1
+    assert server.closed_metrics.counter("segments_sent_total").value >= SEGMENTS
+
+
+def syn_ack() -> bytes:
+    """SYN-ACK of the client, acknowledging the metadata sent with the SYN of a fast open"""
+    segment = Segment()
+    segment.set_flag(["SYN", "ACK"])
+    segment.set_header({"seq": 0, "ack": METADATA_SEQ + 1})
+    return segment.to_bytes()
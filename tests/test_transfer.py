@@ -0,0 +1,127 @@
+"""
+End to end transfers between a server and a client running as threads of the test, over the
+mem: transport, see lib.transport.QueueTransport.
+"""
+import itertools
+import random
+import threading
+import pytest
+from lib.parser import parse_args
+from server import Server
+from client import Client
+
+HOST = "mem:test"
+SEGMENT_SIZE = 1024
+READ_AHEAD = 4
+# Seconds a transfer may take before its sockets are closed to fail it
+RUN_TIMEOUT = 60
+
+PORTS = itertools.count(20000, 2)
+
+
+def transfer(name: str, fast_open: bool, server_args: list = (), client_args: list = ()):
+    """
+    Send sent_file/name to a client.
+    :param server_args, client_args: more options of the server and of the client
+    :return: the server, whether the metadata came with the SYN and whether both sides succeeded
+    """
+    server_port = next(PORTS)
+    fast_open_args = [] if fast_open else ["--no-fast-open"]
+    server = Server(parse_args(True, [
+        str(server_port), name, HOST, "--clients", "1", "-q", "--segment-size", str(SEGMENT_SIZE),
+        "--read-ahead", str(READ_AHEAD), "--linger", "0.1",
+    ] + fast_open_args + list(server_args)))
+    client = Client(parse_args(False, [str(server_port + 1), str(server_port), name, HOST, HOST, "-q"]
+                               + fast_open_args + list(client_args)))
+    errors = []
+    fast_opened = False
+
+    def serve():
+        try:
+            server.split_file()
+            server.listen_for_clients()
+            server.initiate_transfer()
+        except Exception as exc:  # pylint: disable=broad-except
+            errors.append(exc)
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    # Closing the endpoints makes a stuck transfer fail instead of hanging the tests
+    watchdog = threading.Timer(RUN_TIMEOUT, lambda: (client.conn.close(), server.conn.close()))
+    watchdog.start()
+    try:
+        client.connect()
+        client.three_way_handshake()
+        fast_opened = client.early_metadata
+        client.listen_file_transfer()
+    finally:
+        client.shutdown()
+        thread.join(RUN_TIMEOUT)
+        watchdog.cancel()
+        server.conn.close()
+    return server, fast_opened, not errors and not thread.is_alive()
+
+
+# 11 data segments make 3 groups of up to 4
+@pytest.mark.parametrize("client_fec, parity", [(4, 3), (0, 0)], ids=["fec", "client-without-fec"])
+def test_fec_is_negotiated(workdir, client_fec, parity):
+    data = random.Random(3).randbytes(SEGMENT_SIZE * 10 + 45)
+    (workdir / "sent_file" / "data.bin").write_bytes(data)
+
+    server, _, ok = transfer("data.bin", True, ["--fec", "4"], ["--fec", str(client_fec)])
+
+    assert ok
+    assert (workdir / "received_file" / "data.bin").read_bytes() == data
+    # A client sending --fec 0 gets no parity segments
+    assert server.closed_metrics.counter("fec_parity_sent_total").value == parity
+
+
+def request(name: str) -> bool:
+    """
+    Ask a daemon serving sent_file/ for name, the daemon being left to run in its thread.
+    :return: whether the client received the file
+    """
+    server_port = next(PORTS)
+    server = Server(parse_args(True, [str(server_port), ".", HOST, "--daemon", "-q", "--linger", "0.1"]))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = Client(parse_args(False, [str(server_port + 1), str(server_port), name, HOST, HOST, "-q"]))
+    watchdog = threading.Timer(RUN_TIMEOUT, client.conn.close)
+    watchdog.start()
+    try:
+        client.connect()
+        client.three_way_handshake()
+        return client.listen_file_transfer()
+    finally:
+        client.shutdown()
+        watchdog.cancel()
+
+
+@pytest.mark.parametrize("fast_open", [True, False], ids=["fast-open", "full-handshake"])
+def test_file_longer_than_read_ahead(workdir, fast_open):
+    data = random.Random(1).randbytes(SEGMENT_SIZE * READ_AHEAD * 5 + 123)
+    (workdir / "sent_file" / "data.bin").write_bytes(data)
+
+    server, fast_opened, ok = transfer("data.bin", fast_open)
+
+    assert ok
+    assert (workdir / "received_file" / "data.bin").read_bytes() == data
+    assert fast_opened == fast_open
+    # The session ended, its counters are in the totals of the closed connections
+    assert not server.metrics
+    assert server.closed_sessions.value == 1
+    # Read ahead after the first miss
+    assert server.closed_metrics.counter("segment_cache_hits_total").value > 0
+
+
+def test_refused_request_writes_nothing(workdir):
+    assert not request("missing.bin")
+    assert not (workdir / "received_file" / "missing.bin").exists()
+
+
+def test_file_keeps_its_relative_path(workdir):
+    data = random.Random(2).randbytes(SEGMENT_SIZE * 3)
+    (workdir / "sent_file" / "sub").mkdir()
+    (workdir / "sent_file" / "sub" / "data.bin").write_bytes(data)
+
+    assert request("sub/data.bin")
+    assert (workdir / "received_file" / "sub" / "data.bin").read_bytes() == data